@@ -0,0 +1,80 @@
+"""
+Benchmark of the time it takes to import the modules of the analytical path.
+
+Each import is timed in a fresh interpreter, since a module is only imported
+once per process, and the heavy optional dependencies that got imported
+along the way are recorded, so that an eager import of one of them shows up
+as a regression.
+
+Usage:
+    python -m slrealizer.benchmarks.import_time [--repeat 5] [--output import_time.json]
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import json
+import subprocess
+import numpy as np
+
+# Modules whose import time is tracked
+MODULES = ['slrealizer.realize_om10', 'slrealizer.realize_sdss', 'slrealizer.utils.aggregate']
+# Dependencies that the analytical path should not import
+HEAVY_DEPENDENCIES = ['galsim', 'om10', 'astropy', 'matplotlib']
+
+_TIMER = """
+import sys, time, json
+start = time.time()
+import %s
+elapsed = time.time() - start
+print(json.dumps({'seconds': elapsed, 'heavy': [m for m in %r if m in sys.modules]}))
+"""
+
+def time_import(module, repeat=5, python=sys.executable):
+    """
+    Returns the import time of module in seconds, as the median over repeat fresh interpreters,
+    and the heavy dependencies that importing it pulled in
+
+    Keyword arguments:
+    module -- dotted name of the module, e.g. 'slrealizer.realize_om10'
+    repeat -- number of interpreters to time [default: 5]
+    python -- path of the Python interpreter [default: sys.executable]
+    """
+    timings = []
+    heavy = []
+    for _ in range(repeat):
+        output = subprocess.check_output([python, '-c', _TIMER %(module, HEAVY_DEPENDENCIES)])
+        result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        timings.append(result['seconds'])
+        heavy = result['heavy']
+    return float(np.median(timings)), heavy
+
+def run(modules=None, repeat=5):
+    """
+    Returns the benchmark results, a dictionary with one entry per module
+
+    Keyword arguments:
+    modules -- list of the modules to time. If None, MODULES is used [default: None]
+    repeat -- number of interpreters per module [default: 5]
+    """
+    if modules is None:
+        modules = MODULES
+    results = {}
+    for module in modules:
+        seconds, heavy = time_import(module, repeat=repeat)
+        results[module] = {'seconds': seconds, 'heavy_dependencies': heavy}
+        print("%s: %0.3f s, heavy dependencies imported: %s" %(module, seconds, ', '.join(heavy) or 'none'))
+    return results
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='number of fresh interpreters per module')
+    parser.add_argument('--output', default=None, help='path of the JSON file of the results')
+    args = parser.parse_args()
+    results = run(repeat=args.repeat)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
@@ -0,0 +1,96 @@
+"""
+Vectorized generators of synthetic inputs of any size for the benchmarks.
+
+The lens catalog has the columns of the flattened OM10 sample
+(see utils/catalog_cache.py) and the observation history has the OpSim
+columns used by the realizers, with values in realistic ranges, so that
+the realizers do the same work per row as on the real inputs.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import pandas as pd
+from ..utils.catalog_cache import CachedCatalog
+from ..utils.analytical_moments import BANDS, get_band_index
+
+# Columns of the observation history read by the realizers, in the order of obs_info
+OBSERVATION_COLUMNS = ['obsHistID', 'expMJD', 'filter', 'FWHMeff', 'fiveSigmaDepth']
+# Typical single-visit 5-sigma depths of LSST in each band
+FIVE_SIGMA_DEPTHS = {'u': 23.9, 'g': 25.0, 'r': 24.7, 'i': 24.0, 'z': 23.3}
+
+def make_synthetic_catalog(num_lenses, seed=123, first_id=1):
+    """
+    Returns a synthetic OM10-like lens sample as a CachedCatalog,
+    which OM10Realizer accepts in place of an OM10 DB
+
+    Keyword arguments:
+    num_lenses -- number of lenses
+    seed -- seed of the generator [default: 123]
+    first_id -- LENSID of the first lens; IDs are consecutive [default: 1]
+    """
+    rng = np.random.RandomState(seed)
+    table = {}
+    lens_mag = rng.uniform(18.0, 22.0, num_lenses)
+    q_mag = rng.uniform(20.0, 23.5, num_lenses)
+    for i, b in enumerate(BANDS):
+        # Redder lenses and bluer quasars, with some scatter in the colors
+        table[b + '_SDSS_lens'] = lens_mag + 0.3*(2 - i) + rng.normal(0.0, 0.1, num_lenses)
+        table[b + '_SDSS_quasar'] = q_mag - 0.1*(2 - i) + rng.normal(0.0, 0.1, num_lenses)
+    table['REFF_T'] = rng.uniform(0.3, 1.5, num_lenses)
+    num_images = rng.choice([2, 4], size=num_lenses, p=[0.85, 0.15])
+    table['NIMG'] = num_images
+    table['LENSID'] = np.arange(first_id, first_id + num_lenses)
+    table['ELLIP'] = rng.uniform(0.0, 0.5, num_lenses)
+    table['PHIE'] = rng.uniform(-90.0, 90.0, num_lenses)
+
+    # Images on a ring of the Einstein radius around the lens
+    einstein_radius = rng.uniform(0.5, 1.5, num_lenses)[:, None]
+    angle = rng.uniform(0.0, 2.0*np.pi, (num_lenses, 4))
+    radius = einstein_radius*rng.uniform(0.7, 1.3, (num_lenses, 4))
+    magnification = rng.uniform(0.5, 5.0, (num_lenses, 4))*np.array([1.0, -1.0, 1.0, -1.0])
+    delay = np.sort(rng.uniform(0.0, 100.0, (num_lenses, 4)), axis=1)
+    delay -= delay[:, :1]
+    missing = np.arange(4)[None, :] >= num_images[:, None]
+    for mc, values in [('MAG', magnification), ('XIMG', radius*np.cos(angle)),
+                       ('YIMG', radius*np.sin(angle)), ('DELAY', delay)]:
+        values[missing] = 0.0
+        for c in range(4):
+            table[mc + '_%d' %c] = values[:, c]
+    return CachedCatalog(pd.DataFrame(table))
+
+def make_synthetic_observation(num_visits, seed=123, first_id=1, start_mjd=59580.0, duration=3650.0,
+                               num_fields=10, include_pointings=False):
+    """
+    Returns a synthetic OpSim-like observation history, sorted by expMJD
+
+    Keyword arguments:
+    num_visits -- number of visits
+    seed -- seed of the generator [default: 123]
+    first_id -- obsHistID of the first visit; IDs are consecutive [default: 1]
+    start_mjd -- MJD of the start of the survey [default: 59580.0]
+    duration -- length of the survey in days [default: 3650.0]
+    num_fields -- number of distinct pointings [default: 10]
+    include_pointings -- whether to include the fieldRA, fieldDec columns of the pointings,
+                         in radians as in OpSim v3 (e.g. for SLRealizer.match_footprints).
+                         The realizers expect only the other columns in their observation history. [default: False]
+    """
+    rng = np.random.RandomState(seed)
+    band = rng.choice(list(BANDS), size=num_visits)
+    depth = np.array([FIVE_SIGMA_DEPTHS[b] for b in BANDS])[get_band_index(band)]
+    field = rng.randint(0, num_fields, num_visits)
+    field_ra = rng.uniform(0.0, 2.0*np.pi, num_fields)
+    field_dec = np.arcsin(rng.uniform(-1.0, 0.1, num_fields))
+    observation = pd.DataFrame({'obsHistID': np.arange(first_id, first_id + num_visits),
+                                'expMJD': np.sort(start_mjd + rng.uniform(0.0, duration, num_visits)),
+                                'filter': band,
+                                'FWHMeff': rng.lognormal(np.log(0.8), 0.2, num_visits),
+                                'fiveSigmaDepth': depth + rng.normal(0.0, 0.3, num_visits),
+                                'fieldRA': field_ra[field],
+                                'fieldDec': field_dec[field]},
+                               columns=OBSERVATION_COLUMNS + ['fieldRA', 'fieldDec'])
+    if not include_pointings:
+        observation = observation[OBSERVATION_COLUMNS]
+    return observation
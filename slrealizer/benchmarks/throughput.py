@@ -0,0 +1,185 @@
+"""
+Timed and memory-profiled benchmarks of the realization pipeline on synthetic inputs.
+
+Each benchmark runs one stage of the pipeline on a synthetic lens catalog and
+observation history (see synthetic.py) and records its wall time, its throughput
+in source table rows per second and the peak memory allocated while it ran,
+as traced by tracemalloc (which NumPy reports its array allocations to).
+Tracing slows Python code down, so the time and the memory are measured in two separate runs.
+The results are saved as JSON, so that they can be compared across versions.
+
+Usage:
+    python -m slrealizer.benchmarks.throughput [--num_lenses 200] [--num_visits 500] [--output throughput.json]
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import numpy as np
+import pandas as pd
+from ..realize_om10 import OM10Realizer
+from .synthetic import make_synthetic_catalog, make_synthetic_observation
+
+ROWBYROW_METHODS = ['analytical', 'raw_numerical', 'gaussian_numerical', 'hsm']
+
+def measure(func, num_rows, trace_memory=True):
+    """
+    Calls func() and returns a dictionary of its wall time in seconds, rows per second
+    and peak traced memory in MB (None if not traced)
+
+    Keyword arguments:
+    func -- the function to benchmark, called without arguments (twice if trace_memory)
+    num_rows -- number of source table rows that func processes
+    trace_memory -- whether to call func() a second time under tracemalloc,
+                    which is unavailable in Python 2 [default: True]
+    """
+    start = time.time()
+    func()
+    seconds = time.time() - start
+    peak_mb = None
+    try:
+        import tracemalloc
+    except ImportError: # Python 2
+        trace_memory = False
+    if trace_memory:
+        tracemalloc.start()
+        func()
+        peak_mb = tracemalloc.get_traced_memory()[1]/1.e6
+        tracemalloc.stop()
+    return {'seconds': seconds,
+            'rows': num_rows,
+            'rows_per_second': num_rows/seconds if seconds > 0.0 else None,
+            'peak_memory_mb': peak_mb}
+
+def _measure_into(benchmarks, name, func, num_rows, trace_memory=True):
+    """
+    Measures func (see measure) into benchmarks[name], or records the error it raised
+    as benchmarks[name]['error'], so that one failing benchmark does not discard the others
+    """
+    try:
+        benchmarks[name] = measure(func, num_rows, trace_memory)
+    except Exception as error:
+        benchmarks[name] = {'rows': num_rows, 'error': '%s: %s' %(type(error).__name__, error)}
+        print("Benchmark %s failed with %s" %(name, benchmarks[name]['error']))
+
+def _get_variability_input(realizer):
+    """Returns the per-row columns that include_quasar_variability reads, for every (lens, visit) pair"""
+    catalog = realizer._get_catalog_table()
+    lens_rows, obs_rows = realizer._get_pair_rows(catalog['LENSID'].values, realizer.observation)
+    src = pd.DataFrame({'objectId': catalog['LENSID'].values[lens_rows],
+                        'ccdVisitId': realizer.observation['obsHistID'].values[obs_rows],
+                        'MJD': realizer.observation['expMJD'].values[obs_rows],
+                        'filter': realizer.observation['filter'].values[obs_rows],
+                        'NIMG': catalog['NIMG'].values[lens_rows]})
+    for q in range(4):
+        src['DELAY_%d' %q] = catalog['DELAY_%d' %q].values[lens_rows]
+        src['q_mag_%d' %q] = 0.0
+    return src
+
+def run(num_lenses=200, num_visits=500, rowbyrow_num_lenses=5, rowbyrow_num_visits=40,
+        rowbyrow_methods=None, seed=123, table_format='csv', trace_memory=True, output_dir=None):
+    """
+    Runs the benchmarks and returns the results as a dictionary
+
+    Keyword arguments:
+    num_lenses, num_visits -- size of the inputs of the vectorized benchmarks [default: 200, 500]
+    rowbyrow_num_lenses, rowbyrow_num_visits -- size of the inputs of the row-by-row benchmarks,
+                                                which render images and are much slower [default: 5, 40]
+    rowbyrow_methods -- list of the methods of make_source_table_rowbyrow to benchmark.
+                        If None, ROWBYROW_METHODS is used [default: None]
+    seed -- seed of the synthetic inputs [default: 123]
+    table_format -- format of the source and object tables, one of 'csv', 'parquet' and 'feather' [default: 'csv']
+    trace_memory -- whether to measure the peak memory of each benchmark (see measure) [default: True]
+    output_dir -- directory of the tables written by the benchmarks.
+                  If None, a temporary directory is used and removed afterwards [default: None]
+
+    Returns:
+    a dictionary of the configuration, the environment and the benchmarks, each of which
+    has the results of measure, or the error it failed with under 'error'
+    """
+    if rowbyrow_methods is None:
+        rowbyrow_methods = ROWBYROW_METHODS
+    remove_output_dir = output_dir is None
+    if output_dir is None:
+        output_dir = tempfile.mkdtemp(prefix='slrealizer_benchmark_')
+    source_path = os.path.join(output_dir, 'source.' + table_format)
+    object_path = os.path.join(output_dir, 'object.' + table_format)
+
+    catalog = make_synthetic_catalog(num_lenses, seed=seed)
+    observation = make_synthetic_observation(num_visits, seed=seed)
+    num_rows = num_lenses*num_visits
+    benchmarks = {}
+    try:
+        realizer = OM10Realizer(observation=observation, catalog=catalog)
+        realizer.table_format = table_format
+        _measure_into(benchmarks, 'make_source_table_vectorized',
+                      lambda: realizer.make_source_table_vectorized(source_path, include_time_variability=False),
+                      num_rows, trace_memory)
+        _measure_into(benchmarks, 'make_source_table_vectorized_variability',
+                      lambda: realizer.make_source_table_vectorized(source_path, include_time_variability=True),
+                      num_rows, trace_memory)
+        _measure_into(benchmarks, 'make_object_table',
+                      lambda: realizer.make_object_table(object_path, source_table_path=source_path, include_std=True),
+                      num_rows, trace_memory)
+        variability_input = _get_variability_input(realizer)
+        def include_quasar_variability():
+            realizer.source_table = variability_input.copy()
+            realizer.include_quasar_variability(save_output=False)
+        for model in ['independent', 'time_delay']:
+            realizer.variability_model = model
+            _measure_into(benchmarks, 'include_quasar_variability_' + model, include_quasar_variability, num_rows, trace_memory)
+
+        rowbyrow_catalog = make_synthetic_catalog(rowbyrow_num_lenses, seed=seed)
+        rowbyrow_observation = make_synthetic_observation(rowbyrow_num_visits, seed=seed)
+        rowbyrow_realizer = OM10Realizer(observation=rowbyrow_observation, catalog=rowbyrow_catalog)
+        rowbyrow_realizer.table_format = table_format
+        for method in rowbyrow_methods:
+            _measure_into(benchmarks, 'make_source_table_rowbyrow_' + method,
+                          lambda: rowbyrow_realizer.make_source_table_rowbyrow(source_path, method=method),
+                          rowbyrow_num_lenses*rowbyrow_num_visits, trace_memory)
+    finally:
+        if remove_output_dir:
+            shutil.rmtree(output_dir)
+
+    return {'config': {'num_lenses': num_lenses, 'num_visits': num_visits,
+                       'rowbyrow_num_lenses': rowbyrow_num_lenses, 'rowbyrow_num_visits': rowbyrow_num_visits,
+                       'seed': seed, 'table_format': table_format},
+            'environment': {'python': sys.version.split()[0], 'numpy': np.__version__,
+                            'pandas': pd.__version__, 'platform': platform.platform()},
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'benchmarks': benchmarks}
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--num_lenses', type=int, default=200)
+    parser.add_argument('--num_visits', type=int, default=500)
+    parser.add_argument('--rowbyrow_num_lenses', type=int, default=5)
+    parser.add_argument('--rowbyrow_num_visits', type=int, default=40)
+    parser.add_argument('--rowbyrow_methods', nargs='*', default=None, choices=ROWBYROW_METHODS)
+    parser.add_argument('--seed', type=int, default=123)
+    parser.add_argument('--table_format', default='csv', choices=['csv', 'parquet', 'feather'])
+    parser.add_argument('--no_memory', action='store_true', help='skip the memory-traced runs')
+    parser.add_argument('--output', default=None, help='path of the JSON file of the results')
+    args = parser.parse_args()
+    results = run(num_lenses=args.num_lenses, num_visits=args.num_visits,
+                  rowbyrow_num_lenses=args.rowbyrow_num_lenses, rowbyrow_num_visits=args.rowbyrow_num_visits,
+                  rowbyrow_methods=args.rowbyrow_methods, seed=args.seed,
+                  table_format=args.table_format, trace_memory=not args.no_memory)
+    for name, result in sorted(results['benchmarks'].items()):
+        if 'error' in result:
+            print("%s: failed with %s" %(name, result['error']))
+            continue
+        print("%s: %0.3f s, %0.0f rows/s, peak memory %s MB" %(name, result['seconds'], result['rows_per_second'] or 0.0,
+                                                                '%0.1f' %result['peak_memory_mb'] if result['peak_memory_mb'] is not None else 'n/a'))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
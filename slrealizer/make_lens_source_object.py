@@ -2,39 +2,80 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import os, sys
-from om10 import DB
+import os
+import argparse
 import pandas as pd
 import numpy as np
-realizer_path = os.path.join(os.environ['SLREALIZERDIR'], 'slrealizer')
-sys.path.insert(0, realizer_path)
-from realize_om10 import OM10Realizer
+from slrealizer.realize_om10 import OM10Realizer
+from slrealizer.utils.catalog_cache import load_om10_catalog
+from slrealizer.utils.shard import parse_shard, SHARD_METHODS
 
 if __name__=='__main__':
     """
     An annotated version of this script can be found in
     demo/Example+SLRealizer+Usage.ipynb.
+
+    With --shard i/N, only the i-th of N shards of the catalog is realized
+    (e.g. as one job of a batch array); once all N have run, --merge N
+    makes the object table from the per-shard statistics.
+
+    The random selection and painting of the OM10 sample is only cached
+    (and reproducible) with --catalog_seed; without it, every run draws
+    a fresh sample. All the shards of a run, and the merge, must therefore
+    share the same --catalog_seed.
     """
-    data_path = os.path.join(os.environ['SLREALIZERDIR'], 'data')
+    parser = argparse.ArgumentParser(description='Realizes the OM10 lens source and object tables.')
+    parser.add_argument('--shard', default=None, help='realize only shard i/N of the catalog, e.g. 0/16')
+    parser.add_argument('--shard_by', default='hash', choices=SHARD_METHODS)
+    parser.add_argument('--merge', type=int, default=None, metavar='N', help='merge the N shards into the object table')
+    parser.add_argument('--catalog_seed', type=int, default=None,
+                        help='seed of the selection and painting of the OM10 sample, which is then cached')
+    args = parser.parse_args()
+    if (args.shard is not None or args.merge is not None) and args.catalog_seed is None:
+        parser.error('--shard and --merge need --catalog_seed, so that all the jobs realize the same sample')
+
+    # SLREALIZERDIR (see configure.sh) defaults to the root of the repository
+    repo_dir = os.environ.get('SLREALIZERDIR', os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    data_path = os.path.join(repo_dir, 'data')
     catalog_f = os.path.join(data_path, 'qso_mock.fits')
     observation_f = os.path.join(data_path, 'twinkles_observation_history.csv')
 
     output_lens_source_path = os.path.join(data_path, 'lens_source_table.csv')
     output_lens_object_path = os.path.join(data_path, 'lens_object_table.csv')
+    output_lens_state_path = os.path.join(data_path, 'lens_aggregate_state.csv')
 
-    db = DB(catalog=catalog_f)
-    db.select_random(maglim=23.3, area=100.0, IQ=0.75)
-    #db.select_random(maglim=23.3, area=1.e8, IQ=0.75)
-    db.paint(synthetic=True)
+    # With a seed, the selected and painted sample is cached on disk,
+    # keyed by the catalog file, the parameters below and the seed
+    db = load_om10_catalog(catalog_path=catalog_f, cache_dir=os.path.join(data_path, 'catalog_cache'),
+                           select_params={'maglim': 23.3, 'area': 100.0, 'IQ': 0.75},
+                           #select_params={'maglim': 23.3, 'area': 1.e8, 'IQ': 0.75},
+                           paint_params={'synthetic': True},
+                           seed=args.catalog_seed)
     
     obs = pd.read_csv(observation_f)\
             .query("(expMJD < 65000) & (filter != 'y')")\
             .reset_index(drop=True)
     realizer = OM10Realizer(observation=obs, catalog=db, debug=False, add_moment_noise=True, add_flux_noise=True)
+    # Per-stage timing, row counts and memory go to the JSON-lines file at SLREALIZER_EVENTS, if set
+    if os.environ.get('SLREALIZER_EVENTS'):
+        realizer.instrumentation.add_jsonl_sink(os.environ['SLREALIZER_EVENTS'])
 
-    realizer.make_source_table_vectorized(output_source_path=output_lens_source_path,
-                                          include_time_variability=True)
-    
-    realizer.make_object_table(include_std=True,
-                               source_table_path=output_lens_source_path,
-                               object_table_path=output_lens_object_path)
+    if args.shard is not None:
+        shard_index, num_shards = parse_shard(args.shard)
+        realizer.make_source_table_shard(shard_index, num_shards,
+                                         output_source_path=output_lens_source_path,
+                                         aggregate_state_path=output_lens_state_path,
+                                         include_time_variability=True,
+                                         shard_by=args.shard_by)
+    elif args.merge is not None:
+        realizer.merge_object_table_shards(args.merge,
+                                           include_std=True,
+                                           object_table_path=output_lens_object_path,
+                                           aggregate_state_path=output_lens_state_path)
+    else:
+        realizer.make_source_table_vectorized(output_source_path=output_lens_source_path,
+                                              include_time_variability=True)
+        
+        realizer.make_object_table(include_std=True,
+                                   source_table_path=output_lens_source_path,
+                                   object_table_path=output_lens_object_path)
@@ -1,23 +1,35 @@
-import os, sys
-import galsim
+import os
+import argparse
 import pandas as pd
 import numpy as np
-realizer_path = os.path.join(os.environ['SLREALIZERDIR'], 'slrealizer')
-sys.path.insert(0, realizer_path)
-from realize_sdss import SDSSRealizer
-from utils.utils import *
+from slrealizer.realize_sdss import SDSSRealizer
+from slrealizer.utils.utils import *
+from slrealizer.utils.shard import parse_shard, SHARD_METHODS
 
 if __name__=='__main__':
     """
     An annotated version of this script can be found in
     demo/Example+SLRealizer+Usage.ipynb.
+
+    With --shard i/N, only the i-th of N shards of the catalog is realized
+    (e.g. as one job of a batch array); once all N have run, --merge N
+    makes the object table from the per-shard statistics.
     """
-    data_path = os.path.join(os.environ['SLREALIZERDIR'], 'data')
+    parser = argparse.ArgumentParser(description='Realizes the SDSS nonlens source and object tables.')
+    parser.add_argument('--shard', default=None, help='realize only shard i/N of the catalog, e.g. 0/16')
+    parser.add_argument('--shard_by', default='hash', choices=SHARD_METHODS)
+    parser.add_argument('--merge', type=int, default=None, metavar='N', help='merge the N shards into the object table')
+    args = parser.parse_args()
+
+    # SLREALIZERDIR (see configure.sh) defaults to the root of the repository
+    repo_dir = os.environ.get('SLREALIZERDIR', os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    data_path = os.path.join(repo_dir, 'data')
     catalog_f = os.path.join(data_path, 'sdss_processed.csv')
     observation_f = os.path.join(data_path, 'twinkles_observation_history.csv')
 
     output_nonlens_source_path = os.path.join(data_path, 'nonlens_source_table.csv')
     output_nonlens_object_path = os.path.join(data_path, 'nonlens_object_table.csv')
+    output_nonlens_state_path = os.path.join(data_path, 'nonlens_aggregate_state.csv')
     
     db = pd.read_csv(catalog_f).sample(20, random_state=123).reset_index(drop=True)
     #db = pd.read_csv(catalog_f).sample(20000, random_state=123).reset_index(drop=True)
@@ -26,10 +38,25 @@ if __name__=='__main__':
             .query("(expMJD < 65000) & (filter != 'y')")\
             .reset_index(drop=True)
     realizer = SDSSRealizer(observation=obs, catalog=db, debug=False, add_moment_noise=True, add_flux_noise=True)
+    # Per-stage timing, row counts and memory go to the JSON-lines file at SLREALIZER_EVENTS, if set
+    if os.environ.get('SLREALIZER_EVENTS'):
+        realizer.instrumentation.add_jsonl_sink(os.environ['SLREALIZER_EVENTS'])
 
-    realizer.make_source_table_vectorized(save_path=output_nonlens_source_path)
-    realizer.make_object_table(include_std=True,
-                               source_table_path=output_nonlens_source_path,
-                               object_table_path=output_nonlens_object_path)
+    if args.shard is not None:
+        shard_index, num_shards = parse_shard(args.shard)
+        realizer.make_source_table_shard(shard_index, num_shards,
+                                         output_source_path=output_nonlens_source_path,
+                                         aggregate_state_path=output_nonlens_state_path,
+                                         shard_by=args.shard_by)
+    elif args.merge is not None:
+        realizer.merge_object_table_shards(args.merge,
+                                           include_std=True,
+                                           object_table_path=output_nonlens_object_path,
+                                           aggregate_state_path=output_nonlens_state_path)
+    else:
+        realizer.make_source_table_vectorized(save_file=output_nonlens_source_path)
+        realizer.make_object_table(include_std=True,
+                                   source_table_path=output_nonlens_source_path,
+                                   object_table_path=output_nonlens_object_path)
 
     
@@ -2,13 +2,18 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from realize_sl import SLRealizer
-from utils.constants import *
-from utils.utils import *
+from .realize_sl import SLRealizer
+from .utils.constants import *
+from .utils.utils import *
+from .utils.table_io import write_table
+from .utils.gaussian_render import draw_gaussian_systems
+from .utils.noise import add_keyed_noise
+from .utils.catalog_cache import CachedCatalog, get_om10_catalog_table
+from .utils.moments_cache import get_catalog_fingerprint
+from .utils.analytical_moments import NUM_IMAGES, get_band_index, get_lens_covariance, get_image_mags, get_blended_moments, add_moment_noise
+import collections
 import numpy as np
 import pandas as pd
-import galsim
-import gc # need this to optimize memory usage
 
 class OM10Realizer(SLRealizer):
 
@@ -25,9 +30,16 @@ class OM10Realizer(SLRealizer):
         self.as_super = super(OM10Realizer, self)
         self.as_super.__init__(observation, add_moment_noise=add_moment_noise, add_flux_noise=add_flux_noise)
         self.catalog = catalog
-        self.num_systems = len(self.catalog.sample)
+        if isinstance(self.catalog, CachedCatalog):
+            self.num_systems = len(self.catalog)
+        else:
+            self.num_systems = len(self.catalog.sample)
         self.DEBUG = debug
         
+    def _bind_super(self):
+        # Methods of this class call SLRealizer's through as_super, including in subclasses
+        self.as_super = super(OM10Realizer, self)
+
     def get_lens_info(self, objID=None, rownum=None):
         if objID is not None and rownum is not None:
             raise ValueError("Need to define either objID or rownum, not both.")
@@ -37,6 +49,18 @@ class OM10Realizer(SLRealizer):
         elif rownum is not None:
             return self.catalog.sample[rownum]
 
+    def get_object_ids(self):
+        if isinstance(self.catalog, CachedCatalog):
+            return self.catalog.table['LENSID'].values
+        return np.asarray(self.catalog.sample['LENSID'])
+
+    def _get_catalog_fingerprint(self):
+        if isinstance(self.catalog, CachedCatalog):
+            table = self.catalog.table
+            return get_catalog_fingerprint([(col, table[col].values) for col in table.columns])
+        sample = self.catalog.sample
+        return get_catalog_fingerprint([(col, sample[col]) for col in sample.colnames])
+
     def _om10_to_galsim(self, lens_info, band):
         """
         Converts OM10's column values into GalSim terms
@@ -50,6 +74,8 @@ class OM10Realizer(SLRealizer):
         can be passed into GalSim (See code for which properties)
         """
         
+        import galsim
+
         # We will input flux in units of nMgy
         mag   = lens_info[band + '_SDSS_lens'] 
         flux  = mag_to_flux(mag, to_unit='nMgy') # in nMgy
@@ -63,7 +89,7 @@ class OM10Realizer(SLRealizer):
                      'beta': beta,
                      'num_objects': lens_info['NIMG']}
         
-        for obj in xrange(lens_info['NIMG']):
+        for obj in range(lens_info['NIMG']):
             obj_mag = lens_info[band + '_SDSS_quasar']\
             + flux_to_mag(abs(lens_info['MAG'][obj]))
                       #+ flux_to_mag(lens_info['MAG'][obj] + get_filter_AB_offset())
@@ -72,9 +98,35 @@ class OM10Realizer(SLRealizer):
             
         return galsimInput
 
+    def _om10_to_gaussian(self, lens_info, band):
+        """
+        Converts OM10's column values into the inputs of the NumPy Gaussian renderer
+        
+        Keyword arguments:
+        lens_info -- a row of the OM10 DB
+        band -- the filter used to observe
+
+        Returns:
+        A dictionary containing the lens galaxy's flux (nMgy), half-light radius (arcsec),
+        distortion and position angle (radians), and arrays of length 4 of
+        the quasar images' fluxes (nMgy, zero for nonexistent images) and positions (arcsec)
+        """
+        numQuasars = lens_info['NIMG']
+        q_mag_arr = lens_info[band + '_SDSS_quasar'] + flux_to_mag(np.abs(np.array(lens_info['MAG'][:numQuasars])))
+        q_flux_arr = np.zeros(4)
+        q_flux_arr[:numQuasars] = mag_to_flux(q_mag_arr, to_unit='nMgy')
+        
+        return {'flux': mag_to_flux(lens_info[band + '_SDSS_lens'], to_unit='nMgy'),
+                'half_light_radius': lens_info['REFF_T'], # REFF_T is in arcsec
+                'e': lens_info['ELLIP'],
+                'beta': np.radians(lens_info['PHIE']), # PHIE is in degrees
+                'q_flux': q_flux_arr,
+                'q_x': np.array(lens_info['XIMG'][:4], dtype=np.float64),
+                'q_y': np.array(lens_info['YIMG'][:4], dtype=np.float64), }
+
     def _om10_to_lsst(self, obs_info, lens_info):
         """Converts OM10 column values into LSST source table format
-        using analytical mooment calculation
+        using analytical moment calculation (see utils/analytical_moments.get_blended_moments)
 
         Keyword arguments:
         obs_info -- dictionary containing the observation conditions
@@ -86,39 +138,46 @@ class OM10Realizer(SLRealizer):
         """
         
         histID, MJD, band, psf_fwhm, five_sigma_depth = obs_info
+        object_id = lens_info['LENSID']
         
-        # Initialize parameter dictionary
         numQuasars = lens_info['NIMG']
         lens_mag = lens_info[band + '_SDSS_lens']
         lens_flux = mag_to_flux(lens_mag, to_unit='nMgy')
         q_mag_arr = lens_info[band + '_SDSS_quasar'] + flux_to_mag(np.abs(np.array(lens_info['MAG'][:numQuasars])))
-        q_flux_arr = mag_to_flux(q_mag_arr, to_unit='nMgy')
-        q_tot_flux = np.sum(q_flux_arr)
-        
-        derived_params = {'psf_fwhm': psf_fwhm,
-                          'lens_flux': lens_flux,
-                          'apFlux': lens_flux + q_tot_flux,
-                          'e': lens_info['ELLIP'],
-                          'beta': lens_info['PHIE'], }
+        # Fluxes of nonexistent quasar images are zero
+        q_flux = np.zeros((1, NUM_IMAGES))
+        x_img = np.zeros((1, NUM_IMAGES))
+        y_img = np.zeros((1, NUM_IMAGES))
+        q_flux[0, :numQuasars] = mag_to_flux(q_mag_arr, to_unit='nMgy')
+        x_img[0, :numQuasars] = lens_info['XIMG'][:numQuasars]
+        y_img[0, :numQuasars] = lens_info['YIMG'][:numQuasars]
         
-        # Set fluxes of nonexistent quasar images to zero
-        if numQuasars < 4:
-            q_flux_arr[numQuasars - 1:] = 0.0
-
-        # Further populate dictionary with quasar-related parameters
-        for q in range(4):
-            derived_params['q_flux_%d' %q] = q_flux_arr[q]
-            derived_params['XIMG_%d' %q] = lens_info['XIMG'][q]
-            derived_params['YIMG_%d' %q] = lens_info['YIMG'][q]
-
-        # Include moment-related keys to dictionary
-        derived_params = self._include_moments(inplace=False, input_dict=derived_params)
+        # The same kernel as the vectorized path, on a single row
+        noise = {}
+        if self.add_moment_noise:
+            for quantity, mean, stdev in [('x', get_first_moment_err(), get_first_moment_err_std()),
+                                          ('y', get_first_moment_err(), get_first_moment_err_std()),
+                                          ('trace', get_second_moment_err(), get_second_moment_err_std())]:
+                noise[quantity + '_noise'] = np.atleast_1d(add_keyed_noise(mean=mean, stdev=stdev, seed=self.seed,
+                                                                           object_id=object_id, visit_id=histID,
+                                                                           quantity=quantity))
+        # Arbitrarily set REFF_T to 1.0, as in the vectorized path
+        lens_Ixx, lens_Iyy, lens_Ixy = get_lens_covariance(np.array([lens_info['ELLIP']]), np.array([lens_info['PHIE']]))
+        moments = get_blended_moments(lens_flux=np.array([lens_flux]), q_flux=q_flux, x_img=x_img, y_img=y_img,
+                                      lens_Ixx=lens_Ixx, lens_Iyy=lens_Iyy, lens_Ixy=lens_Ixy,
+                                      sigmasq_psf=np.array([fwhm_to_sigma(psf_fwhm)**2.0]), **noise)
+        derived_params = dict((key, values[0]) for key, values in moments.items())
+        derived_params['objectId'] = object_id
+        derived_params['ccdVisitId'] = histID
+        derived_params['psf_fwhm'] = psf_fwhm
+        derived_params['e_final'], derived_params['phi_final'] = e1e2_to_ephi(derived_params['e1'], derived_params['e2'])
 
         # Add flux noise
-        apFluxErr = mag_to_flux((five_sigma_depth - 22.5)/5.0)
+        apFluxErr = mag_to_flux(five_sigma_depth - 22.5)/5.0 # because Fb = 5 \sigma_b
         derived_params['apFluxErr'] = apFluxErr
         if self.add_flux_noise:
-            derived_params['apFlux'] += add_noise(mean=0.0, stdev=apFluxErr)
+            derived_params['apFlux'] += add_keyed_noise(mean=0.0, stdev=apFluxErr, seed=self.seed,
+                                                        object_id=object_id, visit_id=histID, quantity='apFlux')
 
         # Get total magnitude
         derived_params['apMag'] = flux_to_mag(derived_params['apFlux'], from_unit='nMgy')
@@ -137,6 +196,38 @@ class OM10Realizer(SLRealizer):
         galsimInput = self._om10_to_galsim(lens_info, obs_info['filter'])
         return self.as_super.draw_system(galsimInput=galsimInput, obs_info=obs_info, save_path=save_path)
 
+    def draw_systems_gaussian(self, obs_infos, lens_infos, pixel_integration=True):
+        """
+        Renders a stack of lens systems with the FFT-free NumPy Gaussian renderer,
+        which agrees with draw_system to ~1e-6 (without the pixel response)
+        and ~1e-4 (with it) of the peak pixel value
+
+        Keyword arguments:
+        obs_infos -- list of rows of the observation history df
+        lens_infos -- list of rows of the OM10 DB, one per row of obs_infos
+        pixel_integration -- whether to include the pixel response, 
+                             as in GalSim's default drawImage method [default: True]
+
+        Returns:
+        A NumPy array of shape (len(obs_infos), self.ny, self.nx)
+        """
+        inputs = []
+        psf_fwhm = np.empty(len(obs_infos))
+        for n, (obs_info, lens_info) in enumerate(zip(obs_infos, lens_infos)):
+            histID, MJD, band, PSF_FWHM, sky_mag = obs_info
+            inputs.append(self._om10_to_gaussian(lens_info, band))
+            psf_fwhm[n] = PSF_FWHM
+        return draw_gaussian_systems(lens_flux=np.array([g['flux'] for g in inputs]),
+                                     lens_hlr=np.array([g['half_light_radius'] for g in inputs]),
+                                     lens_e=np.array([g['e'] for g in inputs]),
+                                     lens_beta=np.array([g['beta'] for g in inputs]),
+                                     q_flux=np.array([g['q_flux'] for g in inputs]),
+                                     q_x=np.array([g['q_x'] for g in inputs]),
+                                     q_y=np.array([g['q_y'] for g in inputs]),
+                                     psf_fwhm=psf_fwhm,
+                                     nx=self.nx, ny=self.ny, pixel_scale=self.pixel_scale,
+                                     pixel_integration=pixel_integration)
+
     def estimate_parameters(self, obs_info, lens_info, method="raw_numerical"):
         """
         Performs GalSim's HSM shape estimation on the image
@@ -146,15 +237,47 @@ class OM10Realizer(SLRealizer):
         Keyword arguments:
         obs_info -- dictionary containing the observation conditions
         lens_info -- dictionary containing the lens properties 
-        method -- one of "hsm" (GalSim's HSM shape estimator) or 
-                  "raw_numerical" (a native numerical moment calculator) [default: "raw_numerical"]
+        method -- one of "hsm" (GalSim's HSM shape estimator),
+                  "raw_numerical" (a native numerical moment calculator) or
+                  "gaussian_numerical" (the native numerical moment calculator 
+                  on an image from draw_systems_gaussian) [default: "raw_numerical"]
         
         Returns
         a dictionary containing the shape information 
         numerically derived by HSM
         """
+        if method == "gaussian_numerical":
+            image = self.draw_systems_gaussian(obs_infos=[obs_info], lens_infos=[lens_info])[0]
+            return self.as_super.estimate_parameters(galsim_img=image, method=method)
         galsim_img = self.draw_system(lens_info=lens_info, obs_info=obs_info, save_path=None)
-        return self.as_super.estimate_parameters(galsim_img=galsim_img, method=method)
+        guess = None
+        if method == "hsm" and self.hsm_warm_start:
+            guess = self._get_hsm_guess(obs_info, lens_info)
+        return self.as_super.estimate_parameters(galsim_img=galsim_img, method=method, guess=guess)
+
+    def _get_hsm_guess(self, obs_info, lens_info):
+        """
+        Returns the analytical, noise-free centroid x, y and size sigma = det(I)^(1/4), in arcsec,
+        of the image that draw_system renders, from which HSM starts its fit
+        """
+        histID, MJD, band, psf_fwhm, five_sigma_depth = obs_info
+        num_images = lens_info['NIMG']
+        q_flux = np.zeros((1, NUM_IMAGES))
+        x_img = np.zeros((1, NUM_IMAGES))
+        y_img = np.zeros((1, NUM_IMAGES))
+        q_mag = lens_info[band + '_SDSS_quasar'] + flux_to_mag(np.abs(np.array(lens_info['MAG'][:num_images])))
+        q_flux[0, :num_images] = mag_to_flux(q_mag, to_unit='nMgy')
+        x_img[0, :num_images] = lens_info['XIMG'][:num_images]
+        y_img[0, :num_images] = lens_info['YIMG'][:num_images]
+        # As rendered by draw_system, with the half-light radius REFF_T
+        lens_Ixx, lens_Iyy, lens_Ixy = get_lens_covariance(np.array([lens_info['ELLIP']]), np.array([lens_info['PHIE']]),
+                                                           hlr=lens_info['REFF_T'])
+        moments = get_blended_moments(lens_flux=np.array([mag_to_flux(lens_info[band + '_SDSS_lens'], to_unit='nMgy')]),
+                                      q_flux=q_flux, x_img=x_img, y_img=y_img,
+                                      lens_Ixx=lens_Ixx, lens_Iyy=lens_Iyy, lens_Ixy=lens_Ixy,
+                                      sigmasq_psf=np.array([fwhm_to_sigma(psf_fwhm)**2.0]))
+        det = moments['Ixx'][0]*moments['Iyy'][0] - moments['Ixy'][0]**2.0
+        return {'x': moments['x'][0], 'y': moments['y'][0], 'sigma': det**0.25}
 
     def draw_emulated_system(self, obs_info, lens_info):
         """
@@ -178,8 +301,8 @@ class OM10Realizer(SLRealizer):
         Keyword arguments:
         image -- a Numpy array of the lens system's image
         obs_info -- a row of the observation history df
-        method -- how to calculate the moments, one of "analytical", "raw_numerical", and "hsm"
-                  (for details about "raw_numerical" vs. "hsm", see method estimate_parameters)
+        method -- how to calculate the moments, one of "analytical", "raw_numerical", "gaussian_numerical", and "hsm"
+                  (for details about the numerical methods, see method estimate_parameters)
         
         Returns
         A dictionary with properties derived from HSM estimation
@@ -188,17 +311,81 @@ class OM10Realizer(SLRealizer):
 
         objectId = lens_info['LENSID']
         if method == "analytical":
+            # _om10_to_lsst adds the noise itself, as the vectorized path does
             derived_params = self._om10_to_lsst(obs_info=obs_info, lens_info=lens_info)
-        else:
-            derived_params = self.estimate_parameters(obs_info, lens_info, method=method)
-            if derived_params is None:
-                return None
+            return self.as_super.create_source_row(derived_params=derived_params, objectId=objectId, obs_info=obs_info,
+                                                   include_noise=False)
+        derived_params = self.estimate_parameters(obs_info, lens_info, method=method)
+        if derived_params is None:
+            return None
 
         return self.as_super.create_source_row(derived_params=derived_params, objectId=objectId, obs_info=obs_info)
 
+    def _create_rowbyrow_rows(self, start, stop, method):
+        """
+        Returns the list of source rows of the work units in range(start, stop).
+        For the "raw_numerical" and "gaussian_numerical" methods, the images of the block
+        are stacked (rendered as one stack, for "gaussian_numerical")
+        and their moments measured in one pass. With self.moments_cache, only the systems
+        missing from the cache are rendered, once per (system, band, PSF FWHM bin),
+        at the quantized FWHM of the bin.
+        """
+        if method not in ["raw_numerical", "gaussian_numerical"]:
+            return self.as_super._create_rowbyrow_rows(start, stop, method)
+        obs_rows, lens_infos = [], []
+        for k in range(start, stop):
+            j, i = self._get_work_unit(k)
+            obs_rows.append(j)
+            lens_infos.append(self.get_lens_info(rownum=i))
+        obs_infos = self.observation_store.get_records(obs_rows)
+        cache = self.moments_cache
+        derived = [None]*len(obs_infos)
+        # Work units to render, grouped by key: each group is rendered once
+        missing = collections.OrderedDict()
+        for n, (obs_info, lens_info) in enumerate(zip(obs_infos, lens_infos)):
+            if cache is None:
+                missing[n] = [n]
+                continue
+            histID, MJD, band, psf_fwhm, sky_mag = obs_info
+            key = cache.get_key(lens_info['LENSID'], band, psf_fwhm, method, self.pixel_scale, (self.nx, self.ny))
+            if key in missing:
+                # Rendered along with an earlier unit of the block
+                cache.stats.num_hits += 1
+                missing[key].append(n)
+            else:
+                derived[n] = cache.get(key)
+                if derived[n] is None:
+                    missing[key] = [n]
+        if missing:
+            render_obs_infos, render_lens_infos = [], []
+            for units in missing.values():
+                obs_info = obs_infos[units[0]]
+                if cache is not None:
+                    obs_info = obs_info.replace(3, cache.quantize_fwhm(obs_info[3]))
+                render_obs_infos.append(obs_info)
+                render_lens_infos.append(lens_infos[units[0]])
+            if method == "gaussian_numerical":
+                images = self.draw_systems_gaussian(obs_infos=render_obs_infos, lens_infos=render_lens_infos)
+            else:
+                images = np.array([self.draw_system(lens_info=lens_info, obs_info=obs_info).array
+                                   for obs_info, lens_info in zip(render_obs_infos, render_lens_infos)])
+            batch_params = self.estimate_parameters_batch(images, method=method)
+            for (key, units), derived_params in zip(missing.items(), batch_params):
+                if cache is not None:
+                    cache.put(key, derived_params)
+                for n in units:
+                    derived[n] = dict(derived_params)
+        rows = []
+        for derived_params, obs_info, lens_info in zip(derived, obs_infos, lens_infos):
+            if cache is not None:
+                cache.record_error(obs_info[3], derived_params['trace'])
+            rows.append(self.as_super.create_source_row(derived_params=derived_params, objectId=lens_info['LENSID'], obs_info=obs_info))
+        return rows
+
     def make_source_table_vectorized(self, output_source_path, include_time_variability):
         """
-        Generates the source table and saves it as a csv file.
+        Generates the source table and saves it in self.table_format
+        (inferred from the extension of output_source_path by default).
 
         Keyword arguments:
         output_source_path -- save path for the output source table
@@ -207,46 +394,11 @@ class OM10Realizer(SLRealizer):
         Returns (only if self.DEBUG == True):
         a Pandas dataframe of the source table
         """
-        import time
-        
-        start = time.time()
-        self._preformat_source_table()
-        
-        if include_time_variability:
-            self.include_quasar_variability(save_output=False)
-            self.source_table.reset_index(inplace=True)
-        src = self.source_table
-
-        # Convert each quasar magnitude back to flux
-        for q in range(4):
-            src['q_flux_' + str(q)] = mag_to_flux(src['q_mag_' + str(q)], to_unit='nMgy')
-        # Get total flux
-        q_flux_cols = ['q_flux_' + str(q) for q in range(4)]
-        src['apFlux'] = src[q_flux_cols + ['lens_flux']].sum(axis=1)
-        
-        self.source_table = src
-        self._include_moments()
-        
-        # Add flux noise
-        src['apFluxErr'] = mag_to_flux(src['fiveSigmaDepth']-22.5)/5.0 # because Fb = 5 \sigma_b
-        if self.add_flux_noise:
-            src['apFlux'] += add_noise(mean=0.0, stdev=src['apFluxErr'], shape=src['apFluxErr'].shape)
-        # Get total magnitude
-        src['apMag'] = flux_to_mag(src['apFlux'], from_unit='nMgy')
-        # Propagate to get error on magnitude
-        src['apMagErr'] = (2.5/np.log(10.0)) * src['apFluxErr'] / src['apFlux']
-        gc.collect()
-
-        # Remove remaining unused columns
-        src.drop(['lensFluxRatio', 'lens_mag', 'q_mag', 'sigmasq_lens', 'sigmasq_psf', 'NIMG',], axis=1, inplace=True)
-        for q in range(4):
-            src.drop(['MAG_%d'%q] + ['XIMG_%d'%q] + ['YIMG_%d'%q] + ['qFluxRatio_%d'%q], axis=1, inplace=True)
-        gc.collect()
+        src = self._realize_tile(include_time_variability=include_time_variability)
 
         ############################################
         # Final column reordering & saving to file #
         ############################################
-        src = src[self.source_columns]
         if self.DEBUG:
             out_num_lenses = src['objectId'].nunique()
             out_num_times = src['MJD'].nunique()
@@ -255,88 +407,226 @@ class OM10Realizer(SLRealizer):
             print("Number of lenses: ", out_num_lenses)
         
         src.set_index('objectId', inplace=True)
-        src.to_csv(output_source_path)
-        gc.collect()
-        end = time.time()
+        with self.instrumentation.stage('write', rows=len(src), method='make_source_table_vectorized'):
+            write_table(src, output_source_path, table_format=self.table_format, compression=self.table_compression,
+                        dtype=self.get_source_dtypes())
 
-        print("Done making the source table with %d row(s) in %0.2f seconds using vectorization." %(len(src), end-start))
+        print("Done making the source table with %d row(s) using vectorization." %len(src))
         self.sourceTable = src
         if self.DEBUG:
             return src
 
-    def _preformat_source_table(self):
+    def _realize_tile(self, catalog=None, observation=None, include_time_variability=False, drw_state=None):
         """
-        Initializes self.source_table with the column conventions
-        that can be used by SLRealizer's helper functions
+        Realizes the source table rows of the lenses in catalog
+        under the observation conditions in observation
+
+        Keyword arguments:
+        catalog -- a Pandas DF of lenses, formatted by _get_catalog_table
+                   If None, all lenses in self.catalog are used [default: None]
+        observation -- a Pandas DF of observations, i.e. a subset of the rows of self.observation
+                       If None, all rows of self.observation are used [default: None]
+        include_time_variability -- whether to include intrinsic quasar variability [default: False]
+        drw_state -- state of the quasar light curves to continue (see include_quasar_variability) [default: None]
+
+        Returns:
+        a Pandas DF of the source table rows, with columns self.source_columns
+        and dtypes self.get_source_dtypes(observation)
         """
-        from astropy.table import Table, Column
-        
-        catalogAstropy = self.catalog.sample # the Astropy table underlying OM10 object
-        
-        #################################
-        # OM10 --> Pandas DF conversion #
-        #################################
-        lensMagCols = [b + '_SDSS_lens' for b in 'ugriz']
-        qMagCols = [b + '_SDSS_quasar' for b in 'ugriz']
-        saveCols = lensMagCols + qMagCols + ['REFF_T', 'NIMG', 'LENSID', 'ELLIP', 'PHIE']
-        saveValues = [catalogAstropy[c] for c in saveCols]
-        saveColDict = dict(zip(saveCols, saveValues))
-        collapsedColDict = get_1D_columns(multidimColNames=['MAG', 'XIMG', 'YIMG'], table=catalogAstropy)
-        saveColDict.update(collapsedColDict)
-        catalog = Table(saveColDict.values(), names=saveColDict.keys()).to_pandas()
-        catalog.drop_duplicates('LENSID', inplace=True)
-
-        ####################################
-        # Merging catalog with observation #
-        ####################################
-        observation = self.observation.copy()
-        catalog['key'] = 0
-        observation['key'] = 0
-        src = catalog.merge(observation, how='left', on='key')
-        src.drop('key', 1, inplace=True)
-        gc.collect()
-        
-        ##############################################
-        # Rename columns and set null values to zero #
-        ##############################################
-        #src.drop(['fiveSigmaDepth', ], axis=1, inplace=True)
-        src.rename(columns={'obsHistID': 'ccdVisitId',
-            'LENSID': 'objectId',
-            'expMJD': 'MJD',
-            'FWHMeff': 'psf_fwhm',
-            'ELLIP': 'e',
-            'PHIE': 'beta',
-            }, inplace=True)
-        gc.collect()
-        
-        # Set unused band magnitudes to zero, to
-        # work only with the magnitude in the observed filter
-        for b in 'ugriz': # b = observed filter
-            setZeroLens = lensMagCols[:]
-            setZeroLens.remove(b + '_SDSS_lens')
-            setZeroQ = qMagCols[:]
-            setZeroQ.remove(b + '_SDSS_quasar')
-            src.loc[src['filter'] == b, setZeroLens] = 0.0
-            src.loc[src['filter'] == b, setZeroQ] = 0.0
-        src['lens_mag'] = src[lensMagCols].sum(axis=1)
-        src['q_mag'] = src[qMagCols].sum(axis=1)
-        src.drop(lensMagCols + qMagCols, axis=1, inplace=True)
-        gc.collect()
-        
-        # Convert magnitudes into fluxes
-        src['lens_flux'] = mag_to_flux(src['lens_mag'], to_unit='nMgy')
-        for q in range(4):
-            src['q_mag_' + str(q)] = src['q_mag'] + flux_to_mag(np.abs(src['MAG_' + str(q)]))
-            src['q_flux_' + str(q)] = mag_to_flux(src['q_mag_' + str(q)], to_unit='nMgy')
-
-        # Set fluxes of nonexistent quasar images to zero
-        src.loc[src['NIMG'] == 2, ['q_flux_2', 'q_flux_3']] = 0.0
-        src.loc[src['NIMG'] == 3, ['q_flux_3']] = 0.0
-        
-        self.source_table = src
+        tile = self._prepare_tile(catalog=catalog, observation=observation)
+        return self._realize_prepared_tile(tile, include_time_variability=include_time_variability, drw_state=drw_state)
 
-        
+    def _prepare_tile(self, catalog=None, observation=None, pair_rows=None):
+        """
+        Returns the deterministic inputs of a tile (see _realize_tile) as a dictionary:
+        the lens-level and observation-level arrays, the row indices into them
+        and the Pandas DF of the source table columns that do not depend on the noise
+
+        Keyword arguments:
+        catalog, observation -- see _realize_tile
+        pair_rows -- the (lens rows, observation rows) of the (lens, visit) pairs to realize,
+                     if already known. If None, they are given by _get_pair_rows [default: None]
+        """
+        if catalog is None:
+            catalog = self._get_catalog_table()
+        if observation is None:
+            observation = self.observation
+        dtypes = self.get_source_dtypes(observation)
+        with self.instrumentation.stage('merge') as stage:
+            if pair_rows is None:
+                pair_rows = self._get_pair_rows(catalog['LENSID'].values, observation)
+            lens_rows, obs_rows = pair_rows
+            stage.rows = len(lens_rows)
+
+        ###########################################
+        # Lens-level and observation-level arrays #
+        ###########################################
+        with self.instrumentation.stage('preformat', rows=len(lens_rows)):
+            lens_Ixx, lens_Iyy, lens_Ixy = get_lens_covariance(e=catalog['ELLIP'].values, beta=catalog['PHIE'].values)
+            tile = {'catalog': catalog,
+                    'lens_rows': lens_rows,
+                    'obs_rows': obs_rows,
+                    'dtypes': dtypes,
+                    'lens_flux': mag_to_flux(catalog[[b + '_SDSS_lens' for b in 'ugriz']].values, to_unit='nMgy'),
+                    'image_mag': get_image_mags(q_mag=catalog[[b + '_SDSS_quasar' for b in 'ugriz']].values,
+                                                magnification=catalog[['MAG_%d' %q for q in range(4)]].values,
+                                                num_images=catalog['NIMG'].values),
+                    'x_img': catalog[['XIMG_%d' %q for q in range(4)]].values,
+                    'y_img': catalog[['YIMG_%d' %q for q in range(4)]].values,
+                    'lens_Ixx': lens_Ixx, 'lens_Iyy': lens_Iyy, 'lens_Ixy': lens_Ixy,
+                    'sigmasq_psf': np.power(fwhm_to_sigma(observation['FWHMeff'].values), 2.0),
+                    'obs_flux_err': mag_to_flux(observation['fiveSigmaDepth'].values - 22.5)/5.0} # because Fb = 5 \sigma_b
+            row_band = get_band_index(observation['filter'].values)[obs_rows]
+            tile['row_band'] = row_band
+            # The band indices of get_band_index are the codes of the categorical filter
+            tile['src'] = pd.DataFrame({'MJD': observation['expMJD'].values[obs_rows],
+                                        'ccdVisitId': observation['obsHistID'].values[obs_rows].astype(dtypes['ccdVisitId']),
+                                        'objectId': catalog['LENSID'].values[lens_rows].astype(dtypes['objectId']),
+                                        'filter': pd.Categorical.from_codes(row_band, dtype=dtypes['filter']),
+                                        'psf_fwhm': observation['FWHMeff'].values[obs_rows].astype(dtypes['psf_fwhm'])})
+        return tile
+
+    def _get_blended_moments(self, tile, q_mag, noise=None):
+        """Returns the moments of the blends of tile (see get_blended_moments) given the image magnitudes q_mag of its rows"""
+        lens_rows = tile['lens_rows']
+        return get_blended_moments(lens_flux=tile['lens_flux'][lens_rows, tile['row_band']],
+                                   q_flux=mag_to_flux(q_mag, to_unit='nMgy'),
+                                   x_img=tile['x_img'][lens_rows], y_img=tile['y_img'][lens_rows],
+                                   lens_Ixx=tile['lens_Ixx'][lens_rows], lens_Iyy=tile['lens_Iyy'][lens_rows],
+                                   lens_Ixy=tile['lens_Ixy'][lens_rows], sigmasq_psf=tile['sigmasq_psf'][tile['obs_rows']],
+                                   **(noise or {}))
+
+    def _draw_noise(self, tile):
+        """
+        Returns the keyed noise of the rows of tile: a dictionary of the fractional noise
+        of x, y and the trace (empty if self.add_moment_noise is False)
+        and the flux noise (None if self.add_flux_noise is False)
+        """
+        src = tile['src']
+        noise = {}
+        flux_noise = None
+        with self.instrumentation.stage('noise', rows=len(src)):
+            if self.add_moment_noise:
+                for quantity, mean, stdev in [('x', get_first_moment_err(), get_first_moment_err_std()),
+                                              ('y', get_first_moment_err(), get_first_moment_err_std()),
+                                              ('trace', get_second_moment_err(), get_second_moment_err_std())]:
+                    noise[quantity + '_noise'] = add_keyed_noise(mean=mean, stdev=stdev, seed=self.seed,
+                                                                 object_id=src['objectId'].values,
+                                                                 visit_id=src['ccdVisitId'].values, quantity=quantity)
+            if self.add_flux_noise:
+                flux_noise = add_keyed_noise(mean=0.0, stdev=tile['obs_flux_err'][tile['obs_rows']], seed=self.seed,
+                                             object_id=src['objectId'].values, visit_id=src['ccdVisitId'].values,
+                                             quantity='apFlux')
+        return noise, flux_noise
+
+    def _get_source_rows(self, tile, moments, flux_noise=None):
+        """
+        Returns the source table rows of tile given the (noisy) moments of its blends
+        and the flux noise to add, or None for no flux noise
+        """
+        # The noise-free columns are shared with the tile, which can be realized again.
+        # Quantities are computed in float64 and only stored in the dtypes of the tile.
+        src = tile['src'].copy(deep=False)
+        float_dtype = tile['dtypes']['x']
+        e_final, phi_final = e1e2_to_ephi(moments['e1'], moments['e2'])
+        # Add flux noise
+        ap_flux = moments['apFlux']
+        ap_flux_err = tile['obs_flux_err'][tile['obs_rows']]
+        if flux_noise is not None:
+            ap_flux = ap_flux + flux_noise
+        # Get total magnitude
+        ap_mag = flux_to_mag(ap_flux, from_unit='nMgy')
+        # Propagate to get error on magnitude
+        ap_mag_err = (2.5/np.log(10.0)) * ap_flux_err / ap_flux
+        for col, values in [('x', moments['x']), ('y', moments['y']), ('trace', moments['trace']),
+                            ('e1', moments['e1']), ('e2', moments['e2']), ('e_final', e_final), ('phi_final', phi_final),
+                            ('apFlux', ap_flux), ('apFluxErr', ap_flux_err), ('apMag', ap_mag), ('apMagErr', ap_mag_err)]:
+            src[col] = values.astype(float_dtype, copy=False)
+        return src[self.source_columns]
+
+    def _realize_prepared_tile(self, tile, include_time_variability=False, drw_state=None):
+        """
+        Realizes the source table rows of a tile prepared by _prepare_tile
+
+        Keyword arguments: see _realize_tile
+        """
+        lens_rows = tile['lens_rows']
+        catalog = tile['catalog']
+        q_mag = tile['image_mag'][lens_rows, tile['row_band'], :]
+        if include_time_variability:
+            # Variability is computed on the magnitude offsets of the quasar images
+            offsets = tile['src'][['objectId', 'ccdVisitId', 'MJD', 'filter']].copy()
+            offsets['NIMG'] = catalog['NIMG'].values[lens_rows]
+            for q in range(4):
+                offsets['DELAY_%d' %q] = catalog['DELAY_%d' %q].values[lens_rows]
+                offsets['q_mag_%d' %q] = 0.0
+            self.drw_state = self._add_quasar_variability(offsets, drw_state)
+            q_mag += offsets[['q_mag_%d' %q for q in range(4)]].values
+
+        #########################################
+        # Keyed noise of the moments and fluxes #
+        #########################################
+        noise, flux_noise = self._draw_noise(tile)
+
+        ##################################
+        # Moments of the blended systems #
+        ##################################
+        with self.instrumentation.stage('moments', rows=len(lens_rows)):
+            moments = self._get_blended_moments(tile, q_mag, noise)
+            return self._get_source_rows(tile, moments, flux_noise)
+
+    def _prepare_ensemble(self, noiseless=None):
+        """
+        Returns the state shared by the realizations of make_source_table_ensemble:
+        the prepared tile of all (lens, visit) pairs (see _prepare_tile) and the noise-free table,
+        a Pandas DF of the lens and observation row of each pair and of the noise-free
+        moments of its blend, from which the noisy moments follow without the images
+
+        Keyword arguments:
+        noiseless -- the noise-free table, e.g. saved by an earlier ensemble.
+                     If None, it is computed [default: None]
+        """
+        if noiseless is not None:
+            tile = self._prepare_tile(pair_rows=(noiseless['lens_row'].values, noiseless['obs_row'].values))
+            return {'tile': tile, 'noiseless': noiseless}
+        tile = self._prepare_tile()
+        lens_rows, row_band = tile['lens_rows'], tile['row_band']
+        with self.instrumentation.stage('moments', rows=len(lens_rows)):
+            moments = self._get_blended_moments(tile, tile['image_mag'][lens_rows, row_band, :])
+            noiseless = pd.DataFrame({'lens_row': lens_rows, 'obs_row': tile['obs_rows']})
+            for col in ['apFlux', 'x', 'y', 'Ixx', 'Iyy', 'Ixy']:
+                noiseless[col] = moments[col]
+        return {'tile': tile, 'noiseless': noiseless}
+
+    def _realize_ensemble_member(self, state, include_time_variability=False):
+        """
+        Realizes the source table of one member of an ensemble with self.seed
+        from the state shared by the ensemble (see _prepare_ensemble).
+        Without variability, the noise is added to the noise-free moments;
+        variability changes the image fluxes, so the moments are then computed again.
+        """
+        tile = state['tile']
+        if include_time_variability:
+            return self._realize_prepared_tile(tile, include_time_variability=True)
+        noise, flux_noise = self._draw_noise(tile)
+        with self.instrumentation.stage('moments', rows=len(tile['lens_rows'])):
+            noiseless = state['noiseless']
+            moments = add_moment_noise(dict((col, noiseless[col].values) for col in
+                                            ['apFlux', 'x', 'y', 'Ixx', 'Iyy', 'Ixy']), **noise)
+            return self._get_source_rows(tile, moments, flux_noise)
+
+    def _get_catalog_table(self):
+        """
+        Converts the OM10 catalog into a Pandas DF with one row per lens,
+        with the multi-dimensional MAG, XIMG, YIMG, DELAY columns flattened
+        into one column per quasar image.
+        A catalog loaded from the catalog cache (see utils/catalog_cache.py) is already in this format.
+        """
+        if isinstance(self.catalog, CachedCatalog):
+            return self.catalog.table
+        return get_om10_catalog_table(self.catalog.sample)
 
     #def add_time_variability INHERITED
     #def make_source_table_rowbyrow INHERITED
+    #def make_source_table_chunked INHERITED
     #def compare_truth_vs_emulated INHERITED
@@ -2,12 +2,14 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from realize_sl import SLRealizer
-from utils.constants import *
-from utils.utils import *
-import pandas as pd
+from .realize_sl import SLRealizer
+from .utils.constants import *
+from .utils.utils import *
+from .utils.table_io import write_table, SOURCE_FLOAT_COLUMNS
+from .utils.noise import add_keyed_noise
+from .utils.moments_cache import get_catalog_fingerprint
+import copy
 import numpy as np
-import galsim
 
 class SDSSRealizer(SLRealizer):
     
@@ -28,6 +30,10 @@ class SDSSRealizer(SLRealizer):
         self.DEBUG = debug
         self.sdss_pixel_scale = 0.396 #arcsec/pixel
         
+    def _bind_super(self):
+        # Methods of this class call SLRealizer's through as_super, including in subclasses
+        self.as_super = super(SDSSRealizer, self)
+
     def get_lens_info(self, objID=None, rownum=None):
         if objID is not None and rownum is not None:
             raise ValueError("Need to define either objID or rownum, not both.")
@@ -37,6 +43,12 @@ class SDSSRealizer(SLRealizer):
         elif rownum is not None:
             return self.catalog.loc[rownum]
     
+    def get_object_ids(self):
+        return np.asarray(self.catalog['objectId'])
+
+    def _get_catalog_fingerprint(self):
+        return get_catalog_fingerprint([(col, self.catalog[col].values) for col in self.catalog.columns])
+
     def _sdss_to_galsim(self, lens_info, band):
         raise NotImplementedError
     
@@ -75,72 +87,93 @@ class SDSSRealizer(SLRealizer):
     
     def make_source_table_vectorized(self, save_file):
         import gc # need this to optimize memory usage
-        import time
         
-        start = time.time()
+        src = self._realize_tile()
+        print("Number of observations: ", src['MJD'].nunique())
+        print("Number of nonlenses: ", src['objectId'].nunique())
+        
+        src.set_index('objectId', inplace=True)
+        with self.instrumentation.stage('write', rows=len(src), method='make_source_table_vectorized'):
+            write_table(src, save_file, table_format=self.table_format, compression=self.table_compression,
+                        dtype=self.get_source_dtypes())
+        gc.collect()
+        
+        print("Done making the source table with %d row(s) using vectorization." %len(src))
+        
+        self.sourceTable = src
+        if self.DEBUG:
+            return src
+        
+    def _get_catalog_table(self):
+        """
+        Returns the SDSS catalog as a Pandas DF with one row per object
+        """
+        return self.catalog
+
+    def _realize_tile(self, catalog=None, observation=None, include_time_variability=False, drw_state=None):
+        """
+        Realizes the source table rows of the objects in catalog
+        under the observation conditions in observation
+
+        Keyword arguments:
+        catalog -- a Pandas DF of objects, i.e. a subset of the rows of self.catalog
+                   If None, all rows of self.catalog are used [default: None]
+        observation -- a Pandas DF of observations, i.e. a subset of the rows of self.observation
+                       If None, all rows of self.observation are used [default: None]
+        include_time_variability -- not supported for SDSS objects [default: False]
+        drw_state -- not supported for SDSS objects [default: None]
+
+        Returns:
+        a Pandas DF of the source table rows, with columns self.source_columns
+        and dtypes self.get_source_dtypes(observation)
+        """
+        import gc # need this to optimize memory usage
+        
+        if include_time_variability:
+            raise ValueError("SDSS objects have no quasar images to vary.")
+        if catalog is None:
+            catalog = self.catalog
+        if observation is None:
+            observation = self.observation
 
         ####################################
         # Merging catalog with observation #
         ####################################
-        catalog = self.catalog.copy()
-        observation = self.observation.copy()
-        catalog['key'] = 0
-        observation['key'] = 0
-        src = catalog.merge(observation, how='left', on='key')
-        src.drop('key', 1, inplace=True)
+        with self.instrumentation.stage('merge') as stage:
+            src = self._merge_with_observation(catalog, observation, id_column='objectId')
+            stage.rows = len(src)
         gc.collect()
         
         ####################################
         # Collapsing multi-band properties #
         # into one of observed band        #
         ####################################
-        setZeroDict = {}
-        propsToCollapse = ['modelFlux', 'offsetRa', 'offsetDec', 'mRrCc', 'mE1', 'mE2', ]
-        # Initialize dictionary of columns we want to collapse
-        for p in propsToCollapse:
-            setZeroDict[p] = [p + '_' + b for b in 'ugriz']
-        # Set unused column values to zero
-        for b in 'ugriz': # b = observed filter
+        with self.instrumentation.stage('preformat', rows=len(src)):
+            setZeroDict = {}
+            propsToCollapse = ['modelFlux', 'offsetRa', 'offsetDec', 'mRrCc', 'mE1', 'mE2', ]
+            # Initialize dictionary of columns we want to collapse
+            for p in propsToCollapse:
+                setZeroDict[p] = [p + '_' + b for b in 'ugriz']
+            # Set unused column values to zero
+            for b in 'ugriz': # b = observed filter
+                for p in propsToCollapse: # multi-band columns to collapse
+                    setZeroCols = setZeroDict[p][:]
+                    setZeroCols.remove(p + '_' + b)
+                    src.loc[src['filter'] == b, setZeroCols] = 0.0
+            # Collapse
             for p in propsToCollapse: # multi-band columns to collapse
-                setZeroCols = setZeroDict[p][:]
-                setZeroCols.remove(p + '_' + b)
-                src.loc[src['filter'] == b, setZeroCols] = 0.0
-        # Collapse
-        for p in propsToCollapse: # multi-band columns to collapse
-            src[p] = src[[p + '_' + b for b in 'ugriz']].sum(axis=1)
-            src.drop([p + '_' + b for b in 'ugriz'], axis=1, inplace=True)
+                src[p] = src[[p + '_' + b for b in 'ugriz']].sum(axis=1)
+                src.drop([p + '_' + b for b in 'ugriz'], axis=1, inplace=True)
         gc.collect()
         
-        ################
-        # Adding noise #
-        ################
-        src['apFluxErr'] = mag_to_flux(src['fiveSigmaDepth'] - 22.5)/5.0
-        if self.add_flux_noise:
-            src['modelFlux'] += add_noise(mean=0.0, 
-                                          stdev=src['apFluxErr'],
-                                          shape=src['apFluxErr'].shape) # flux rms not skyEr
-        src['x'] = np.cos(np.deg2rad(src['offsetDec']*3600.0))*src['offsetRa']
-        src['y'] = src['offsetDec']
-        src['trace'] = src['mRrCc']*(self.sdss_pixel_scale**2.0) + 2.0*np.power(fwhm_to_sigma(src['FWHMeff']), 2.0)
-        if self.add_moment_noise:
-            src['x'] += add_noise(mean=get_first_moment_err(), 
-                                  stdev=get_first_moment_err_std(), 
-                                  shape=src['x'].shape,
-                                  measurement=src['x'])
-            src['y'] += add_noise(mean=get_first_moment_err(), 
-                                  stdev=get_first_moment_err_std(), 
-                                  shape=src['y'].shape,
-                                  measurement=src['y'])
-            src['trace'] += add_noise(mean=get_second_moment_err(), 
-                                     stdev=get_second_moment_err_std(), 
-                                     shape=src['trace'].shape,
-                                     measurement=src['trace'])
-        src['apMag'] = flux_to_mag(src['modelFlux'], from_unit='nMgy')
-        src['apMagErr'] = (2.5/np.log(10.0)) * src['apFluxErr'] / src['modelFlux']
-        
-        #####################################################
-        # Final column renaming/reordering & saving to file #
-        #####################################################
+        ###################################
+        # Moments & final column renaming #
+        ###################################
+        with self.instrumentation.stage('moments', rows=len(src)):
+            src['apFluxErr'] = mag_to_flux(src['fiveSigmaDepth'] - 22.5)/5.0
+            src['x'] = np.cos(np.deg2rad(src['offsetDec']*3600.0))*src['offsetRa']
+            src['y'] = src['offsetDec']
+            src['trace'] = src['mRrCc']*(self.sdss_pixel_scale**2.0) + 2.0*np.power(fwhm_to_sigma(src['FWHMeff']), 2.0)
         src.rename(columns={'obsHistID': 'ccdVisitId',
                             'expMJD': 'MJD',
                             'FWHMeff': 'psf_fwhm',
@@ -150,19 +183,66 @@ class SDSSRealizer(SLRealizer):
         src['e_final'], src['phi_final'] = e1e2_to_ephi(src['e1'], src['e2'])
         src.drop(['mRrCc', 'offsetRa', 'offsetDec', 'fiveSigmaDepth'], axis=1, inplace=True)
         gc.collect()
-        print("Number of observations: ", src['MJD'].nunique())
-        print("Number of nonlenses: ", src['objectId'].nunique())
-        
-        src = src[self.source_columns]
-        src.set_index('objectId', inplace=True)
-        src.to_csv(save_file)
-        end = time.time()
-        
-        print("Done making the source table with %d row(s) in %0.2f seconds using vectorization." %(len(src), end-start))
-        
-        self.sourceTable = src
-        if self.DEBUG:
-            return src
-        
-    
-    #def make_source_table INHERITED
+
+        ################
+        # Adding noise #
+        ################
+        self._add_noise(src)
+
+        return src[self.source_columns].astype(self.get_source_dtypes(observation))
+
+    def _add_noise(self, src):
+        """
+        Adds the keyed flux and moment noise to the noise-free source table rows in src, in place,
+        and computes the magnitudes from the noisy fluxes
+        """
+        with self.instrumentation.stage('noise', rows=len(src)):
+            if self.add_flux_noise:
+                src['apFlux'] += add_keyed_noise(mean=0.0, 
+                                                 stdev=src['apFluxErr'], # flux rms not skyErr
+                                                 seed=self.seed, object_id=src['objectId'], visit_id=src['ccdVisitId'], quantity='apFlux')
+            if self.add_moment_noise:
+                src['x'] += add_keyed_noise(mean=get_first_moment_err(), 
+                                            stdev=get_first_moment_err_std(), 
+                                            seed=self.seed, object_id=src['objectId'], visit_id=src['ccdVisitId'], quantity='x',
+                                            measurement=src['x'])
+                src['y'] += add_keyed_noise(mean=get_first_moment_err(), 
+                                            stdev=get_first_moment_err_std(), 
+                                            seed=self.seed, object_id=src['objectId'], visit_id=src['ccdVisitId'], quantity='y',
+                                            measurement=src['y'])
+                src['trace'] += add_keyed_noise(mean=get_second_moment_err(), 
+                                                stdev=get_second_moment_err_std(), 
+                                                seed=self.seed, object_id=src['objectId'], visit_id=src['ccdVisitId'], quantity='trace',
+                                                measurement=src['trace'])
+        src['apMag'] = flux_to_mag(src['apFlux'], from_unit='nMgy')
+        src['apMagErr'] = (2.5/np.log(10.0)) * src['apFluxErr'] / src['apFlux']
+
+    def _prepare_ensemble(self, noiseless=None):
+        """
+        Returns the state shared by the realizations of make_source_table_ensemble:
+        the noise-free source table, in double precision
+
+        Keyword arguments:
+        noiseless -- the noise-free source table, e.g. saved by an earlier ensemble.
+                     If None, it is realized [default: None]
+        """
+        if noiseless is None:
+            quiet = copy.copy(self)
+            quiet.add_moment_noise, quiet.add_flux_noise, quiet.use_float32 = False, False, False
+            noiseless = quiet._realize_tile()
+        return {'noiseless': noiseless}
+
+    def _realize_ensemble_member(self, state, include_time_variability=False):
+        """
+        Realizes the source table of one member of an ensemble with self.seed
+        by adding the noise to the noise-free source table of state (see _prepare_ensemble)
+        """
+        if include_time_variability:
+            raise ValueError("SDSS objects have no quasar images to vary.")
+        noiseless = state['noiseless']
+        src = noiseless.astype(dict((col, np.float64) for col in SOURCE_FLOAT_COLUMNS if col in noiseless.columns))
+        self._add_noise(src)
+        return src[self.source_columns].astype(self.get_source_dtypes())
+
+    #def make_source_table_rowbyrow INHERITED
+    #def make_source_table_chunked INHERITED
@@ -3,12 +3,47 @@ from __future__ import division
 from __future__ import print_function
 
 import numpy as np
-from utils.utils import *
-from utils.constants import *
+from .utils.utils import *
+from .utils.constants import *
+from .utils.table_io import read_table, iter_table, write_table, append_table, open_table_writer
+from .utils.table_io import get_source_table_dtypes, get_object_table_dtypes
+from .utils.drw import get_segment_starts, simulate_drw, get_grid_nodes
+from .utils.noise import add_keyed_noise, get_standard_normal
+from .utils.footprint import get_uniform_sky_positions, get_overlapping_pairs
+from .utils.column_buffer import ColumnBuffer
+from .utils.aggregate import ObjectAggregator
+from .utils.instrumentation import Instrumentation
+from .utils.observation_store import ObservationStore
+from .utils.shard import get_shard_indices, get_shard_path
+from .utils.checkpoint import Checkpoint
+from .utils.hsm_stats import HSMStats
+from .utils.moments_cache import get_catalog_fingerprint
 import pandas as pd
 import random
-import om10
-import galsim
+
+# Per-process state of the make_source_table_rowbyrow worker pool,
+# set once per worker by _init_rowbyrow_worker
+_worker_realizer = None
+_worker_method = None
+
+def _init_rowbyrow_worker(realizer, method):
+    """Receives the realizer (with its catalog and observation history) once per worker process"""
+    global _worker_realizer, _worker_method
+    _worker_realizer = realizer
+    _worker_method = method
+
+def _realize_rowbyrow_block(bounds):
+    """
+    Returns the start index, the source rows, the HSM fit counts and the moments cache counts
+    (None without a cache) of the work units in range(*bounds)
+    """
+    start, stop = bounds
+    moments_cache = _worker_realizer.moments_cache
+    _worker_realizer.hsm_stats.reset()
+    if moments_cache is not None:
+        moments_cache.stats.reset()
+    rows = _worker_realizer._create_rowbyrow_rows(start, stop, _worker_method)
+    return start, rows, _worker_realizer.hsm_stats, None if moments_cache is None else moments_cache.stats
 
 class SLRealizer(object):
 
@@ -28,16 +63,49 @@ class SLRealizer(object):
         """
         self.observation = observation
         self.num_obs = len(self.observation)
+        # Indexed view of self.observation, built on first use (see observation_store)
+        self._observation_store = None
         
-        # GalSim drawImage params
-        self.fft_params = galsim.GSParams(maximum_fft_size=10240)
+        # GalSim drawImage params, created on first use (see fft_params)
+        self._fft_params = None
         self.pixel_scale = 0.1
         self.nx, self.ny = 49, 49 
         
+        # (observation, system) pairs realized when only systems within the field of view
+        # of each visit are observed (see match_footprints); None means all pairs
+        self.footprint_rows = None
+        self.footprint_pairs = None
+        self.sky_positions = None
+        
         # Source table df
         self.source_table = None
+        # Model of quasar variability: 'independent' gives each quasar image its own random walk,
+        # 'time_delay' delays one intrinsic light curve per source by the OM10 time delay of each image,
+        # evaluated on a grid with spacing drw_grid_step (days)
+        self.variability_model = 'independent'
+        self.drw_grid_step = 0.01
+        # Value of each random walk at its last epoch, set by include_quasar_variability
+        # to continue light curves with new visits
+        self.drw_state = None
+        # Mask of the (observation, system) pairs for which make_source_table_rowbyrow failed
+        self.rowbyrow_failed = None
+        # Whether HSM fits start from the analytical centroid and size of the image, where the subclass
+        # can predict them, and the counts of the fits of the last make_source_table_rowbyrow run
+        self.hsm_warm_start = True
+        self.hsm_stats = HSMStats()
+        # Optional MomentsCache of the noise-free moments of the "raw_numerical" and "gaussian_numerical"
+        # row-by-row methods, keyed by system, band and PSF FWHM bin (see utils/moments_cache.py) [default: None]
+        self.moments_cache = None
         # Source table column list
         self.source_columns = ['MJD', 'ccdVisitId', 'objectId', 'filter', 'psf_fwhm', 'x', 'y', 'apFlux', 'apFluxErr', 'apMag', 'apMagErr', 'trace', 'e1', 'e2', 'e_final', 'phi_final', ]
+        # On-disk format of the source and object tables, one of 'csv', 'parquet', 'feather'
+        # (None infers the format from the file extension) and its compression codec
+        # (None uses the format's default); see utils/table_io.py
+        self.table_format = None
+        self.table_compression = None
+        # Whether to store the measured quantities of the source and object tables in float32
+        # instead of float64; see get_source_dtypes
+        self.use_float32 = False
         
         # Controlling randomness
         self.add_moment_noise = add_moment_noise
@@ -46,22 +114,45 @@ class SLRealizer(object):
             self.remove_random = True
         else:
             self.remove_random = False
+        # Seed of the counter-based noise, which is keyed by (seed, objectId, ccdVisitId, quantity)
+        # so that it does not depend on the order or grouping of the rows; see utils/noise.py
         self.seed = 123
-        np.random.seed(self.seed)
+        # Receives the timing, row count and memory of each stage of the realization;
+        # register callbacks or a JSON-lines sink on it (see utils/instrumentation.py)
+        self.instrumentation = Instrumentation()
         
+    @property
+    def observation_store(self):
+        """The ObservationStore of self.observation, rebuilt whenever self.observation is replaced"""
+        if self._observation_store is None or self._observation_store.observation is not self.observation:
+            self._observation_store = ObservationStore(self.observation)
+        return self._observation_store
+
     def get_obs_info(self, obsID=None, rownum=None):
+        """
+        Returns the visit with ID obsID, or in row rownum of the observation history,
+        as an ObservationRecord (see utils/observation_store.py)
+        """
         if obsID is not None and rownum is not None:
             raise ValueError("Need to define either obsID or rownum, not both.")
         
         if obsID is not None:
-            return self.observation.loc[self.observation['obsHistID']==obsID]
+            return self.observation_store.get_record_by_id(obsID)
         elif rownum is not None:
-            return self.observation.loc[rownum]
+            return self.observation_store.get_record(rownum)
     
     def _get_lens_info(self, lensID):
         ''' This function will depend on the format of each lens catalog '''
         raise NotImplementedError
         
+    @property
+    def fft_params(self):
+        """GalSim drawImage params, created on first use so that only the rendering paths import galsim"""
+        if self._fft_params is None:
+            import galsim
+            self._fft_params = galsim.GSParams(maximum_fft_size=10240)
+        return self._fft_params
+
     def draw_system(self, galsimInput, obs_info, save_path=None):
         '''
         Draws all objects of the given lens system
@@ -76,15 +167,17 @@ class SLRealizer(object):
         A GalSim object of the aggregate system used to render
         the image
         '''
+        import galsim
+
         histID, MJD, band, PSF_FWHM, sky_mag = obs_info
 
         # Lens galaxy
         galaxy = galsim.Gaussian(half_light_radius=galsimInput['half_light_radius'],\
                                  flux=galsimInput['flux'])\
                        .shear(e=galsimInput['e'], beta=galsimInput['beta'])
-        # Lensed quasar
-        for i in xrange(galsimInput['num_objects']):
-            lens = galsim.Gaussian(flux=galsimInput['flux_'+str(i)], sigma=0.0)\
+        # Lensed quasar, a point source (GalSim 2 no longer accepts a Gaussian of zero width)
+        for i in range(galsimInput['num_objects']):
+            lens = galsim.DeltaFunction(flux=galsimInput['flux_'+str(i)])\
                          .shift(galsimInput['xy_'+str(i)])
             galaxy += lens
             
@@ -92,12 +185,42 @@ class SLRealizer(object):
         galsim_obj = galsim.Convolve([galaxy, psf], gsparams=self.fft_params)
         galsim_img = galsim_obj.drawImage(nx=self.nx, ny=self.ny, scale=self.pixel_scale)
         if save_path is not None:
+            import matplotlib.pyplot as plt
             plt.imshow(galsim_img.array, interpolation='none', aspect='auto')
             plt.savefig(save_path)
             plt.close()
         return galsim_img
         
-    def estimate_parameters(self, galsim_img, method="raw_numerical"):
+    def _find_adaptive_moments(self, galsim_img, guess=None):
+        """
+        Returns GalSim's HSM adaptive moments of galsim_img, or None if they cannot be found.
+        The fit starts from guess, if given, and is retried from the center of the stamp
+        with a fixed size if it fails. Every fit is counted in self.hsm_stats.
+
+        Keyword arguments:
+        galsim_img -- GalSim's Image object
+        guess -- dictionary of the expected centroid x, y and size sigma of the image in arcsec,
+                 e.g. from the analytical moments [default: None]
+        """
+        import galsim
+        attempts = []
+        if guess is not None:
+            attempts.append({'guess_sig': guess['sigma']/self.pixel_scale,
+                             'guess_centroid': galsim.PositionD(physical_to_pixel(guess['x'], self.nx, self.pixel_scale),
+                                                                physical_to_pixel(guess['y'], self.ny, self.pixel_scale))})
+        attempts.append({'guess_sig': self.pixel_scale*10.0})
+        iterations = 0
+        for attempt, kwargs in enumerate(attempts):
+            # Non-strict fits report failures in moments_status rather than raising
+            shape_info = galsim_img.FindAdaptiveMom(strict=False, **kwargs)
+            iterations += max(shape_info.moments_n_iter, 0)
+            if shape_info.moments_status == 0:
+                self.hsm_stats.record(iterations, attempt + 1, True, guess is not None)
+                return shape_info
+        self.hsm_stats.record(iterations, len(attempts), False, guess is not None)
+        return None
+
+    def estimate_parameters(self, galsim_img, method="raw_numerical", guess=None):
         """
         Performs shape estimati on on the galsim_img 
         using either GalSim's HSM shape estimator or 
@@ -106,8 +229,13 @@ class SLRealizer(object):
         
         Keyword arguments:
         galsim_img -- GalSim's Image object on which parameters will be estimated
-        method -- one of "hsm" (GalSim's HSM shape estimator) or 
-                  "raw_numerical" (a native numerical moment calculator) [default: "raw"]
+                      (or, for method "gaussian_numerical", a NumPy image array)
+        method -- one of "hsm" (GalSim's HSM shape estimator), 
+                  "raw_numerical" (a native numerical moment calculator) or
+                  "gaussian_numerical" (the native numerical moment calculator applied to
+                  an image from the NumPy Gaussian renderer) [default: "raw"]
+        guess -- for method "hsm", the expected centroid and size of the image
+                 (see _find_adaptive_moments) [default: None]
         
         Returns
         a dictionary of the lens properties, 
@@ -115,10 +243,9 @@ class SLRealizer(object):
         """
         estimated_params = {}
         if method == "hsm":       
-            try:
-                shape_info = galsim_img.FindAdaptiveMom(guess_sig=self.pixel_scale*10.0)
-            except:
-                #print "HSM failed"
+            import galsim
+            shape_info = self._find_adaptive_moments(galsim_img, guess=guess)
+            if shape_info is None:
                 return None
 
             # Calculate the real position from the arbitrary pixel position
@@ -134,24 +261,48 @@ class SLRealizer(object):
             estimated_params['e1'] = shape_info.observed_shape.e1
             estimated_params['e2'] = shape_info.observed_shape.e2
             estimated_params['e_final'] = shape_info.observed_shape.e
-            estimated_params['phi_final'] = shape_info.observed_shape.beta
-        elif method == "raw_numerical":
-            image_array = galsim_img.array
-            Ix, Iy = get_first_moments_from_image(image_array, self.pixel_scale)
-            Ixx, Ixy, Iyy = get_second_moments_from_image(image_array, self.pixel_scale)
-            estimated_params['apFlux'] = np.sum(image_array)
-            estimated_params['x'] = Ix
-            estimated_params['y'] = Iy
-            trace = Ixx + Iyy
-            estimated_params['e1'] = (Ixx - Iyy)/trace
-            estimated_params['e2'] = 2.0*Ixy/trace
-            estimated_params['trace'] = trace
-            estimated_params['e_final'], estimated_params['phi_final'] = e1e2_to_ephi(estimated_params['e1'], estimated_params['e2'])
+            estimated_params['phi_final'] = shape_info.observed_shape.beta/galsim.radians
+        elif method in ["raw_numerical", "gaussian_numerical"]:
+            image_array = galsim_img.array if method == "raw_numerical" else galsim_img
+            estimated_params = self._params_from_moments(*get_moments_from_images(image_array, self.pixel_scale))
         else:
-            raise ValueError("Please enter a valid method, either 'hsm' or 'raw_numerical'")
+            raise ValueError("Please enter a valid method, one of 'hsm', 'raw_numerical' or 'gaussian_numerical'")
 
         return estimated_params
     
+    def _params_from_moments(self, flux, Ix, Iy, Ixx, Ixy, Iyy):
+        """
+        Returns the dictionary of estimated parameters of the "raw_numerical" method
+        given the numerical moments of get_moments_from_images,
+        which may be scalars (one image) or arrays (a stack of images)
+        """
+        estimated_params = {}
+        estimated_params['apFlux'] = flux
+        estimated_params['x'] = Ix
+        estimated_params['y'] = Iy
+        trace = Ixx + Iyy
+        estimated_params['e1'] = (Ixx - Iyy)/trace
+        estimated_params['e2'] = 2.0*Ixy/trace
+        estimated_params['trace'] = trace
+        estimated_params['e_final'], estimated_params['phi_final'] = e1e2_to_ephi(estimated_params['e1'], estimated_params['e2'])
+        return estimated_params
+
+    def estimate_parameters_batch(self, images, method="raw_numerical"):
+        """
+        Performs the native numerical moment calculation on a stack of images in one pass
+
+        Keyword arguments:
+        images -- a NumPy array of shape (N, ny, nx)
+        method -- one of "raw_numerical" or "gaussian_numerical" [default: "raw_numerical"]
+
+        Returns
+        a list of N dictionaries of the lens properties, as from estimate_parameters
+        """
+        if method not in ["raw_numerical", "gaussian_numerical"]:
+            raise ValueError("Only the 'raw_numerical' and 'gaussian_numerical' methods can be batched")
+        batch_params = self._params_from_moments(*get_moments_from_images(images, self.pixel_scale))
+        return [dict((k, v[n]) for k, v in batch_params.items()) for n in range(len(images))]
+
     def draw_emulated_system(self, estimated_params):
         """
         Draws the emulated system, i.e. draws the aggregate system
@@ -164,13 +315,14 @@ class SLRealizer(object):
         """
         if not self.DEBUG:
             raise ValueError("Only runs in debug mode")
+        import galsim
         system = galsim.Gaussian(flux=estimated_params['apFlux'], half_light_radius=estimated_params['hlr'])\
                        .shift(float(estimated_params['x']), float(estimated_params['y']))\
                        .shear(e1=estimated_params['e1'], e2=estimated_params['e2'])
         emulatedImg = system.drawImage(nx=self.nx, ny=self.ny, scale=self.pixel_scale, method='no_pixel')
         return emulatedImg
     
-    def create_source_row(self, derived_params, objectId, obs_info):
+    def create_source_row(self, derived_params, objectId, obs_info, include_noise=True):
         '''
         Returns a dictionary of lens system's properties
         computed the image of one lens system and the observation conditions,
@@ -178,7 +330,10 @@ class SLRealizer(object):
 
         Keyword arguments:
         derived_params -- derived lens properties 
+        objectId -- ID of the lens system
         obs_info -- a row of the observation history df
+        include_noise -- whether to add the moment and flux noise (as configured).
+                         False if derived_params already include it. [default: True]
         
         Returns
         A dictionary with properties derived from HSM estimation
@@ -187,19 +342,23 @@ class SLRealizer(object):
         histID, MJD, band, PSF_FWHM, sky_mag = obs_info
         
         derived_params['apFluxErr'] = mag_to_flux(sky_mag-22.5)/5.0 # because Fb = 5 \sigma_b
-        if self.add_moment_noise:
-            derived_params['trace'] += add_noise(mean=get_second_moment_err(), 
-                                               stdev=get_second_moment_err_std(), 
-                                               measurement=derived_params['trace'])
-            derived_params['x'] += add_noise(mean=get_first_moment_err(), 
-                                           stdev=get_first_moment_err_std(), 
-                                           measurement=derived_params['x'])
-            derived_params['y'] += add_noise(mean=get_first_moment_err(), 
-                                           stdev=get_first_moment_err_std(), 
-                                           measurement=derived_params['y']) 
-        if self.add_flux_noise:
-            derived_params['apFlux'] += add_noise(mean=0.0, 
-                                                stdev=derived_params['apFluxErr']) # flux rms not skyErr
+        if self.add_moment_noise and include_noise:
+            derived_params['trace'] += add_keyed_noise(mean=get_second_moment_err(), 
+                                                       stdev=get_second_moment_err_std(), 
+                                                       seed=self.seed, object_id=objectId, visit_id=histID, quantity='trace',
+                                                       measurement=derived_params['trace'])
+            derived_params['x'] += add_keyed_noise(mean=get_first_moment_err(), 
+                                                   stdev=get_first_moment_err_std(), 
+                                                   seed=self.seed, object_id=objectId, visit_id=histID, quantity='x',
+                                                   measurement=derived_params['x'])
+            derived_params['y'] += add_keyed_noise(mean=get_first_moment_err(), 
+                                                   stdev=get_first_moment_err_std(), 
+                                                   seed=self.seed, object_id=objectId, visit_id=histID, quantity='y',
+                                                   measurement=derived_params['y']) 
+        if self.add_flux_noise and include_noise:
+            derived_params['apFlux'] += add_keyed_noise(mean=0.0, 
+                                                        stdev=derived_params['apFluxErr'], # flux rms not skyErr
+                                                        seed=self.seed, object_id=objectId, visit_id=histID, quantity='apFlux')
         derived_params['apMag'] = flux_to_mag(derived_params['apFlux'], from_unit='nMgy')
         derived_params['apMagErr'] = (2.5/np.log(10.0)) * derived_params['apFluxErr']/derived_params['apFlux']
         
@@ -212,132 +371,805 @@ class SLRealizer(object):
                'psf_fwhm': PSF_FWHM, 'objectId': objectId}
         return row
 
-    def make_source_table_rowbyrow(self, save_file, method="analytical"):
-        import time
+    def __getstate__(self):
+        # Bound super objects cannot be pickled, e.g. when shipping the realizer to worker processes
+        state = self.__dict__.copy()
+        state.pop('as_super', None)
+        # Rebuilt on first use rather than copied along with the observation history
+        state['_observation_store'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._bind_super()
+
+    def _bind_super(self):
+        """
+        Rebinds self.as_super, the bound super object through which a subclass calls the methods
+        it overrides, after unpickling or copying. Each subclass that uses as_super binds it
+        past itself, e.g. super(OM10Realizer, self), which also holds for subclasses of it.
+        """
+        pass
+
+    def get_object_ids(self):
+        ''' Returns the IDs of the systems, in catalog row order; depends on the catalog format '''
+        raise NotImplementedError
+
+    def _get_catalog_fingerprint(self):
+        ''' Returns a digest of the catalog contents (see utils/moments_cache.py); depends on the catalog format '''
+        raise NotImplementedError
+
+    def get_source_dtypes(self, observation=None):
+        """
+        Returns the dtypes of the source table columns realized by this realizer:
+        a categorical filter, int32 IDs if all object and visit IDs fit
+        and float32 measured quantities if self.use_float32 (see utils/table_io.get_source_table_dtypes)
+
+        Keyword arguments:
+        observation -- a Pandas DF of observations whose visit IDs are realized
+                       besides those of self.observation, e.g. new visits [default: None]
+        """
+        ids = [self.get_object_ids(), self.observation['obsHistID'].values]
+        if observation is not None:
+            ids.append(observation['obsHistID'].values)
+        max_ids = [np.max(i) for i in ids if len(i) > 0]
+        return get_source_table_dtypes(max_id=max(max_ids) if max_ids else None, use_float32=self.use_float32)
+
+    def match_footprints(self, field_ra, field_dec, fov_radius=1.75, system_ra=None, system_dec=None,
+                         ra_range=(0.0, 360.0), dec_range=(-90.0, 90.0)):
+        """
+        Restricts all later realizations to the (observation, system) pairs
+        in which the system lies within the field of view of the visit,
+        instead of observing every system in every visit.
+        Set self.footprint_rows and self.footprint_pairs to None to undo.
+
+        Keyword arguments:
+        field_ra, field_dec -- arrays of the pointing of each row of self.observation in degrees,
+                               e.g. the fieldRA and fieldDec columns of OpSim
+        fov_radius -- radius of the field of view in degrees [default: 1.75]
+        system_ra, system_dec -- arrays of the sky position of each system in degrees, in catalog row order.
+                                 If None, positions are drawn uniformly over the box
+                                 given by ra_range and dec_range [default: None]
+        ra_range -- (min, max) of RA in degrees of the survey area [default: (0.0, 360.0)]
+        dec_range -- (min, max) of Dec in degrees of the survey area [default: (-90.0, 90.0)]
+        """
+        object_ids = np.asarray(self.get_object_ids())
+        if len(field_ra) != self.num_obs or len(field_dec) != self.num_obs:
+            raise ValueError("field_ra and field_dec must have one entry per observation.")
+        if system_ra is None or system_dec is None:
+            system_ra, system_dec = get_uniform_sky_positions(self.seed, object_ids, ra_range=ra_range, dec_range=dec_range)
+        self.sky_positions = pd.DataFrame({'ra': np.asarray(system_ra, dtype=np.float64),
+                                           'dec': np.asarray(system_dec, dtype=np.float64)},
+                                          index=pd.Index(object_ids, name='objectId'))
+        visit_rows, system_rows = get_overlapping_pairs(system_ra, system_dec, field_ra, field_dec, fov_radius=fov_radius)
+        self.footprint_rows = (visit_rows, system_rows)
+        self.footprint_pairs = pd.DataFrame({'objectId': object_ids[system_rows],
+                                             'obsHistID': self.observation['obsHistID'].values[visit_rows]})\
+                                 .drop_duplicates()
+        print("Matched %d of %d (observation, system) pairs." %(len(visit_rows), self.num_obs*self.num_systems))
+
+    def _merge_with_observation(self, catalog, observation, id_column):
+        """
+        Returns the Pandas DF with one row per (system, observation) pair to realize:
+        all pairs, or only those matched by match_footprints
+
+        Keyword arguments:
+        catalog -- a Pandas DF of systems
+        observation -- a Pandas DF of observations
+        id_column -- name of the column of system IDs in catalog
+        """
+        if self.footprint_pairs is None:
+            catalog = catalog.copy()
+            observation = observation.copy()
+            catalog['key'] = 0
+            observation['key'] = 0
+            src = catalog.merge(observation, how='left', on='key')
+            src.drop('key', axis=1, inplace=True)
+            return src
+        pairs = self.footprint_pairs.rename(columns={'objectId': id_column})
+        src = catalog.merge(pairs, how='inner', on=id_column)
+        return src.merge(observation, how='inner', on='obsHistID')
+
+    def _get_pair_rows(self, object_ids, observation):
+        """
+        Returns the row numbers, into the systems object_ids and into observation,
+        of the (system, observation) pairs to realize: all pairs, or only those
+        matched by match_footprints. Pairs are ordered by system and then by observation,
+        as in the rows of _merge_with_observation.
+
+        Keyword arguments:
+        object_ids -- array of the IDs of the systems
+        observation -- a Pandas DF of observations
+        """
+        num_systems, num_obs = len(object_ids), len(observation)
+        if self.footprint_pairs is None:
+            return np.repeat(np.arange(num_systems), num_obs), np.tile(np.arange(num_obs), num_systems)
+        system_rows = pd.Index(object_ids).get_indexer(self.footprint_pairs['objectId'].values)
+        obs_rows = pd.Index(observation['obsHistID'].values).get_indexer(self.footprint_pairs['obsHistID'].values)
+        keep = (system_rows >= 0) & (obs_rows >= 0)
+        system_rows, obs_rows = system_rows[keep], obs_rows[keep]
+        order = np.lexsort((obs_rows, system_rows))
+        return system_rows[order], obs_rows[order]
+
+    def _get_num_work_units(self):
+        """Returns the number of (observation, system) pairs to realize"""
+        if self.footprint_rows is None:
+            return self.num_obs*self.num_systems
+        return len(self.footprint_rows[0])
+
+    def _get_work_unit(self, k):
+        """
+        Returns the observation and system row numbers of the k-th (observation, system) work unit,
+        where observations are the outer loop and systems the inner loop
+        """
+        if self.footprint_rows is None:
+            return divmod(k, self.num_systems)
+        return self.footprint_rows[0][k], self.footprint_rows[1][k]
+
+    def _create_rowbyrow_row(self, k, method):
+        """
+        Returns the source row of the k-th (observation, system) work unit
+        """
+        j, i = self._get_work_unit(k)
+        return self.create_source_row(lens_info=self.get_lens_info(rownum=i),
+                                      obs_info=self.observation_store.get_record(j),
+                                      method=method)
+
+    def _create_rowbyrow_rows(self, start, stop, method):
+        """
+        Returns the list of source rows of the work units in range(start, stop).
+        Subclasses can override this to process a block of work units at once.
+        """
+        return [self._create_rowbyrow_row(k, method) for k in range(start, stop)]
+
+    def _iter_rowbyrow_blocks(self, bounds, method, num_processes=1):
+        """
+        Yields the start index and the list of source rows of each block of work units
+        range(start, stop) in bounds, in order, realized in a pool of num_processes
+        worker processes if num_processes > 1
+        """
+        if num_processes > 1:
+            import copy
+            import multiprocessing
+            # Workers only need the inputs, not any previously generated tables
+            worker_realizer = copy.copy(self)
+            worker_realizer.source_table = None
+            worker_realizer.sourceTable = None
+            pool = multiprocessing.Pool(processes=num_processes, 
+                                        initializer=_init_rowbyrow_worker, 
+                                        initargs=(worker_realizer, method))
+            try:
+                # imap yields the blocks in submission order as they complete
+                for block_start, rows, hsm_stats, cache_stats in pool.imap(_realize_rowbyrow_block, bounds):
+                    self.hsm_stats.merge(hsm_stats)
+                    if cache_stats is not None:
+                        self.moments_cache.stats.merge(cache_stats)
+                    yield block_start, rows
+            except BaseException:
+                # Do not wait for the queued blocks if a worker or the consumer failed (or the generator was closed)
+                pool.terminate()
+                pool.join()
+                raise
+            pool.close()
+            pool.join()
+        else:
+            for block_start, block_stop in bounds:
+                yield block_start, self._create_rowbyrow_rows(block_start, block_stop, method)
+
+    def _get_checkpoint_config(self, method, **config):
+        """
+        Returns the configuration of a checkpointed run (see utils/checkpoint.py), which a resumed run must match:
+        the inputs, by the digests of their contents, and the settings that change the row values or dtypes
+        """
+        observation = self.observation
+        config.update({'method': method, 'seed': self.seed, 'num_systems': self.num_systems, 'num_obs': self.num_obs,
+                       'catalog_fingerprint': self._get_catalog_fingerprint(),
+                       'observation_fingerprint': get_catalog_fingerprint([(col, observation[col].values) 
+                                                                           for col in observation.columns]),
+                       'add_moment_noise': self.add_moment_noise, 'add_flux_noise': self.add_flux_noise,
+                       'num_pairs': self._get_num_work_units(),
+                       'drw_grid_step': float(self.drw_grid_step), 'hsm_warm_start': bool(self.hsm_warm_start),
+                       'pixel_scale': float(self.pixel_scale), 'nx': int(self.nx), 'ny': int(self.ny),
+                       'use_float32': bool(self.use_float32),
+                       'moments_cache_fwhm_bin': None if self.moments_cache is None else self.moments_cache.fwhm_bin})
+        return config
+
+    def make_source_table_rowbyrow(self, save_file, method="analytical", num_processes=1, work_unit_size=None,
+                                   checkpoint_dir=None):
         """
         Returns a source table generated from all the lens systems in the catalog
         under all the observation conditions in the observation history,
-        and saves it as a .csv file.
+        and saves it in self.table_format (inferred from the extension of save_file by default).
 
         Keyword arguments:
         save_file -- path into which output source table will be saved
         method -- how to calculate moments for each row
-                  (See method estimate_parameters for details about each option)         
+                  (See method estimate_parameters for details about each option).
+                  With self.moments_cache, the "raw_numerical" and "gaussian_numerical" methods
+                  of subclasses that support it reuse the moments of a system in the same band
+                  and PSF FWHM bin; "hsm" fits are not cached, as each is counted in self.hsm_stats.
+        num_processes -- number of worker processes. If greater than 1, blocks of 
+                         (observation, system) pairs are realized in a process pool,
+                         each worker receiving the catalog and observation history once,
+                         and the rows are collected in the same order as in a serial run. [default: 1]
+        work_unit_size -- number of (observation, system) pairs processed as one block,
+                          e.g. sent to a worker or rendered as one stack of images.
+                          If None, each worker gets about 8 blocks, and a serial run
+                          uses blocks of 256 (1024 with checkpoint_dir). [default: None]
+        checkpoint_dir -- if given, each block is committed to this directory as soon as it is done,
+                          so that the run can be resumed after an interruption by calling this method again
+                          with the same arguments (see utils/checkpoint.py). The directory is removed
+                          once the source table is saved. [default: None]
         """
-        start = time.time()
         print("Began making the source catalog.")
         
-        df = pd.DataFrame(columns=self.source_columns)
         #ellipticity_upper_limit = desc.slrealizer.get_ellipticity_cut()
         print("Number of systems: %d, number of observations: %d" %(self.num_systems, self.num_obs))
         
-        hsm_failed = 0
+        num_rows = self._get_num_work_units()
+        source_dtypes = self.get_source_dtypes()
+        if work_unit_size is None:
+            if checkpoint_dir is not None:
+                # Blocks are the units of the checkpoint, so they must not depend on num_processes
+                work_unit_size = 1024
+            elif num_processes > 1:
+                work_unit_size = max(1, int(np.ceil(num_rows/(8.0*num_processes))))
+            else:
+                work_unit_size = 256
+        bounds = get_chunk_bounds(num_rows, work_unit_size)
+        checkpoint = None
+        if checkpoint_dir is not None:
+            checkpoint = Checkpoint(checkpoint_dir, self._get_checkpoint_config('make_source_table_rowbyrow', 
+                                                                                rowbyrow_method=method,
+                                                                                work_unit_size=work_unit_size))
+            todo = [(start, stop) for start, stop in bounds if not checkpoint.is_done(start)]
+            print("Resuming from %d of %d block(s) in the checkpoint at %s." %(len(bounds) - len(todo), len(bounds), checkpoint_dir))
+        else:
+            todo = bounds
+            # One preallocated slot per (observation, system) pair, in row order
+            buf = ColumnBuffer(columns=self.source_columns, num_rows=num_rows, dtypes=source_dtypes)
         
-        for j in xrange(self.num_obs):
-            for i in xrange(self.num_systems):
-                row = self.create_source_row(lens_info=self.get_lens_info(rownum=i),
-                                             obs_info=self.observation.loc[j],
-                                             method=method)
-                if row == None:
-                    hsm_failed += 1
-                else:
-                    df = df.append(row, ignore_index=True)
+        self.hsm_stats.reset()
+        if self.moments_cache is not None:
+            self.moments_cache.stats.reset()
+            if method in ['raw_numerical', 'gaussian_numerical']:
+                # Entries measured on another catalog, e.g. in an earlier run, are removed
+                self.moments_cache.bind(self._get_catalog_fingerprint())
+        with self.instrumentation.stage('moments', rows=sum(stop - start for start, stop in todo), 
+                                        method=method, num_processes=num_processes) as stage:
+            for block_start, rows in self._iter_rowbyrow_blocks(todo, method, num_processes):
+                if checkpoint is None:
+                    for offset, row in enumerate(rows):
+                        buf.set_row(block_start + offset, row)
+                    continue
+                block_buf = ColumnBuffer(columns=self.source_columns, num_rows=len(rows), dtypes=source_dtypes)
+                for offset, row in enumerate(rows):
+                    block_buf.set_row(offset, row)
+                checkpoint.commit(block_start, {'source': block_buf.to_dataframe()},
+                                  info={'failed': np.where(~block_buf.is_filled)[0].tolist()})
+            if method == 'hsm':
+                stage.context.update(self.hsm_stats.as_dict())
+            if self.moments_cache is not None and method in ['raw_numerical', 'gaussian_numerical']:
+                stage.context.update(self.moments_cache.stats.as_dict())
         
-        df = df.infer_objects()
-        df = df[self.source_columns]
+        if checkpoint is None:
+            is_filled = buf.is_filled
+            df = buf.to_dataframe()
+            del buf
+        else:
+            # Assemble the table from the blocks, in row order
+            is_filled = np.ones(num_rows, dtype=bool)
+            for start, stop in bounds:
+                is_filled[start + np.array(checkpoint.get_info(start)['failed'], dtype=np.int64)] = False
+            df = pd.concat([checkpoint.read(start, 'source') for start, stop in bounds], ignore_index=True)
+        # Mask of shape [num_obs, num_systems] that is True where the row could not be computed
+        if self.footprint_rows is None:
+            self.rowbyrow_failed = ~is_filled.reshape(self.num_obs, self.num_systems)
+        else:
+            self.rowbyrow_failed = np.zeros((self.num_obs, self.num_systems), dtype=bool)
+            self.rowbyrow_failed[self.footprint_rows] = ~is_filled
         df.set_index('objectId', inplace=True)
-        df.to_csv(save_file, index=True)
+        with self.instrumentation.stage('write', rows=len(df), method='make_source_table_rowbyrow'):
+            write_table(df, save_file, table_format=self.table_format, index=True, compression=self.table_compression,
+                        dtype=source_dtypes)
+        if checkpoint is not None:
+            checkpoint.remove()
         
-        end = time.time()
         if method == 'hsm':
-            print("Done making the source table which has %d row(s) in %0.2f hours, after getting %d errors from HSM failure." %(len(df), (end - start)/3600.0, hsm_failed))
+            print("Done making the source table which has %d row(s), after getting %d errors from HSM failure." %(len(df), np.count_nonzero(self.rowbyrow_failed)))
+            stats = self.hsm_stats.as_dict()
+            if stats['num_fits'] > 0:
+                print("HSM made %d fit(s) in %0.2f iteration(s) each, with %d retry(ies) and a failure rate of %0.4f." 
+                      %(stats['num_fits'], stats['iterations_per_fit'], stats['num_retries'], stats['failure_rate']))
         else:
-            print("Done making the source table with %s method in %0.2f minutes." %(method, (end - start)/60.0))
+            print("Done making the source table with %s method." %method)
+            if self.moments_cache is not None and method in ['raw_numerical', 'gaussian_numerical']:
+                stats = self.moments_cache.stats.as_dict()
+                if stats['hit_rate'] is not None:
+                    print("The moments cache served %d hit(s) and %d miss(es), a hit rate of %0.4f; "
+                          "the PSF FWHM quantization changed the trace by at most %0.3g (relative %0.3g)." 
+                          %(stats['num_hits'], stats['num_misses'], stats['hit_rate'], 
+                            stats['max_trace_error'], stats['max_relative_trace_error']))
 #        desc.slrealizer.dropbox_upload(dir, 'source_catalog_new.csv')
 
         self.sourceTable = df
         if self.DEBUG:
             return df
 
-    def make_object_table(self, object_table_path, source_table_path=None, include_std=False):
+    def _get_catalog_table(self):
+        ''' Returns the catalog as a Pandas DF with one row per system; depends on the catalog format '''
+        raise NotImplementedError
+
+    def _realize_tile(self, catalog=None, observation=None, include_time_variability=False, drw_state=None):
+        ''' Realizes the source table rows of one (catalog block, observation block) tile; depends on the catalog format '''
+        raise NotImplementedError
+
+    def make_source_table_chunked(self, output_source_path, include_time_variability=False,
+                                  lens_chunk_size=1000, obs_chunk_size=1000, checkpoint_dir=None):
+        """
+        Generates the same source table as make_source_table_vectorized
+        without ever holding the full catalog x observation cross join in memory.
+        The work is split into tiles of (block of lens_chunk_size systems) x
+        (block of obs_chunk_size observations), each of which is realized
+        by _realize_tile and appended to output_source_path,
+        so that peak memory is set by lens_chunk_size*obs_chunk_size rows.
+
+        Rows come out tile by tile, so they are in the same order as
+        make_source_table_vectorized's only if obs_chunk_size >= self.num_obs.
+        Row values are identical, noise included, as the noise is keyed by
+        (seed, objectId, ccdVisitId) rather than drawn in row order.
+
+        Keyword arguments:
+        output_source_path -- save path for the output source table
+        include_time_variability -- whether to include intrinsic quasar variability.
+                                    Variability needs each system's full light curve,
+                                    so obs_chunk_size is then ignored and each tile
+                                    spans all observations. [default: False]
+        lens_chunk_size -- number of systems per tile [default: 1000]
+        obs_chunk_size -- number of observations per tile [default: 1000]
+        checkpoint_dir -- if given, each tile is committed to this directory as soon as it is realized,
+                          so that the run can be resumed after an interruption by calling this method again
+                          with the same arguments (see utils/checkpoint.py). The tiles are written to
+                          output_source_path at the end, after which the directory is removed.
+                          With lens_chunk_size=None and obs_chunk_size=None, this checkpoints
+                          make_source_table_vectorized. [default: None]
+
+        Returns (only if self.DEBUG == True):
+        a Pandas dataframe of the source table
+        """
+        import gc
+        
+        if include_time_variability:
+            obs_chunk_size = None
+        catalog = self._get_catalog_table()
+        lens_bounds = get_chunk_bounds(len(catalog), lens_chunk_size)
+        obs_bounds = get_chunk_bounds(self.num_obs, obs_chunk_size)
+        units = [(lens_bound, obs_bound) for lens_bound in lens_bounds for obs_bound in obs_bounds]
+        print("Realizing the source table in %d tile(s)." %len(units))
+        checkpoint = None
+        if checkpoint_dir is not None:
+            checkpoint = Checkpoint(checkpoint_dir, self._get_checkpoint_config('make_source_table_chunked',
+                                                                                include_time_variability=include_time_variability,
+                                                                                variability_model=self.variability_model,
+                                                                                lens_chunk_size=lens_chunk_size,
+                                                                                obs_chunk_size=obs_chunk_size))
+            print("Resuming from %d of %d tile(s) in the checkpoint at %s." 
+                  %(sum(checkpoint.is_done((l[0], o[0])) for l, o in units), len(units), checkpoint_dir))
+        else:
+            writer = open_table_writer(output_source_path, table_format=self.table_format, compression=self.table_compression,
+                                       dtype=self.get_source_dtypes())
+        
+        debug_tiles = []
+        drw_states = []
+        for (lens_start, lens_stop), (obs_start, obs_stop) in units:
+            if checkpoint is not None and checkpoint.is_done((lens_start, obs_start)):
+                continue
+            catalog_block = catalog.iloc[lens_start:lens_stop]
+            observation_block = self.observation.iloc[obs_start:obs_stop]
+            tile = self._realize_tile(catalog=catalog_block, 
+                                      observation=observation_block, 
+                                      include_time_variability=include_time_variability)
+            tile.set_index('objectId', inplace=True)
+            if checkpoint is not None:
+                tables = {'source': tile} if len(tile) > 0 else {}
+                if include_time_variability:
+                    tables['drw_state'] = self.drw_state
+                checkpoint.commit((lens_start, obs_start), tables)
+                continue
+            if include_time_variability:
+                drw_states.append(self.drw_state)
+            if len(tile) == 0:
+                # No system of the tile falls within the footprint of its visits
+                continue
+            with self.instrumentation.stage('write', rows=len(tile), method='make_source_table_chunked'):
+                writer.write(tile)
+            if self.DEBUG:
+                debug_tiles.append(tile)
+            self.source_table = None
+            del tile
+            gc.collect()
+        if checkpoint is not None:
+            # Copy the committed tiles into the source table, in tile order
+            writer = open_table_writer(output_source_path, table_format=self.table_format, compression=self.table_compression,
+                                       dtype=self.get_source_dtypes())
+            for (lens_start, lens_stop), (obs_start, obs_stop) in units:
+                if include_time_variability:
+                    drw_states.append(checkpoint.read((lens_start, obs_start), 'drw_state'))
+                tile = checkpoint.read((lens_start, obs_start), 'source')
+                if tile is None:
+                    continue
+                with self.instrumentation.stage('write', rows=len(tile), method='make_source_table_chunked'):
+                    writer.write(tile)
+                if self.DEBUG:
+                    debug_tiles.append(tile)
+                del tile
+        writer.close()
+        if checkpoint is not None:
+            checkpoint.remove()
+        if drw_states:
+            self.drw_state = pd.concat(drw_states, ignore_index=True)
+        
+        print("Done making the source table with %d row(s) using chunked vectorization." %writer.num_rows)
+        # The full table is never in memory, so later stages read it from disk
+        self.sourceTable = None
+        if self.DEBUG:
+            src = pd.concat(debug_tiles)
+            self.sourceTable = src
+            return src
+
+    def _get_object_properties(self):
+        ''' Returns the (filter-nonspecific) properties of the source table that go in the object table columns '''
+        return [c for c in self.source_columns if c not in ['MJD', 'ccdVisitId', 'objectId', 'filter', 'psf_fwhm']]
+
+    def _prepare_ensemble(self, noiseless=None):
+        ''' Returns the state shared by the realizations of an ensemble; depends on the catalog format '''
+        raise NotImplementedError
+
+    def _realize_ensemble_member(self, state, include_time_variability=False):
+        ''' Realizes the source table of one member of an ensemble from the shared state; depends on the catalog format '''
+        raise NotImplementedError
+
+    def make_source_table_ensemble(self, num_realizations, output_source_path, output_object_path=None, seeds=None,
+                                   include_time_variability=False, include_std=False, noiseless_table_path=None):
+        """
+        Generates an ensemble of num_realizations source tables, the k-th of which is
+        the source table of make_source_table_vectorized with self.seed = seeds[k].
+        The deterministic part of the realization (merging the catalog with the observation
+        history, the magnitudes and the noise-free moments) is computed once and shared,
+        and each realization only draws its noise and, optionally, its quasar variability.
+        Realizations are written one at a time, so only one is in memory at any time.
+
+        Keyword arguments:
+        num_realizations -- number of realizations in the ensemble
+        output_source_path -- save path of the source tables, with a %-format field
+                              for the realization index, e.g. 'source_%03d.csv'
+        output_object_path -- save path of the object tables, formatted like output_source_path.
+                              If None, no object tables are made [default: None]
+        seeds -- list of num_realizations seeds. If None, self.seed + k is used for the k-th realization [default: None]
+        include_time_variability -- whether to include intrinsic quasar variability,
+                                    drawn independently for each realization [default: False]
+        include_std -- whether to include the standard deviations in the object tables [default: False]
+        noiseless_table_path -- path of the table of the deterministic part of the realization.
+                                If it exists, the table is read from it rather than computed;
+                                otherwise, the computed table is saved there. If None,
+                                the table is only kept in memory [default: None]
+
+        Returns (only if self.DEBUG == True):
+        the list of the Pandas dataframes of the source tables
+        """
+        import os
+        import copy
+        import gc
+
+        if seeds is None:
+            seeds = [self.seed + k for k in range(num_realizations)]
+        if len(seeds) != num_realizations:
+            raise ValueError("Must provide one seed per realization, got %d seed(s) for %d realization(s)." %(len(seeds), num_realizations))
+
+        noiseless = None
+        if noiseless_table_path is not None and os.path.exists(noiseless_table_path):
+            print("Reading in the noise-free table at %s ..." %noiseless_table_path)
+            noiseless = read_table(noiseless_table_path, table_format=self.table_format, dtype={})
+        state = self._prepare_ensemble(noiseless=noiseless)
+        if noiseless is None and noiseless_table_path is not None:
+            with self.instrumentation.stage('write', rows=len(state['noiseless']), method='make_source_table_ensemble'):
+                write_table(state['noiseless'], noiseless_table_path, table_format=self.table_format,
+                            index=False, compression=self.table_compression, dtype={})
+
+        source_dtypes = self.get_source_dtypes()
+        properties = self._get_object_properties()
+        debug_tables = []
+        for k, seed in enumerate(seeds):
+            member = copy.copy(self)
+            member.seed = seed
+            src = member._realize_ensemble_member(state, include_time_variability=include_time_variability)
+            src.set_index('objectId', inplace=True)
+            with self.instrumentation.stage('write', rows=len(src), method='make_source_table_ensemble', realization=k):
+                write_table(src, output_source_path %k, table_format=self.table_format,
+                            compression=self.table_compression, dtype=source_dtypes)
+            if output_object_path is not None:
+                aggregator = ObjectAggregator(properties)
+                with self.instrumentation.stage('aggregate', rows=len(src), method='make_source_table_ensemble', realization=k):
+                    aggregator.update(src.reset_index())
+                    obj = aggregator.to_object_table(include_std=include_std, reference_band='r')
+                with self.instrumentation.stage('write', rows=len(obj), method='make_source_table_ensemble', realization=k):
+                    write_table(obj, output_object_path %k, table_format=self.table_format, index=False,
+                                compression=self.table_compression,
+                                dtype=get_object_table_dtypes(obj.columns, use_float32=self.use_float32))
+            if self.DEBUG:
+                debug_tables.append(src)
+            del src
+            gc.collect()
+        if include_time_variability:
+            # Of the last realization, as after make_source_table_vectorized
+            self.drw_state = member.drw_state
+
+        print("Done making an ensemble of %d source table(s)." %num_realizations)
+        self.sourceTable = None
+        if self.DEBUG:
+            return debug_tables
+
+    def iter_object_batches(self, batch_size, num_visits_per_band=10, num_batches=None, seed=None,
+                            include_time_variability=False, include_std=False):
+        """
+        Yields mini-batches of object table rows, each realized on the fly from a random subset
+        of batch_size systems of the catalog observed in a random subset of the visits,
+        e.g. to stream fresh realizations into the training of a classifier
+        without writing any table. Each batch is realized with its own noise seed and
+        goes through the vectorized path, so memory is bounded by the size of one batch.
+
+        Keyword arguments:
+        batch_size -- number of systems realized per batch. Systems missing a value
+                      in any band are dropped from the object table, so batches can be smaller.
+        num_visits_per_band -- number of visits drawn in each band of the observation history,
+                               so that every batch has the same feature columns [default: 10]
+        num_batches -- number of batches. If None, batches are yielded forever [default: None]
+        seed -- seed of the draws of the systems, the visits and the noise of each batch.
+                If None, self.seed is used [default: None]
+        include_time_variability -- whether to include intrinsic quasar variability [default: False]
+        include_std -- whether to include the standard deviations across the visits [default: False]
+
+        Yields:
+        a Pandas DF of object table rows indexed by objectId, in random order
+        """
+        import copy
+        
+        rng = np.random.RandomState(self.seed if seed is None else seed)
+        catalog = self._get_catalog_table()
+        properties = self._get_object_properties()
+        filters = np.asarray(self.observation['filter'].values, dtype=object)
+        band_rows = [np.where(filters == b)[0] for b in sorted(set(filters))]
+        batch = 0
+        while num_batches is None or batch < num_batches:
+            rows = np.sort(rng.choice(len(catalog), size=min(batch_size, len(catalog)), replace=False))
+            # Visits in observation order, as the light curves of the variability need them sorted in time
+            obs_rows = np.sort(np.concatenate([rng.choice(b_rows, size=min(num_visits_per_band, len(b_rows)), replace=False)
+                                               for b_rows in band_rows]))
+            member = copy.copy(self)
+            member.seed = rng.randint(2**31 - 1)
+            src = member._realize_tile(catalog=catalog.iloc[rows], observation=self.observation.iloc[obs_rows],
+                                       include_time_variability=include_time_variability)
+            aggregator = ObjectAggregator(properties)
+            with self.instrumentation.stage('aggregate', rows=len(src), method='iter_object_batches'):
+                aggregator.update(src)
+                obj = aggregator.to_object_table(include_std=include_std, reference_band='r')
+            del src
+            yield obj.iloc[rng.permutation(len(obj))]
+            batch += 1
+
+    def make_source_table_shard(self, shard_index, num_shards, output_source_path, aggregate_state_path,
+                                include_time_variability=False, shard_by='hash'):
+        """
+        Realizes the source table rows of one shard of the catalog, for runs split over
+        independent processes or hosts, and saves them with the per-object running statistics
+        of the shard, from which merge_object_table_shards makes the object table.
+        Systems are assigned to shards by their IDs (see utils/shard.py) and their rows
+        are the same as in make_source_table_vectorized, so the union of the shards
+        does not depend on num_shards.
+
+        Keyword arguments:
+        shard_index -- index of the shard to realize, in [0, num_shards)
+        num_shards -- number of shards
+        output_source_path -- save path of the source table of the whole run; the shard is saved
+                              at get_shard_path(output_source_path, shard_index, num_shards)
+        aggregate_state_path -- save path of the running statistics of the run,
+                                formatted like output_source_path
+        include_time_variability -- whether to include intrinsic quasar variability [default: False]
+        shard_by -- how to assign systems to shards, 'hash' or 'range' (see utils/shard.get_shard_indices) [default: 'hash']
+
+        Returns:
+        the paths of the source table and of the running statistics of the shard
+        """
+        shard_source_path = get_shard_path(output_source_path, shard_index, num_shards)
+        shard_state_path = get_shard_path(aggregate_state_path, shard_index, num_shards)
+        catalog = self._get_catalog_table()
+        rows = np.where(get_shard_indices(self.get_object_ids(), num_shards, method=shard_by) == shard_index)[0]
+        print("Realizing shard %d of %d with %d system(s)." %(shard_index, num_shards, len(rows)))
+        if len(rows) > 0:
+            src = self._realize_tile(catalog=catalog.iloc[rows], include_time_variability=include_time_variability)
+        else:
+            src = pd.DataFrame(dict((col, []) for col in self.source_columns), columns=self.source_columns)
+        src.set_index('objectId', inplace=True)
+        with self.instrumentation.stage('write', rows=len(src), method='make_source_table_shard'):
+            write_table(src, shard_source_path, table_format=self.table_format, compression=self.table_compression,
+                        dtype=self.get_source_dtypes())
+        aggregator = ObjectAggregator(self._get_object_properties())
+        with self.instrumentation.stage('aggregate', rows=len(src), method='make_source_table_shard'):
+            aggregator.update(src)
+        with self.instrumentation.stage('write', method='make_source_table_shard'):
+            aggregator.save(shard_state_path, table_format=self.table_format)
+        print("Done making shard %d of %d of the source table with %d row(s)." %(shard_index, num_shards, len(src)))
+        return shard_source_path, shard_state_path
+
+    def make_object_table(self, object_table_path, source_table_path=None, include_std=False, chunk_size=1000000,
+                          aggregate_state_path=None):
 
         """
         Generates the object table from the given source table at source_table_path
         by averaging the properties for each filter, and saves it as object_table_path.
+        The source table is read in chunks of chunk_size rows and aggregated in a single pass,
+        so that memory scales with the number of objects rather than the number of rows.
+        If aggregate_state_path is given, the per-object running statistics are saved there,
+        so that append_visits can later update the object table with new visits.
         """
-        import time
         import gc
         
         if object_table_path is None:
             raise ValueError("Must provide save path of the output object table.")
         
-        if source_table_path is not None:
-            print("Reading in the source table at %s ..." %source_table_path)
-            obj = pd.read_csv(source_table_path)
-            obj.set_index('objectId', inplace=True)
-        elif self.sourceTable is not None:            
-            print("Reading in Pandas Dataframe of most recent source table generated... ")
-            obj = self.sourceTable.copy()
-        else:
+        properties = self._get_object_properties()
+        aggregator = ObjectAggregator(properties)
+        if source_table_path is None and self.sourceTable is None:
             raise ValueError("Must provide a source table path or generate a source table at least once using this Realizer object.")
+        with self.instrumentation.stage('aggregate', method='make_object_table') as stage:
+            stage.rows = 0
+            if source_table_path is not None:
+                print("Reading in the source table at %s ..." %source_table_path)
+                # Only read the columns that go into the object table
+                for chunk in iter_table(source_table_path, chunk_size, table_format=self.table_format,
+                                        columns=['objectId', 'filter'] + properties):
+                    aggregator.update(chunk)
+                    stage.rows += len(chunk)
+                    del chunk
+                    gc.collect()
+            else:
+                print("Reading in Pandas Dataframe of most recent source table generated... ")
+                aggregator.update(self.sourceTable)
+                stage.rows = len(self.sourceTable)
 
-        start = time.time()
+            # Take mean, optional std of properties across observed times for each object,
+            # drop examples with missing values and get x, y values relative to the r-band
+            obj = aggregator.to_object_table(include_std=include_std, reference_band='r')
         
-        obj.drop(['ccdVisitId', 'psf_fwhm'], axis=1, inplace=True)
-        # Define (filter-nonspecific) properties to go in object table columns
-        keepCols = list(obj.columns.values)
-        keepCols.remove('filter')
-        # Pivot the filter values to the column axis
-        obj = obj.pivot_table(values=keepCols, index=[obj.index, 'MJD'], columns='filter', aggfunc='first')
-        # Collapse multi-indexed column using filter_property formatting
-        obj.columns = obj.columns.map('{0[1]}_{0[0]}'.format)
-        gc.collect()
+        # Save to file
+        with self.instrumentation.stage('write', rows=len(obj), method='make_object_table'):
+            write_table(obj, object_table_path, table_format=self.table_format, index=False, compression=self.table_compression,
+                        dtype=get_object_table_dtypes(obj.columns, use_float32=self.use_float32))
+            if aggregate_state_path is not None:
+                aggregator.save(aggregate_state_path, table_format=self.table_format)
+        print("Done making the object table with %d object(s)." %len(obj))
+        #if self.DEBUG:
+            #print("Object table columns: ", obj.columns)
+
+    def merge_object_table_shards(self, num_shards, object_table_path, aggregate_state_path, include_std=False,
+                                  merged_state_path=None):
+        """
+        Makes the object table of a sharded run (see make_source_table_shard)
+        by merging the running statistics of its shards, without reading the source tables.
+        As each object is in one shard, the object table is the same as the one
+        make_object_table makes from the source table of an unsharded run.
+
+        Keyword arguments:
+        num_shards -- number of shards of the run
+        object_table_path -- save path of the object table
+        aggregate_state_path -- save path of the running statistics given to make_source_table_shard
+        include_std -- whether to include the standard deviations [default: False]
+        merged_state_path -- if given, the merged running statistics are saved there,
+                             e.g. for append_visits [default: None]
+        """
+        aggregator = ObjectAggregator(self._get_object_properties())
+        with self.instrumentation.stage('aggregate', method='merge_object_table_shards', num_shards=num_shards):
+            for shard_index in range(num_shards):
+                aggregator.merge(ObjectAggregator.load(get_shard_path(aggregate_state_path, shard_index, num_shards),
+                                                       table_format=self.table_format))
+            obj = aggregator.to_object_table(include_std=include_std, reference_band='r')
+        with self.instrumentation.stage('write', rows=len(obj), method='merge_object_table_shards'):
+            write_table(obj, object_table_path, table_format=self.table_format, index=False, compression=self.table_compression,
+                        dtype=get_object_table_dtypes(obj.columns, use_float32=self.use_float32))
+            if merged_state_path is not None:
+                aggregator.save(merged_state_path, table_format=self.table_format)
+        print("Done merging %d shard(s) into the object table with %d object(s)." %(num_shards, len(obj)))
+
+    def save_drw_state(self, drw_state_path):
+        """
+        Saves the value of each quasar light curve at its last epoch (self.drw_state),
+        so that append_visits can continue the light curves with new visits
+        """
+        if self.drw_state is None:
+            raise ValueError("No time variability has been simulated with this Realizer object.")
+        write_table(self.drw_state, drw_state_path, table_format=self.table_format, index=False)
+
+    def append_visits(self, new_observation, source_table_path, object_table_path, aggregate_state_path,
+                      include_time_variability=False, drw_state_path=None, include_std=False):
+        """
+        Extends an existing source table and object table with new visits,
+        realizing only the rows of the new visits instead of the whole survey again.
+        The object table is rebuilt from the per-object running statistics
+        saved by make_object_table(aggregate_state_path=...), which are updated in place.
+        With footprint matching, only the pairs matched by match_footprints are realized,
+        so it should have been run over an observation history that includes the new visits.
+
+        Keyword arguments:
+        new_observation -- a Pandas DF of the new observations, with the columns of self.observation
+        source_table_path -- path of the existing source table, to which the new rows are appended
+        object_table_path -- save path of the updated object table
+        aggregate_state_path -- path of the per-object running statistics
+        include_time_variability -- whether to include intrinsic quasar variability [default: False]
+        drw_state_path -- path of the quasar light curve state saved by save_drw_state.
+                          If given, the light curves continue from their last epoch
+                          and the state is updated in place. [default: None]
+        include_std -- whether to include the std columns in the object table [default: False]
+
+        Returns (only if self.DEBUG == True):
+        a Pandas dataframe of the new source table rows
+        """
+        import os
         
-        #if self.DEBUG: print(obj.columns.values)
+        if not os.path.exists(aggregate_state_path):
+            raise ValueError("No aggregate state at %s. Run make_object_table with aggregate_state_path first." %aggregate_state_path)
+        drw_state = None
+        if include_time_variability and drw_state_path is not None:
+            drw_state = read_table(drw_state_path, table_format=self.table_format)
         
-        # Take mean, optional std of properties across observed times for each object
-        obj.reset_index(inplace=True)
-        obj.drop('MJD', axis=1, inplace=True)
-        obj = obj.groupby('objectId', sort=False)
-        means = obj.mean()
-        if include_std:
-            stds = obj.std()
-            obj = means.join(stds, lsuffix='', rsuffix='-std')
-        else:
-            obj = means
-        gc.collect()
+        src = self._realize_tile(observation=new_observation, 
+                                 include_time_variability=include_time_variability,
+                                 drw_state=drw_state)
+        self.source_table = None
+        src.set_index('objectId', inplace=True)
+        with self.instrumentation.stage('write', rows=len(src), method='append_visits'):
+            append_table(src, source_table_path, table_format=self.table_format, compression=self.table_compression,
+                         dtype=self.get_source_dtypes(new_observation))
         
-        # Drop examples with missing values
-        obj.dropna(how='any', inplace=True)
-        # Get x, y values relative to the r-band
-        for b in 'ugriz':
-            obj[b + '_' + 'x'] = obj[b + '_' + 'x'] - obj['r_x']
-            obj[b + '_' + 'y'] = obj[b + '_' + 'y'] - obj['r_y']
-        end = time.time()
-        
-        # Save as csv file
-        obj.to_csv(object_table_path, index=False)
-        print("Done making the object table in %0.2f seconds." %(end-start))
-        #if self.DEBUG:
-            #print("Object table columns: ", obj.columns)
+        if include_time_variability and drw_state_path is not None:
+            # Light curves that have no new visits keep their old state
+            self.drw_state = pd.concat([drw_state, self.drw_state], ignore_index=True)\
+                               .drop_duplicates(['objectId', 'filter'], keep='last')
+            self.save_drw_state(drw_state_path)
+        
+        with self.instrumentation.stage('aggregate', rows=len(src), method='append_visits'):
+            aggregator = ObjectAggregator.load(aggregate_state_path, table_format=self.table_format)
+            aggregator.update(src)
+            obj = aggregator.to_object_table(include_std=include_std, reference_band='r')
+        with self.instrumentation.stage('write', rows=len(obj), method='append_visits'):
+            aggregator.save(aggregate_state_path, table_format=self.table_format)
+            write_table(obj, object_table_path, table_format=self.table_format, index=False, compression=self.table_compression,
+                        dtype=get_object_table_dtypes(obj.columns, use_float32=self.use_float32))
+        
+        print("Done appending %d source row(s) of %d new visit(s)." %(len(src), len(new_observation)))
+        if self.DEBUG:
+            return src
 
         #desc.slrealizer.dropbox_upload(save_dir, 'object_catalog_new.csv') #this uploads to the desc account
     
-    def include_quasar_variability(self, save_output=False, input_source_path=None, output_source_path=None):
+    def include_quasar_variability(self, save_output=False, input_source_path=None, output_source_path=None, drw_state=None):
         """
         Takes a source table and adds the intrinsic variability of the quasar images
-        using the generative model introduced in MacLeod et al (2010)
+        using the generative model introduced in MacLeod et al (2010).
+        The value of each walk at its last epoch is kept in self.drw_state.
         
         Keyword arguments:
         save_output -- whether to save the output to disk [default: False]
         input_source_path -- path of input source table to be altered [default: None]
         output_source_path -- path of output source table containing time variability [default: None]
+        drw_state -- a Pandas DF of the walks at their last epoch, as in self.drw_state,
+                     with the columns objectId, filter, MJD and q_mag_0, ..., q_mag_3
+                     (intrinsic_mag for the 'time_delay' variability model).
+                     Light curves found in drw_state continue from it
+                     instead of starting afresh. [default: None]
         """
         
         import gc
-        import time
         
-        start = time.time()
         if input_source_path is None:
             try:
                 print("Reading in the most recent source table...")
@@ -347,7 +1179,7 @@ class SLRealizer(object):
         else:
             try:
                 print("Reading in the source table at %s" %input_source_path)
-                src = pd.read_csv(input_source_path)
+                src = read_table(input_source_path, table_format=self.table_format)
             except ValueError:
                 print("Please input a valid path to the source table.")
             
@@ -356,69 +1188,11 @@ class SLRealizer(object):
             NUM_OBJECTS = src['objectId'].nunique()
             print(NUM_TIMES, NUM_OBJECTS)
         
-        for q in range(4):
-            magnitude_type = 'q_mag_' + str(q)
-            # Filter-specific dictionary of apMag values to replace src apMag
-            apMag_filter = {}
-            for b in 'ugriz':
-                #########################
-                # Adding useful columns #
-                #########################
-                # Filter-specific version of src with only the columns we need
-                src_timevar = src.query('filter == @b')[['filter', 'objectId', 'MJD', magnitude_type, ]].copy()
-                # Total number of time steps in this filter
-                NUM_TIMES_FILTER = src_timevar['MJD'].nunique()
-                # Set MJD relative to zero
-                src_timevar['MJD_diff'] = src_timevar['MJD'] - np.min(src_timevar['MJD'].values)
-                # Map ccdVisitId to integers starting from 0
-                sorted_obs_id = np.sort(src_timevar['MJD'].unique())
-                time_map = dict(zip(sorted_obs_id, range(NUM_TIMES_FILTER)))
-                src_timevar['time_index'] = src_timevar['MJD'].map(time_map).astype(int)
-                # Add a column of time elapsed since last observation, d_time
-                src_timevar.sort_values(['objectId', 'filter', 'MJD', 'MJD_diff'], axis=0, inplace=True)
-                src_timevar['d_time'] = src_timevar['MJD_diff'] - src_timevar['MJD_diff'].shift(+1)
-                src_timevar['d_time'].fillna(0.0, inplace=True)
-                src_timevar['d_time'] = np.clip(src_timevar['d_time'], a_min=0.0, a_max=None)
-                gc.collect()
-
-                ##############################
-                # Computing time variability #
-                ##############################
-                # Parameters of the generative model (hand-picked)
-                MU = 0.0
-                TAU = 20.0 #np.power(10.0, 2.4) # days
-                S_INF = 0.14 # mag
-                # Add a column to store the variability and initialize to zero
-                src_timevar['intrinsic_mag'] = 0.0
-                # Pivot to get time sequence to be horizontal
-                src_timepivot = src_timevar.pivot_table(index=['filter', 'objectId'], 
-                                                        columns=['time_index',], 
-                                                        values=['d_time', magnitude_type, 'intrinsic_mag', ])
-                # Update 'intrinsic_mag' column
-                for t in range(1, NUM_TIMES_FILTER):
-                    src_timepivot.loc[b, :]['intrinsic_mag'][t] = np.random.normal(loc=src_timepivot['intrinsic_mag'][t - 1].values*np.exp(-src_timepivot['d_time'][t].values/TAU) + MU*(1.0 - np.exp(-src_timepivot['d_time'][t].values/TAU)),
-                                                                                   scale=0.5*S_INF**2.0*(1.0 - np.exp(-2.0*src_timepivot['d_time'][t].values/TAU)))
-
-                ########################
-                # Final column sorting #
-                ########################
-                # Add computed variability to magnitude_type column
-                src_timepivot[magnitude_type] = src_timepivot[magnitude_type] + src_timepivot['intrinsic_mag']    
-                # Pivot the time sequence back, to be vertical
-                src_timepivot = src_timepivot.stack(dropna=False)
-                # Drop columns we'll no longer use
-                src_timepivot.drop(['intrinsic_mag', 'd_time'], axis=1, inplace=True)
-                # As precaution, sort before storing updated apMag
-                src_timepivot.reset_index(inplace=True)
-                src_timepivot.sort_values(by=['filter', 'objectId', 'time_index'], inplace=True)
-                # Store filter-specific apMag values 
-                apMag_filter[b] = src_timepivot[magnitude_type].values
-                gc.collect()
-
-            # Update apMag in source table, filter by filter
-            for b in 'ugriz':
-                src.loc[src['filter']==b, magnitude_type] = apMag_filter[b]
-            
+        ##############################
+        # Computing time variability #
+        ##############################
+        # Parameters of the generative model (hand-picked)
+        self.drw_state = self._add_quasar_variability(src, drw_state)
         gc.collect()
         if self.DEBUG:
             print("Result of adding time variability: ")
@@ -426,117 +1200,127 @@ class SLRealizer(object):
             print("Number of objects: ", src['objectId'].nunique())
         
         src.set_index('objectId', inplace=True)
-        end = time.time()
         
-        print("Done adding time variability with %d row(s) in %0.2f seconds using vectorization." %(len(src), end-start))
+        print("Done adding time variability with %d row(s) using the segmented DRW solver." %len(src))
         if save_output:
             print("Saving the new source table with time variability at %s" %output_source_path)
-            src.to_csv(output_source_path)
+            with self.instrumentation.stage('write', rows=len(src), method='include_quasar_variability'):
+                write_table(src, output_source_path, table_format=self.table_format, compression=self.table_compression,
+                            dtype=self.get_source_dtypes())
             
         self.source_table = src
     
-    def _include_moments(self, inplace=True, input_dict=None):
+    def _add_quasar_variability(self, src, drw_state=None):
+        """
+        Adds the intrinsic variability of self.variability_model to the columns q_mag_0, ..., q_mag_3 of src
+        and returns the state of the light curves at their last epoch (see include_quasar_variability)
         """
-        Adds columns of first and second moments (analytically computed)
-        to self.source_table (if inplace=True) or some other dictionary
+        MU = 0.0
+        TAU = 20.0 #np.power(10.0, 2.4) # days
+        S_INF = 0.14 # mag
+        if self.variability_model == 'independent':
+            add_variability = self._add_independent_variability
+        elif self.variability_model == 'time_delay':
+            add_variability = self._add_delayed_variability
+        else:
+            raise ValueError("Unknown variability model '%s'. Choose 'independent' or 'time_delay'." %self.variability_model)
+        with self.instrumentation.stage('variability', rows=len(src), model=self.variability_model):
+            return add_variability(src, drw_state, tau=TAU, sf_inf=S_INF, mu=MU)
 
-        Keyword arguments:
-        inplace -- whether to alter the self.source_table. 
-                   If input_dict is None, will be assumed to be True. [default: True]
-        input_dict -- object of type dict that will be used to compute the moments.
-                      If inplace is True, will be ignored. [default: None]
-
-        Returns (only if inplace is False):
-        a new dictionary that is a version of the original input_dict with
-        moment-related columns added
-        """
-        
-        return_dict = False
-        if inplace or input_dict is None:
-            src = self.source_table
-        elif input_dict is not None:
-            is_dictionary = (type(input_dict) is dict)
-            valid_columns = ['lens_flux', 'apFlux', 'e', 'beta', 'psf_fwhm'] 
-            valid_columns += [value + '_%d' %idx for value in ['q_flux', 'XIMG', 'YIMG'] for idx in range(4)]
-            has_valid_columns = all(col in input_dict for col in valid_columns)
-            if is_dictionary and has_valid_columns:
-               src = input_dict
-               return_dict = True
-            else:
-                raise ValueError("Keyword input_dict must be a dictionary and contain all the required keys.")
+    def _add_independent_variability(self, src, drw_state, tau, sf_inf, mu):
+        """
+        Adds an independent random walk in each filter to each of the columns q_mag_0, ..., q_mag_3 of src
+        and returns the state of the walks at their last epoch (see include_quasar_variability)
+        """
+        # Sort once so that each (object, filter) light curve is a contiguous, 
+        # time-ordered segment of the flat arrays
+        filters = src['filter'].values
+        # A categorical filter is sorted and compared by its one-byte codes
+        filter_keys = getattr(filters, 'codes', filters)
+        order = np.lexsort((src['MJD'].values, filter_keys, src['objectId'].values))
+        sorted_MJD = src['MJD'].values[order]
+        sorted_objectId = src['objectId'].values[order]
+        sorted_ccdVisitId = src['ccdVisitId'].values[order]
+        is_start = get_segment_starts(sorted_objectId, filter_keys[order])
+        segment_first = np.flatnonzero(is_start)
+        segment_last = np.append(segment_first[1:] - 1, len(order) - 1)
+        new_drw_state = pd.DataFrame({'objectId': sorted_objectId[segment_first],
+                                      'filter': filters[order[segment_first]],
+                                      'MJD': sorted_MJD[segment_last]}, columns=['objectId', 'filter', 'MJD'])
+        initial_times = None
+        if drw_state is not None:
+            # Last epoch of each light curve that was simulated before, NaN for new ones
+            prior = new_drw_state[['objectId', 'filter']].merge(drw_state, how='left', on=['objectId', 'filter'])
+            initial_times = prior['MJD'].values
         
-        # Calculate flux ratios (for weighted moments)
-        src['lensFluxRatio'] = src['lens_flux']/src['apFlux']
-        for q in range(4):
-            src['qFluxRatio_' + str(q)] = src['q_flux_' + str(q)]/src['apFlux']
-        if not return_dict:
-            src.drop(['lens_flux'] + ['q_flux_' + str(q) for q in range(4)], axis=1, inplace=True)
-        
-        #################
-        # FIRST MOMENTS #
-        #################
-        src['x'], src['y'] = 0.0, 0.0
         for q in range(4):
-            src['x'] += src['qFluxRatio_' + str(q)]*src['XIMG_' + str(q)]
-            src['y'] += src['qFluxRatio_' + str(q)]*src['YIMG_' + str(q)]
-        if self.add_moment_noise:
-            src['x'] += add_noise(mean=get_first_moment_err(), 
-                                  stdev=get_first_moment_err_std(), 
-                                  shape=src['x'].shape,
-                                  measurement=src['x'])
-            src['y'] += add_noise(mean=get_first_moment_err(), 
-                                  stdev=get_first_moment_err_std(), 
-                                  shape=src['y'].shape,
-                                  measurement=src['y'])
-        ##################
-        # SECOND MOMENTS #
-        ##################
-        # Read in lens shape parameters
-        src['minor_to_major'] = np.power((1.0 - src['e'])/(1.0 + src['e']), 0.5) # q parameter in galsim.shear
-        src['beta'] = np.radians(src['beta']) # beta parameter in galsim.shear 
-         # Arbitrarily set REFF_T to 1.0
-        #src['sigmasq_lens'] = np.power(hlr_to_sigma(src['REFF_T']), 2.0)
-        src['sigmasq_lens'] = np.power(hlr_to_sigma(1.0), 2.0)
-        
-        # Initialize with lens contributions
-        src['lam1'] = src['sigmasq_lens']/src['minor_to_major']
-        src['lam2'] = src['sigmasq_lens']*src['minor_to_major']
-        src['lens_Ixx'] = src['lam1']*np.power(np.cos(src['beta']), 2.0) + src['lam2']*np.power(np.sin(src['beta']), 2.0)
-        src['lens_Iyy'] = src['lam1']*np.power(np.sin(src['beta']), 2.0) + src['lam2']*np.power(np.cos(src['beta']), 2.0)
-        src['lens_Ixy'] = (src['lam1'] - src['lam2'])*np.cos(src['beta'])*np.sin(src['beta'])
-        src['Ixx'] = src['lensFluxRatio']*(src['lens_Ixx'] + np.power(src['x'], 2.0)) 
-        src['Iyy'] = src['lensFluxRatio']*(src['lens_Iyy'] + np.power(src['y'], 2.0))
-        src['Ixy'] = src['lensFluxRatio']*(src['lens_Ixy'] - src['x']*src['y'])
-        if not return_dict:
-            src.drop(['lam1', 'lam2', 'lens_Ixx', 'lens_Iyy', 'lens_Ixy'], axis=1, inplace=True)
-        # Add quasar contributions
+            magnitude_type = 'q_mag_' + str(q)
+            # Each quasar image gets its own random walk in each filter,
+            # driven by noise keyed by (objectId, ccdVisitId) rather than by row order
+            standard_normal = get_standard_normal(self.seed, sorted_objectId, sorted_ccdVisitId, quantity=magnitude_type)
+            initial = None if drw_state is None else prior[magnitude_type].values
+            sorted_intrinsic_mag = simulate_drw(sorted_MJD, is_start, tau=tau, sf_inf=sf_inf, mu=mu,
+                                                standard_normal=standard_normal,
+                                                initial=initial, initial_times=initial_times)
+            new_drw_state[magnitude_type] = sorted_intrinsic_mag[segment_last]
+            intrinsic_mag = np.empty(len(order))
+            intrinsic_mag[order] = sorted_intrinsic_mag
+            src[magnitude_type] = src[magnitude_type].values + intrinsic_mag
+        return new_drw_state
+
+    def _add_delayed_variability(self, src, drw_state, tau, sf_inf, mu):
+        """
+        Adds one intrinsic random walk per source and filter to the columns q_mag_0, ..., q_mag_3 of src,
+        each image seeing it at MJD minus the image's time delay (columns DELAY_0, ..., DELAY_3),
+        and returns the state of the walks at their last grid node (see include_quasar_variability).
+        The walk is simulated only at the nodes of a grid of spacing self.drw_grid_step
+        that bracket the delayed times and linearly interpolated between them.
+        """
+        delay_cols = ['DELAY_' + str(q) for q in range(4)]
+        if any(col not in src.columns for col in delay_cols + ['NIMG']):
+            raise ValueError("The 'time_delay' variability model needs the columns %s and NIMG." %delay_cols)
+        num_rows = len(src)
+        grouped = src.groupby(['objectId', 'filter'], sort=True, observed=True)
+        segment_keys = grouped.size().index.to_frame(index=False)
+        row_segment = grouped.ngroup().values
+        
+        # Times at which each image samples the intrinsic light curve.
+        # Nonexistent images get no delay, so they do not stretch the grid.
+        delays = src[delay_cols].values.copy()
+        delays[np.arange(4)[None, :] >= src['NIMG'].values[:, None]] = 0.0
+        query_times = (src['MJD'].values[:, None] - np.nan_to_num(delays)).T.ravel() # image-major
+        node_segment, node_index, lower, frac = get_grid_nodes(np.tile(row_segment, 4), query_times, self.drw_grid_step)
+        node_times = node_index*self.drw_grid_step
+        is_start = get_segment_starts(node_segment)
+        
+        # Noise keyed by (objectId, grid node) in each filter, so that a node
+        # gets the same draw whatever the other visits of the run
+        node_objectId = segment_keys['objectId'].values[node_segment]
+        segment_filter = np.asarray(segment_keys['filter'], dtype=object)
+        standard_normal = np.empty(len(node_segment))
+        for b in np.unique(segment_filter):
+            in_band = (segment_filter == b)[node_segment]
+            standard_normal[in_band] = get_standard_normal(self.seed, node_objectId[in_band], node_index[in_band],
+                                                           quantity='intrinsic_mag_' + str(b))
+        initial, initial_times = None, None
+        if drw_state is not None:
+            # Last node of each light curve that was simulated before, NaN for new ones
+            prior = segment_keys.merge(drw_state, how='left', on=['objectId', 'filter'])
+            initial, initial_times = prior['intrinsic_mag'].values, prior['MJD'].values
+        intrinsic_mag = simulate_drw(node_times, is_start, tau=tau, sf_inf=sf_inf, mu=mu,
+                                     standard_normal=standard_normal,
+                                     initial=initial, initial_times=initial_times)
+        
+        image_mag = (intrinsic_mag[lower]*(1.0 - frac) + intrinsic_mag[lower + 1]*frac).reshape(4, num_rows)
         for q in range(4):
-            src['Ixx'] += src['qFluxRatio_' + str(q)]*(np.power(src['XIMG_' + str(q)] - src['x'], 2.0))
-            src['Iyy'] += src['qFluxRatio_' + str(q)]*(np.power(src['YIMG_' + str(q)] - src['y'], 2.0))
-            src['Ixy'] += src['qFluxRatio_' + str(q)]*(src['XIMG_' + str(q)] - src['x'])\
-                                                     *(src['YIMG_' + str(q)] - src['y'])
-        # Add PSF
-        src['sigmasq_psf'] = np.power(fwhm_to_sigma(src['psf_fwhm']), 2.0)
-        src['Ixx'] += src['sigmasq_psf']
-        src['Iyy'] += src['sigmasq_psf']
-                
-        # Get trace and ellipticities
-        src['trace'] = src['Ixx'] + src['Iyy']
-        if self.add_moment_noise:
-            src['trace'] += add_noise(mean=get_second_moment_err(), 
-                                      stdev=get_second_moment_err_std(), 
-                                      shape=src['trace'].shape,
-                                      measurement=src['trace'])
-        src['e1'] = (src['Ixx'] - src['Iyy'])/src['trace']
-        src['e2'] = 2.0*src['Ixy']/src['trace']
-        src['e_final'], src['phi_final'] = e1e2_to_ephi(src['e1'], src['e2'])
-        
-        if inplace:
-            self.source_table = src
-
-        if return_dict:
-            return src
-    
+            src['q_mag_' + str(q)] = src['q_mag_' + str(q)].values + image_mag[q]
+        
+        segment_last = np.append(np.flatnonzero(is_start)[1:] - 1, len(node_segment) - 1)
+        new_drw_state = segment_keys.copy()
+        new_drw_state['MJD'] = node_times[segment_last]
+        new_drw_state['intrinsic_mag'] = intrinsic_mag[segment_last]
+        return new_drw_state
+
     def compare_truth_vs_emulated(self, lensID=None, rownum=None, save_dir=None):
         """                                                                                                                   
         Draws two images of the lens system with the given rownum
@@ -564,10 +1348,11 @@ class SLRealizer(object):
                                     save_dir)
         
         # Render the emulated image under observation conditions indexed by obs_rownum
+        import matplotlib.pyplot as plt
         fig, axes = plt.subplots(2, figsize=(5, 10))
         axes[0].imshow(truth_img.array, interpolation='none', aspect='auto')
         axes[0].set_title("TRUE MODEL IMAGE")
-        estimated_params = self.estimate_hsm(image=truth_img, observation=self.observation.loc[obs_rownum])
+        estimated_params = self.estimate_hsm(image=truth_img, observation=self.get_obs_info(rownum=obs_rownum))
         emulated_img = self.draw_emulated_system(estimated_params)
         axes[1].imshow(img.array, interpolation='none', aspect='auto')
         axes[1].set_title("EMULATED IMAGE")
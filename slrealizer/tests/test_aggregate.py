@@ -0,0 +1,87 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for the streaming object table aggregation
+
+# ======================================================================
+from __future__ import print_function
+import unittest
+import os
+import numpy as np
+import pandas as pd
+
+import shutil
+from slrealizer.utils.aggregate import ObjectAggregator
+# ======================================================================
+
+class ObjectAggregatorTest(unittest.TestCase):
+
+    """
+    Tests the chunked Welford aggregation against Pandas groupby statistics.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.RandomState(123)
+        num_rows = 5000
+        cls.src = pd.DataFrame({'objectId': rng.randint(0, 50, num_rows),
+                                'filter': rng.choice(list('ugriz'), num_rows),
+                                'x': rng.normal(0.1, 0.01, num_rows),
+                                'y': rng.normal(-0.1, 0.01, num_rows),
+                                'apFlux': rng.normal(100.0, 5.0, num_rows), })
+        cls.src.loc[rng.choice(num_rows, 100, replace=False), 'apFlux'] = np.nan
+        cls.properties = ['x', 'y', 'apFlux']
+        cls.output_dir = os.path.join(os.environ['SLREALIZERDIR'], 'tests', 'test_output', 'test_aggregate')
+        if os.path.exists(cls.output_dir):
+            shutil.rmtree(cls.output_dir)
+        os.makedirs(cls.output_dir)
+
+    def _get_truth(self):
+        grouped = self.src.groupby(['objectId', 'filter'])[self.properties]
+        means, stds = grouped.mean().unstack('filter'), grouped.std().unstack('filter')
+        truth = {}
+        for p in self.properties:
+            for b in 'ugriz':
+                truth[b + '_' + p] = means[(p, b)]
+                truth[b + '_' + p + '-std'] = stds[(p, b)]
+        truth = pd.DataFrame(truth)
+        for p in ['x', 'y']:
+            reference = truth['r_' + p].copy()
+            for b in 'ugriz':
+                truth[b + '_' + p] = truth[b + '_' + p] - reference
+        return truth
+
+    def test_chunked_aggregation(self):
+        aggregator = ObjectAggregator(self.properties)
+        for start in range(0, len(self.src), 700):
+            aggregator.update(self.src.iloc[start:start + 700])
+        obj = aggregator.to_object_table(include_std=True)
+        truth = self._get_truth()
+        np.testing.assert_allclose(obj.values, truth.loc[obj.index, obj.columns].values, rtol=1.e-10, atol=1.e-14)
+        assert list(obj.columns[:5]) == ['g_apFlux', 'i_apFlux', 'r_apFlux', 'u_apFlux', 'z_apFlux']
+
+    def test_merge(self):
+        first, second, whole = [ObjectAggregator(self.properties) for _ in range(3)]
+        first.update(self.src.iloc[:2000])
+        second.update(self.src.iloc[2000:])
+        whole.update(self.src)
+        first.merge(second)
+        merged = first.to_object_table(include_std=True)
+        assert merged.index.is_monotonic_increasing
+        pd.testing.assert_frame_equal(merged, whole.to_object_table(include_std=True))
+        # The rows are ordered by objectId whatever the order of the source rows
+        shuffled = ObjectAggregator(self.properties)
+        shuffled.update(self.src.sample(frac=1.0, random_state=1))
+        pd.testing.assert_frame_equal(shuffled.to_object_table(include_std=True), whole.to_object_table(include_std=True))
+
+    def test_save_load(self):
+        """ Tests whether an aggregator can be updated after a save-load round trip """
+        path = os.path.join(self.output_dir, 'aggregate_state.csv')
+        first, whole = ObjectAggregator(self.properties), ObjectAggregator(self.properties)
+        first.update(self.src.iloc[:3000])
+        first.save(path)
+        loaded = ObjectAggregator.load(path)
+        loaded.update(self.src.iloc[3000:])
+        whole.update(self.src)
+        pd.testing.assert_frame_equal(loaded.to_object_table(include_std=True), whole.to_object_table(include_std=True))
+
+if __name__ == '__main__':
+    unittest.main()
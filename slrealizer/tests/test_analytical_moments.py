@@ -3,6 +3,10 @@ import unittest
 import numpy as np
 import os, sys
 from slrealizer.utils.utils import *
+from slrealizer.utils.analytical_moments import get_lens_covariance, get_blended_moments
+from slrealizer.utils.table_io import read_table
+from slrealizer.realize_om10 import OM10Realizer
+from slrealizer.benchmarks.synthetic import make_synthetic_catalog, make_synthetic_observation
 
 class AnalyticalTest(unittest.TestCase):  
     """Tests the analytical equations used for calculating moments."""
@@ -216,5 +220,68 @@ class AnalyticalTest(unittest.TestCase):
         assert np.isclose(num_Iyy, Iyy, rtol=1.e-3)
         assert np.isclose(np.sum(galsim_img.array), total_flux)
 
+    def test_batched_moments(self):
+        """Compares moments of an image stack computed in one pass with those of each image"""
+        gal = galsim.Gaussian(sigma=self.gal_sigma, flux=self.gal_flux).shear(e1=self.gal_e1, e2=self.gal_e2)
+        psf = galsim.Gaussian(sigma=self.psf_sigma)
+        images = np.array([galsim.Convolve([gal.shift(dx=dx, dy=dy), psf])\
+                                 .drawImage(scale=self.pixel_scale, nx=self.nx, ny=self.nx, method='no_pixel').array
+                           for dx, dy in [(self.gal_x, self.gal_y), (self.qso_x, self.qso_y)]])
+        flux, Ix, Iy, Ixx, Ixy, Iyy = get_moments_from_images(images, pixel_scale=self.pixel_scale)
+        for n in range(len(images)):
+            num_Ix, num_Iy = get_first_moments_from_image(images[n], pixel_scale=self.pixel_scale)
+            num_Ixx, num_Ixy, num_Iyy = get_second_moments_from_image(images[n], pixel_scale=self.pixel_scale)
+            assert np.allclose([Ix[n], Iy[n], Ixx[n], Ixy[n], Iyy[n]], [num_Ix, num_Iy, num_Ixx, num_Ixy, num_Iyy])
+            assert np.isclose(flux[n], np.sum(images[n]))
+        assert np.allclose([Ix[0], Iy[0]], [self.gal_x, self.gal_y], rtol=1.e-3)
+
+    def test_blended_moments_kernel(self):
+        """Compares the array kernel of the source table with the analytical moments of a galaxy, QSO and PSF"""
+        gal_e, gal_phi = e1e2_to_ephi(e1=self.gal_e1, e2=self.gal_e2)
+        gal_hlr = self.gal_sigma*np.sqrt(2.0*np.log(2.0))
+        lens_Ixx, lens_Iyy, lens_Ixy = get_lens_covariance(e=np.array([gal_e]), beta=np.degrees([gal_phi]), hlr=gal_hlr)
+        # QSO image on the x-axis and off both axes, with three empty image slots
+        for qso_y in [0.0, -0.8*self.qso_x]:
+            x_img = np.array([[self.qso_x, 0.0, 0.0, 0.0]])
+            y_img = np.array([[qso_y, 0.0, 0.0, 0.0]])
+            q_flux = np.array([[self.qso_flux, 0.0, 0.0, 0.0]])
+            moments = get_blended_moments(lens_flux=np.array([self.gal_flux]), q_flux=q_flux, x_img=x_img, y_img=y_img,
+                                          lens_Ixx=lens_Ixx, lens_Iyy=lens_Iyy, lens_Ixy=lens_Ixy,
+                                          sigmasq_psf=np.array([self.psf_sigma**2.0]))
+        
+            gal = galsim.Gaussian(sigma=self.gal_sigma, flux=self.gal_flux).shear(e1=self.gal_e1, e2=self.gal_e2)
+            qso = galsim.Gaussian(sigma=1.e-8, flux=self.qso_flux).shift(dx=self.qso_x, dy=qso_y)
+            psf = galsim.Gaussian(sigma=self.psf_sigma)
+            galsim_img = galsim.Convolve([gal + qso, psf]).drawImage(scale=self.pixel_scale, nx=self.nx, ny=self.nx, method='no_pixel')
+            num_Ix, num_Iy = get_first_moments_from_image(galsim_img.array, pixel_scale=self.pixel_scale)
+            num_Ixx, num_Ixy, num_Iyy = get_second_moments_from_image(galsim_img.array, pixel_scale=self.pixel_scale)
+        
+            assert np.isclose(moments['apFlux'][0], self.gal_flux + self.qso_flux)
+            assert np.allclose([moments['x'][0], moments['y'][0]], [num_Ix, num_Iy], rtol=1.e-3, atol=1.e-6)
+            assert np.isclose(moments['Ixx'][0], num_Ixx, rtol=1.e-3)
+            assert np.isclose(moments['Ixy'][0], num_Ixy, rtol=1.e-3)
+            assert np.isclose(moments['Iyy'][0], num_Iyy, rtol=1.e-3)
+            assert np.isclose(moments['trace'][0], moments['Ixx'][0] + moments['Iyy'][0])
+
+    def test_rowbyrow_analytical(self):
+        """Tests that the analytical row-by-row table, which runs the kernel on one row at a time, is the vectorized table"""
+        output_dir = os.path.join(os.environ['SLREALIZERDIR'], 'tests', 'test_output', 'test_analytical_moments')
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        tables = []
+        for method_name in ['make_source_table_rowbyrow', 'make_source_table_vectorized']:
+            realizer = OM10Realizer(observation=make_synthetic_observation(20, seed=13),
+                                    catalog=make_synthetic_catalog(6, seed=13))
+            path = os.path.join(output_dir, method_name + '.csv')
+            if method_name == 'make_source_table_rowbyrow':
+                realizer.make_source_table_rowbyrow(path, method='analytical')
+            else:
+                realizer.make_source_table_vectorized(path, include_time_variability=False)
+            table = read_table(path).reset_index()
+            tables.append(table.sort_values(['objectId', 'ccdVisitId']).reset_index(drop=True))
+        rowbyrow, vectorized = tables
+        for col in ['x', 'y', 'trace', 'e1', 'e2', 'e_final', 'apFlux', 'apMag']:
+            np.testing.assert_allclose(rowbyrow[col], vectorized[col], rtol=1.e-10, atol=1.e-12)
+
 if __name__ == '__main__':
     unittest.main()
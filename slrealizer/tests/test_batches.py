@@ -0,0 +1,67 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for the streamed mini-batches of object table rows
+
+# ======================================================================
+from __future__ import print_function
+import unittest
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+from slrealizer.realize_om10 import OM10Realizer
+from slrealizer.utils.table_io import read_table
+from slrealizer.benchmarks.synthetic import make_synthetic_catalog, make_synthetic_observation
+# ======================================================================
+
+class ObjectBatchTest(unittest.TestCase):
+
+    """
+    Tests that the mini-batches have the features of the object table and are reproducible.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.output_dir = os.path.join(os.environ['SLREALIZERDIR'], 'tests', 'test_output', 'test_batches')
+        if os.path.exists(cls.output_dir):
+            shutil.rmtree(cls.output_dir)
+        os.makedirs(cls.output_dir)
+        cls.realizer = OM10Realizer(observation=make_synthetic_observation(60, seed=9),
+                                    catalog=make_synthetic_catalog(12, seed=9))
+
+    def test_batches(self):
+        """Tests the size, columns and randomness of the batches"""
+        source_path = os.path.join(self.output_dir, 'source.csv')
+        object_path = os.path.join(self.output_dir, 'object.csv')
+        self.realizer.make_source_table_vectorized(source_path, include_time_variability=False)
+        self.realizer.make_object_table(object_path, source_table_path=source_path, include_std=True)
+        columns = list(read_table(object_path, dtype={}).columns)
+
+        batches = list(self.realizer.iter_object_batches(5, num_visits_per_band=4, num_batches=3, include_std=True))
+        assert len(batches) == 3
+        lens_ids = set(self.realizer.get_object_ids())
+        for batch in batches:
+            assert 0 < len(batch) <= 5
+            assert list(batch.columns) == columns
+            assert set(batch.index) <= lens_ids
+            assert not batch.isnull().values.any()
+        # Each batch is a fresh realization
+        assert not np.allclose(batches[0]['r_apFlux'].mean(), batches[1]['r_apFlux'].mean())
+
+        repeated = list(self.realizer.iter_object_batches(5, num_visits_per_band=4, num_batches=3, include_std=True))
+        for batch, repeat in zip(batches, repeated):
+            pd.testing.assert_frame_equal(batch, repeat)
+        other_seed = next(self.realizer.iter_object_batches(5, num_visits_per_band=4, seed=1, include_std=True))
+        assert not other_seed.equals(batches[0])
+
+    def test_unbounded(self):
+        """Tests that the batches go on without num_batches, with variability"""
+        batches = self.realizer.iter_object_batches(12, num_visits_per_band=2, include_time_variability=True)
+        for n in range(5):
+            batch = next(batches)
+            assert len(batch) == 12
+            # All systems, in random order
+            assert sorted(batch.index) == sorted(self.realizer.get_object_ids())
+
+if __name__ == '__main__':
+    unittest.main()
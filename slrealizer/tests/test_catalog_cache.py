@@ -0,0 +1,112 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for the on-disk cache of the flattened OM10 catalog
+
+# ======================================================================
+from __future__ import print_function
+import unittest
+import os
+import numpy as np
+import pandas as pd
+
+import shutil
+import sys
+from slrealizer.utils.catalog_cache import get_catalog_cache_key, get_om10_catalog_table, CachedCatalog, load_om10_catalog
+from slrealizer.utils.table_io import write_table
+# ======================================================================
+
+class CatalogCacheTest(unittest.TestCase):
+
+    """
+    Tests the flattening, keying and reloading of cached OM10 samples.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        from astropy.table import Table
+        rng = np.random.RandomState(123)
+        num_lenses = 20
+        columns = {}
+        for b in 'ugriz':
+            columns[b + '_SDSS_lens'] = rng.uniform(19.0, 22.0, num_lenses)
+            columns[b + '_SDSS_quasar'] = rng.uniform(20.0, 23.0, num_lenses)
+        columns['REFF_T'] = rng.uniform(0.5, 1.5, num_lenses)
+        columns['NIMG'] = rng.choice([2, 4], num_lenses)
+        columns['LENSID'] = np.arange(num_lenses) + 1000
+        columns['ELLIP'] = rng.uniform(0.0, 0.5, num_lenses)
+        columns['PHIE'] = rng.uniform(-90.0, 90.0, num_lenses)
+        for mc in ['MAG', 'XIMG', 'YIMG', 'DELAY']:
+            columns[mc] = rng.uniform(-2.0, 2.0, (num_lenses, 4))
+        cls.sample = Table(columns)
+        cls.output_dir = os.path.join(os.environ['SLREALIZERDIR'], 'tests', 'test_output', 'test_catalog_cache')
+        if os.path.exists(cls.output_dir):
+            shutil.rmtree(cls.output_dir)
+        os.makedirs(cls.output_dir)
+        cls.catalog_path = os.path.join(cls.output_dir, 'catalog.fits')
+        with open(cls.catalog_path, 'wb') as f:
+            f.write(b'catalog contents')
+
+    def test_flatten_and_rebuild(self):
+        """Tests that the flattened table has one column per image and rebuilds the original sample"""
+        table = get_om10_catalog_table(self.sample)
+        assert len(table) == len(self.sample)
+        np.testing.assert_array_equal(table['MAG_2'].values, self.sample['MAG'][:, 2])
+        rebuilt = CachedCatalog(table).sample
+        for mc in ['MAG', 'XIMG', 'YIMG', 'DELAY']:
+            np.testing.assert_array_equal(np.asarray(rebuilt[mc]), np.asarray(self.sample[mc]))
+        np.testing.assert_array_equal(np.asarray(rebuilt['LENSID']), np.asarray(self.sample['LENSID']))
+
+    def test_cache_key(self):
+        """Tests that the key is stable and changes with the catalog contents and the parameters"""
+        select_params = {'maglim': 23.3, 'area': 100.0, 'IQ': 0.75}
+        key = get_catalog_cache_key(self.catalog_path, select_params=select_params, paint_params={'synthetic': True})
+        assert key == get_catalog_cache_key(self.catalog_path, select_params=dict(select_params), paint_params={'synthetic': True})
+        assert key != get_catalog_cache_key(self.catalog_path, select_params=select_params, paint_params={'synthetic': False})
+        assert key != get_catalog_cache_key(self.catalog_path, select_params=dict(select_params, area=10.0), paint_params={'synthetic': True})
+        other_path = os.path.join(self.output_dir, 'other.fits')
+        with open(other_path, 'wb') as f:
+            f.write(b'other contents')
+        assert key != get_catalog_cache_key(other_path, select_params=select_params, paint_params={'synthetic': True})
+
+    def test_load_from_cache(self):
+        """Tests that a cached sample is read back without recomputing it"""
+        table = get_om10_catalog_table(self.sample)
+        key = get_catalog_cache_key(self.catalog_path, paint_params={'synthetic': True}, seed=7)
+        write_table(table, os.path.join(self.output_dir, 'om10_%s.feather' %key), table_format='feather',
+                    index=False, compression='uncompressed')
+        cached = load_om10_catalog(self.catalog_path, self.output_dir, paint_params={'synthetic': True}, seed=7)
+        assert len(cached) == len(table)
+        pd.testing.assert_frame_equal(cached.table, table, check_dtype=False)
+
+    def test_unseeded_draw(self):
+        """Tests that a random selection is only cached with a seed"""
+        import types
+        sample = self.sample
+        class DB(object):
+            def __init__(self, catalog):
+                self.sample = sample
+            def select_random(self, maglim):
+                self.sample = sample[np.random.permutation(len(sample))[:10]]
+        om10 = types.ModuleType('om10')
+        om10.DB = DB
+        saved = sys.modules.get('om10')
+        sys.modules['om10'] = om10
+        try:
+            cache_dir = os.path.join(self.output_dir, 'unseeded')
+            select_params = {'maglim': 23.3}
+            draws = [load_om10_catalog(self.catalog_path, cache_dir, select_params=select_params).table['LENSID'].values
+                     for _ in range(5)]
+            assert not os.path.exists(cache_dir)
+            assert any(not np.array_equal(draws[0], draw) for draw in draws[1:])
+            seeded = load_om10_catalog(self.catalog_path, cache_dir, select_params=select_params, seed=3)
+            assert len(os.listdir(cache_dir)) == 1
+            np.random.seed(4)
+            cached = load_om10_catalog(self.catalog_path, cache_dir, select_params=select_params, seed=3)
+            pd.testing.assert_frame_equal(cached.table, seeded.table, check_dtype=False)
+        finally:
+            if saved is None:
+                del sys.modules['om10']
+            else:
+                sys.modules['om10'] = saved
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for the checkpointed, resumable runs
+
+# ======================================================================
+from __future__ import print_function
+import unittest
+import os
+import json
+import shutil
+import pandas as pd
+
+from slrealizer.realize_om10 import OM10Realizer
+from slrealizer.utils.checkpoint import Checkpoint
+from slrealizer.utils.table_io import read_table
+from slrealizer.benchmarks.synthetic import make_synthetic_catalog, make_synthetic_observation
+# ======================================================================
+
+class Preempted(Exception):
+    pass
+
+class CheckpointTest(unittest.TestCase):
+
+    """
+    Tests that a run interrupted after some work units and resumed from its checkpoint
+    gives the table of an uninterrupted run.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.output_dir = os.path.join(os.environ['SLREALIZERDIR'], 'tests', 'test_output', 'test_checkpoint')
+        if os.path.exists(cls.output_dir):
+            shutil.rmtree(cls.output_dir)
+        os.makedirs(cls.output_dir)
+
+    def get_realizer(self, catalog_seed=8):
+        realizer = OM10Realizer(observation=make_synthetic_observation(12, seed=8),
+                                catalog=make_synthetic_catalog(5, seed=catalog_seed))
+        realizer.variability_model = 'time_delay'
+        return realizer
+
+    def preempt_after(self, realizer, method_name, num_calls):
+        """Makes realizer.<method_name> raise Preempted once it has been called num_calls times"""
+        method = getattr(realizer, method_name)
+        calls = []
+        def preemptible(*args, **kwargs):
+            if len(calls) == num_calls:
+                raise Preempted()
+            calls.append(None)
+            return method(*args, **kwargs)
+        setattr(realizer, method_name, preemptible)
+
+    def test_chunked(self):
+        """Tests resuming make_source_table_chunked, with the variability state of each tile"""
+        expected_path = os.path.join(self.output_dir, 'chunked_expected.csv')
+        realizer = self.get_realizer()
+        realizer.make_source_table_chunked(expected_path, include_time_variability=True, lens_chunk_size=2)
+        expected_drw_state = realizer.drw_state
+
+        path = os.path.join(self.output_dir, 'chunked.csv')
+        checkpoint_dir = os.path.join(self.output_dir, 'chunked_checkpoint')
+        kwargs = dict(include_time_variability=True, lens_chunk_size=2, checkpoint_dir=checkpoint_dir)
+        realizer = self.get_realizer()
+        self.preempt_after(realizer, '_realize_tile', 2)
+        with self.assertRaises(Preempted):
+            realizer.make_source_table_chunked(path, **kwargs)
+        with open(os.path.join(checkpoint_dir, 'manifest.json')) as f:
+            assert len(json.load(f)['units']) == 2
+        # A resumed run must have the same configuration
+        with self.assertRaises(ValueError):
+            self.get_realizer().make_source_table_chunked(path, include_time_variability=True, lens_chunk_size=3,
+                                                          checkpoint_dir=checkpoint_dir)
+        # and the same inputs, not just inputs of the same size
+        with self.assertRaises(ValueError):
+            self.get_realizer(catalog_seed=99).make_source_table_chunked(path, **kwargs)
+        realizer = self.get_realizer()
+        realizer.pixel_scale = 0.2
+        with self.assertRaises(ValueError):
+            realizer.make_source_table_chunked(path, **kwargs)
+        realizer = self.get_realizer()
+        self.preempt_after(realizer, '_realize_tile', 1)
+        realizer.make_source_table_chunked(path, **kwargs)
+        assert not os.path.exists(checkpoint_dir)
+        pd.testing.assert_frame_equal(read_table(path), read_table(expected_path), check_exact=True)
+        pd.testing.assert_frame_equal(realizer.drw_state, expected_drw_state, check_exact=True)
+
+    def test_rowbyrow(self):
+        """Tests resuming make_source_table_rowbyrow"""
+        expected_path = os.path.join(self.output_dir, 'rowbyrow_expected.csv')
+        self.get_realizer().make_source_table_rowbyrow(expected_path, work_unit_size=7)
+
+        path = os.path.join(self.output_dir, 'rowbyrow.csv')
+        checkpoint_dir = os.path.join(self.output_dir, 'rowbyrow_checkpoint')
+        for num_calls in [3, 2]:
+            realizer = self.get_realizer()
+            self.preempt_after(realizer, '_create_rowbyrow_rows', num_calls)
+            with self.assertRaises(Preempted):
+                realizer.make_source_table_rowbyrow(path, work_unit_size=7, checkpoint_dir=checkpoint_dir)
+        realizer = self.get_realizer()
+        realizer.make_source_table_rowbyrow(path, work_unit_size=7, checkpoint_dir=checkpoint_dir)
+        assert not realizer.rowbyrow_failed.any()
+        pd.testing.assert_frame_equal(read_table(path), read_table(expected_path), check_exact=True)
+
+    def test_atomic_commit(self):
+        """Tests that units are only recorded once their tables are saved"""
+        checkpoint_dir = os.path.join(self.output_dir, 'atomic_checkpoint')
+        checkpoint = Checkpoint(checkpoint_dir, {'method': 'test'})
+        checkpoint.commit((0, 5), {'source': pd.DataFrame({'x': [1.0, 2.0]})}, info={'failed': []})
+        class Unpicklable(pd.DataFrame):
+            def to_pickle(self, path):
+                open(path, 'w').close()
+                raise Preempted()
+        with self.assertRaises(Preempted):
+            checkpoint.commit((1, 5), {'source': Unpicklable({'x': [3.0]})})
+        resumed = Checkpoint(checkpoint_dir, {'method': 'test'})
+        assert resumed.is_done((0, 5)) and not resumed.is_done((1, 5))
+        assert resumed.get_info((0, 5)) == {'failed': []}
+        assert resumed.read((0, 5), 'source')['x'].tolist() == [1.0, 2.0]
+        resumed.remove()
+
+if __name__ == '__main__':
+    unittest.main()
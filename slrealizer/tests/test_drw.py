@@ -0,0 +1,84 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for the damped random walk solver
+
+# ======================================================================
+from __future__ import print_function
+import unittest
+import numpy as np
+
+from slrealizer.utils.drw import get_segment_starts, simulate_drw, get_grid_nodes
+# ======================================================================
+
+class DRWTest(unittest.TestCase):
+
+    """
+    Tests the segmented DRW solver against a step-by-step recurrence.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.RandomState(123)
+        num_objects, num_epochs = 20, 150
+        cls.objectId = np.repeat(np.arange(num_objects), num_epochs)
+        cls.times = np.concatenate([np.sort(rng.uniform(0.0, 3650.0, num_epochs)) for _ in range(num_objects)])
+        cls.is_start = get_segment_starts(cls.objectId)
+        cls.standard_normal = rng.normal(size=len(cls.times))
+        cls.sf_inf = 0.14
+        cls.mu = 0.1
+
+    def _step_by_step(self, tau):
+        intrinsic_mag = np.zeros(len(self.times))
+        for i in range(len(self.times)):
+            if self.is_start[i]:
+                continue
+            d_time = self.times[i] - self.times[i - 1]
+            decay = np.exp(-d_time/tau)
+            intrinsic_mag[i] = intrinsic_mag[i - 1]*decay + self.mu*(1.0 - decay)\
+                               + 0.5*self.sf_inf**2.0*(1.0 - np.exp(-2.0*d_time/tau))*self.standard_normal[i]
+        return intrinsic_mag
+
+    def test_get_segment_starts(self):
+        """ Tests whether segment starts are found from multiple keys """
+        is_start = get_segment_starts(np.array([1, 1, 1, 2, 2]), np.array(['g', 'g', 'r', 'r', 'r']))
+        np.testing.assert_array_equal(is_start, [True, False, True, True, False])
+
+    def test_simulate_drw(self):
+        """ Tests whether the solver matches the recurrence, including when exp(t/tau) would overflow """
+        for tau in [20.0, 0.05]:
+            intrinsic_mag = simulate_drw(self.times, self.is_start, tau=tau, sf_inf=self.sf_inf, 
+                                         mu=self.mu, standard_normal=self.standard_normal)
+            np.testing.assert_allclose(intrinsic_mag, self._step_by_step(tau), rtol=1.e-8, atol=1.e-10)
+            np.testing.assert_array_equal(intrinsic_mag[self.is_start], 0.0)
+
+    def test_continue_drw(self):
+        """ Tests whether continuing walks from their last epoch matches simulating them in one go """
+        tau = 20.0
+        full = simulate_drw(self.times, self.is_start, tau=tau, sf_inf=self.sf_inf, 
+                            mu=self.mu, standard_normal=self.standard_normal)
+        # Split each light curve after its 100th epoch
+        epoch = np.arange(len(self.times)) - np.flatnonzero(self.is_start)[np.cumsum(self.is_start) - 1]
+        is_old = (epoch < 100)
+        old_last = np.flatnonzero(is_old & (epoch == 99))
+        new = ~is_old
+        new_is_start = get_segment_starts(self.objectId[new])
+        continued = simulate_drw(self.times[new], new_is_start, tau=tau, sf_inf=self.sf_inf, mu=self.mu,
+                                 standard_normal=self.standard_normal[new],
+                                 initial=full[old_last], initial_times=self.times[old_last])
+        np.testing.assert_allclose(continued, full[new], rtol=1.e-8, atol=1.e-10)
+
+    def test_get_grid_nodes(self):
+        """ Tests whether the grid nodes bracket the query times and interpolate linear functions exactly """
+        grid_step = 0.25
+        node_segment, node_index, lower, frac = get_grid_nodes(self.objectId, self.times, grid_step)
+        node_times = node_index*grid_step
+        np.testing.assert_array_equal(node_segment[lower], self.objectId)
+        np.testing.assert_array_equal(node_segment[lower + 1], self.objectId)
+        assert np.all((node_times[lower] <= self.times) & (self.times < node_times[lower + 1] + 1.e-9))
+        assert np.all((frac >= 0.0) & (frac < 1.0))
+        # Nodes are unique and sorted within each segment
+        assert np.all(np.diff(node_index)[np.diff(node_segment) == 0] > 0)
+        line = 3.0*node_times - 1.0
+        np.testing.assert_allclose(line[lower]*(1.0 - frac) + line[lower + 1]*frac, 3.0*self.times - 1.0, rtol=1.e-10)
+
+if __name__ == '__main__':
+    unittest.main()
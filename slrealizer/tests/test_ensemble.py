@@ -0,0 +1,81 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for the multi-realization ensembles
+
+# ======================================================================
+from __future__ import print_function
+import unittest
+import os
+import shutil
+import numpy as np
+
+from slrealizer.realize_om10 import OM10Realizer
+from slrealizer.utils.table_io import read_table
+from slrealizer.benchmarks.synthetic import make_synthetic_catalog, make_synthetic_observation
+# ======================================================================
+
+class EnsembleTest(unittest.TestCase):
+
+    """
+    Tests that each member of an ensemble is the source table of a single realization with its seed.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.output_dir = os.path.join(os.environ['SLREALIZERDIR'], 'tests', 'test_output', 'test_ensemble')
+        if os.path.exists(cls.output_dir):
+            shutil.rmtree(cls.output_dir)
+        os.makedirs(cls.output_dir)
+        cls.seeds = [7, 123, 2018]
+
+    def get_realizer(self):
+        return OM10Realizer(observation=make_synthetic_observation(30, seed=3),
+                            catalog=make_synthetic_catalog(8, seed=3))
+
+    def assert_same_table(self, out, expected, rtol=1.e-10):
+        for col in expected.columns:
+            if col == 'filter':
+                np.testing.assert_array_equal(np.asarray(out[col], dtype=object), np.asarray(expected[col], dtype=object))
+            else:
+                np.testing.assert_allclose(out[col].values.astype(float), expected[col].values.astype(float),
+                                           rtol=rtol, atol=1.e-12, err_msg=col)
+
+    def get_single_realizations(self, include_time_variability):
+        tables = []
+        for seed in self.seeds:
+            realizer = self.get_realizer()
+            realizer.seed = seed
+            path = os.path.join(self.output_dir, 'single_%d.csv' %seed)
+            realizer.make_source_table_vectorized(path, include_time_variability=include_time_variability)
+            tables.append(read_table(path))
+        return tables
+
+    def test_noise_overlay(self):
+        """Tests the members drawn from the cached noise-free moments, and the noise-free table on disk"""
+        expected = self.get_single_realizations(False)
+        source_path = os.path.join(self.output_dir, 'source_%d.csv')
+        object_path = os.path.join(self.output_dir, 'object_%d.csv')
+        noiseless_path = os.path.join(self.output_dir, 'noiseless.csv')
+        for run in range(2):
+            # The second run reads the noise-free table saved by the first
+            realizer = self.get_realizer()
+            realizer.make_source_table_ensemble(len(self.seeds), source_path, output_object_path=object_path,
+                                                seeds=self.seeds, noiseless_table_path=noiseless_path)
+            assert os.path.exists(noiseless_path)
+            for k in range(len(self.seeds)):
+                self.assert_same_table(read_table(source_path %k), expected[k])
+                obj = read_table(object_path %k, dtype={})
+                assert len(obj) == 8
+        with self.assertRaises(ValueError):
+            realizer.make_source_table_ensemble(2, source_path, seeds=self.seeds)
+
+    def test_variability(self):
+        """Tests the members with quasar variability, which recompute the moments"""
+        expected = self.get_single_realizations(True)
+        source_path = os.path.join(self.output_dir, 'variable_source_%d.csv')
+        realizer = self.get_realizer()
+        realizer.make_source_table_ensemble(len(self.seeds), source_path, seeds=self.seeds, include_time_variability=True)
+        for k in range(len(self.seeds)):
+            self.assert_same_table(read_table(source_path %k), expected[k])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for matching systems to the footprints of visits
+
+# ======================================================================
+from __future__ import print_function
+import unittest
+import numpy as np
+
+from slrealizer.utils.footprint import radec_to_xyz, get_uniform_sky_positions, get_overlapping_pairs
+# ======================================================================
+
+class FootprintTest(unittest.TestCase):
+
+    """
+    Tests the KD-tree footprint matching against a brute-force angular separation cut.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.RandomState(123)
+        cls.system_ra, cls.system_dec = get_uniform_sky_positions(123, np.arange(2000), ra_range=(0.0, 40.0), dec_range=(-30.0, 0.0))
+        # 50 fields, each visited 3 times
+        cls.field_ra = np.repeat(rng.uniform(0.0, 40.0, 50), 3)
+        cls.field_dec = np.repeat(rng.uniform(-30.0, 0.0, 50), 3)
+        cls.fov_radius = 3.0
+
+    def test_uniform_positions(self):
+        assert np.all((self.system_ra >= 0.0) & (self.system_ra <= 40.0))
+        assert np.all((self.system_dec >= -30.0) & (self.system_dec <= 0.0))
+        # Positions are keyed by ID, not by catalog order
+        ra, dec = get_uniform_sky_positions(123, np.arange(2000)[::-1], ra_range=(0.0, 40.0), dec_range=(-30.0, 0.0))
+        np.testing.assert_array_equal(ra[::-1], self.system_ra)
+
+    def test_overlapping_pairs(self):
+        visit_rows, system_rows = get_overlapping_pairs(self.system_ra, self.system_dec, 
+                                                        self.field_ra, self.field_dec, fov_radius=self.fov_radius)
+        cos_sep = np.dot(radec_to_xyz(self.field_ra, self.field_dec), radec_to_xyz(self.system_ra, self.system_dec).T)
+        separation = np.degrees(np.arccos(np.clip(cos_sep, -1.0, 1.0)))
+        true_visit_rows, true_system_rows = np.nonzero(separation <= self.fov_radius)
+        np.testing.assert_array_equal(visit_rows, true_visit_rows)
+        np.testing.assert_array_equal(system_rows, true_system_rows)
+        assert len(visit_rows) < len(self.field_ra)*len(self.system_ra)
+
+if __name__ == '__main__':
+    unittest.main()
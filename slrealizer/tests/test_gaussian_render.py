@@ -0,0 +1,55 @@
+import galsim
+import unittest
+import numpy as np
+from slrealizer.utils.gaussian_render import draw_gaussian_systems
+
+class GaussianRenderTest(unittest.TestCase):  
+    """Compares the NumPy Gaussian renderer with GalSim images."""
+    
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.RandomState(123)
+        num_systems = 5
+        cls.params = {
+            'lens_flux': rng.uniform(10.0, 100.0, num_systems),
+            'lens_hlr': rng.uniform(0.3, 1.5, num_systems),
+            'lens_e': rng.uniform(0.0, 0.6, num_systems),
+            'lens_beta': rng.uniform(0.0, np.pi, num_systems),
+            'q_flux': rng.uniform(5.0, 50.0, (num_systems, 4)),
+            'q_x': rng.uniform(-1.5, 1.5, (num_systems, 4)),
+            'q_y': rng.uniform(-1.5, 1.5, (num_systems, 4)),
+            'psf_fwhm': rng.uniform(0.5, 1.2, num_systems),
+        }
+        cls.nx = 49
+        cls.pixel_scale = 0.1
+        cls.num_systems = num_systems
+
+    def _draw_galsim(self, n, method):
+        p = self.params
+        gal = galsim.Gaussian(half_light_radius=p['lens_hlr'][n], flux=p['lens_flux'][n])\
+                    .shear(e=p['lens_e'][n], beta=p['lens_beta'][n]*galsim.radians)
+        for q in range(4):
+            gal += galsim.DeltaFunction(flux=p['q_flux'][n, q]).shift(p['q_x'][n, q], p['q_y'][n, q])
+        total = galsim.Convolve([gal, galsim.Gaussian(fwhm=p['psf_fwhm'][n])], 
+                                gsparams=galsim.GSParams(maximum_fft_size=10240))
+        return total.drawImage(nx=self.nx, ny=self.nx, scale=self.pixel_scale, method=method).array
+
+    def test_no_pixel(self):
+        """ Compares with method='no_pixel' to 1e-6 of the peak pixel value """
+        stamps = draw_gaussian_systems(nx=self.nx, ny=self.nx, pixel_scale=self.pixel_scale, 
+                                       pixel_integration=False, **self.params)
+        for n in range(self.num_systems):
+            galsim_img = self._draw_galsim(n, method='no_pixel')
+            assert np.allclose(stamps[n], galsim_img, rtol=0.0, atol=1.e-6*galsim_img.max())
+
+    def test_pixel_integration(self):
+        """ Compares with GalSim's default drawImage method to 1e-4 of the peak pixel value """
+        stamps = draw_gaussian_systems(nx=self.nx, ny=self.nx, pixel_scale=self.pixel_scale, 
+                                       pixel_integration=True, **self.params)
+        for n in range(self.num_systems):
+            galsim_img = self._draw_galsim(n, method='auto')
+            assert np.allclose(stamps[n], galsim_img, rtol=0.0, atol=1.e-4*galsim_img.max())
+            assert np.isclose(stamps[n].sum(), galsim_img.sum(), rtol=1.e-6)
+
+if __name__ == '__main__':
+    unittest.main()
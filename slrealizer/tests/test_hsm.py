@@ -0,0 +1,86 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for the warm-started HSM fits
+
+# ======================================================================
+from __future__ import print_function
+import unittest
+import numpy as np
+import galsim
+
+from slrealizer.realize_om10 import OM10Realizer
+from slrealizer.utils.hsm_stats import HSMStats
+from slrealizer.utils.utils import get_moments_from_images
+from slrealizer.benchmarks.synthetic import make_synthetic_catalog, make_synthetic_observation
+# ======================================================================
+
+class HSMTest(unittest.TestCase):
+
+    """
+    Tests the analytical starting point of the HSM fits, their fallback and their counts.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.realizer = OM10Realizer(observation=make_synthetic_observation(20, seed=10),
+                                    catalog=make_synthetic_catalog(10, seed=10))
+
+    def draw_gaussian(self, x, y, sigma):
+        """Returns a GalSim image of a round Gaussian on the stamp of the realizer"""
+        realizer = self.realizer
+        profile = galsim.Gaussian(sigma=sigma, flux=100.0).shift(x, y)
+        return profile.drawImage(nx=realizer.nx, ny=realizer.ny, scale=realizer.pixel_scale, method='no_pixel')
+
+    def test_guess(self):
+        """Tests that the guess is the centroid and size of the image the guess is made for"""
+        realizer = self.realizer
+        for j, i in [(0, 0), (5, 3), (12, 9)]:
+            obs_info = realizer.get_obs_info(rownum=j)
+            lens_info = realizer.get_lens_info(rownum=i)
+            guess = realizer._get_hsm_guess(obs_info, lens_info)
+            images = realizer.draw_systems_gaussian([obs_info], [lens_info], pixel_integration=False)
+            flux, Ix, Iy, Ixx, Ixy, Iyy = get_moments_from_images(images, realizer.pixel_scale)
+            # The stamp truncates the wings of the profile
+            assert np.allclose([guess['x'], guess['y']], [Ix[0], Iy[0]], atol=0.05)
+            assert np.isclose(guess['sigma'], (Ixx[0]*Iyy[0] - Ixy[0]**2.0)**0.25, rtol=0.1)
+
+    def test_warm_start(self):
+        """Tests that a fit from the guess takes fewer iterations and agrees with the cold fit"""
+        realizer = self.realizer
+        image = self.draw_gaussian(0.8, -0.5, 0.4)
+        realizer.hsm_stats.reset()
+        cold = realizer.as_super.estimate_parameters(image, method='hsm')
+        warm = realizer.as_super.estimate_parameters(image, method='hsm', guess={'x': 0.8, 'y': -0.5, 'sigma': 0.4})
+        for key in ['x', 'y', 'trace', 'e1', 'e2']:
+            assert np.isclose(cold[key], warm[key], rtol=0.0, atol=1.e-5)
+        assert np.allclose([warm['x'], warm['y']], [0.8, -0.5], atol=1.e-4)
+        stats = realizer.hsm_stats
+        assert stats.num_fits == 2 and stats.num_warm_starts == 1 and stats.num_failures == 0
+        # The cold fit accounts for most of the iterations
+        warm_iterations = realizer.hsm_stats.num_iterations
+        realizer.hsm_stats.reset()
+        realizer.as_super.estimate_parameters(image, method='hsm')
+        assert realizer.hsm_stats.num_iterations > warm_iterations - realizer.hsm_stats.num_iterations
+
+    def test_fallback(self):
+        """Tests the retry after a failed warm start and the counts of failures"""
+        realizer = self.realizer
+        image = self.draw_gaussian(0.0, 0.0, 0.5)
+        realizer.hsm_stats.reset()
+        # A guess far off the stamp fails, and the fit is retried from the center
+        params = realizer.as_super.estimate_parameters(image, method='hsm', guess={'x': 50.0, 'y': 50.0, 'sigma': 0.01})
+        assert params is not None and np.isclose(params['x'], 0.0, atol=1.e-4)
+        assert realizer.hsm_stats.num_retries == 1 and realizer.hsm_stats.num_failures == 0
+        # Nothing to fit on a blank image
+        blank = galsim.ImageD(realizer.nx, realizer.ny, scale=realizer.pixel_scale)
+        assert realizer.as_super.estimate_parameters(blank, method='hsm', guess={'x': 0.0, 'y': 0.0, 'sigma': 0.5}) is None
+        stats = realizer.hsm_stats.as_dict()
+        assert stats['num_fits'] == 2 and stats['num_failures'] == 1 and stats['failure_rate'] == 0.5
+
+        merged = HSMStats()
+        merged.merge(realizer.hsm_stats)
+        merged.merge(realizer.hsm_stats)
+        assert merged.num_fits == 4 and merged.num_attempts == 2*realizer.hsm_stats.num_attempts
+        assert HSMStats().as_dict()['failure_rate'] is None
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for the per-stage instrumentation
+
+# ======================================================================
+from __future__ import print_function
+import unittest
+import os
+import json
+import pickle
+import shutil
+
+from slrealizer.realize_om10 import OM10Realizer
+from slrealizer.utils.instrumentation import Instrumentation, STAGES
+from slrealizer.benchmarks.synthetic import make_synthetic_catalog, make_synthetic_observation
+# ======================================================================
+
+class InstrumentationTest(unittest.TestCase):
+
+    """
+    Tests the stage events emitted by the realizer to callbacks and JSON-lines sinks.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.output_dir = os.path.join(os.environ['SLREALIZERDIR'], 'tests', 'test_output', 'test_instrumentation')
+        if os.path.exists(cls.output_dir):
+            shutil.rmtree(cls.output_dir)
+        os.makedirs(cls.output_dir)
+        cls.num_lenses, cls.num_visits = 6, 20
+
+    def get_realizer(self):
+        return OM10Realizer(observation=make_synthetic_observation(self.num_visits, seed=2),
+                            catalog=make_synthetic_catalog(self.num_lenses, seed=2))
+
+    def test_pipeline_events(self):
+        """Tests that every stage of a run emits one event with consistent measurements"""
+        realizer = self.get_realizer()
+        events = []
+        realizer.instrumentation.add_callback(events.append)
+        sink = realizer.instrumentation.add_jsonl_sink(os.path.join(self.output_dir, 'events.jsonl'))
+        source_path = os.path.join(self.output_dir, 'source.csv')
+        realizer.make_source_table_vectorized(source_path, include_time_variability=True)
+        realizer.make_object_table(os.path.join(self.output_dir, 'object.csv'), source_table_path=source_path)
+        sink.close()
+
+        num_rows = self.num_lenses*self.num_visits
+        stages = [event['stage'] for event in events]
+        assert stages == ['merge', 'preformat', 'variability', 'noise', 'moments', 'write', 'aggregate', 'write']
+        assert set(stages) == set(STAGES)
+        for event in events:
+            assert event['wall_time'] >= 0.0 and event['cpu_time'] >= 0.0
+            assert event['peak_rss_mb'] is None or event['peak_rss_mb'] > 0.0
+        # Every stage but the object table write processes all source rows
+        assert [event['rows'] for event in events[:-1]] == [num_rows]*7
+        assert events[-1]['rows'] == self.num_lenses
+        assert events[2]['model'] == 'independent'
+        assert events[-1]['method'] == 'make_object_table'
+        with open(sink.path) as f:
+            assert [json.loads(line) for line in f] == events
+
+    def test_disabled(self):
+        """Tests that stages measure nothing without callbacks and that pickling drops the callbacks"""
+        instrumentation = Instrumentation()
+        with instrumentation.stage('write', rows=10) as stage:
+            pass
+        assert stage._timestamp is None
+        with self.assertRaises(ValueError):
+            instrumentation.stage('render')
+        instrumentation.add_callback(lambda event: None)
+        assert not pickle.loads(pickle.dumps(instrumentation)).enabled
+        realizer = self.get_realizer()
+        sink = realizer.instrumentation.add_jsonl_sink(os.path.join(self.output_dir, 'unpicklable.jsonl'))
+        assert not pickle.loads(pickle.dumps(realizer)).instrumentation.enabled
+        sink.close()
+
+if __name__ == '__main__':
+    unittest.main()
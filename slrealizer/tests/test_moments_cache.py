@@ -0,0 +1,124 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for the cache of the moments of the numerical row-by-row methods
+
+# ======================================================================
+from __future__ import print_function
+import unittest
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+from slrealizer.realize_om10 import OM10Realizer
+from slrealizer.utils.moments_cache import MomentsCache, MomentsCacheStats
+from slrealizer.utils.table_io import read_table
+from slrealizer.benchmarks.synthetic import make_synthetic_catalog, make_synthetic_observation
+# ======================================================================
+
+class MomentsCacheTest(unittest.TestCase):
+
+    """
+    Tests the LRU cache itself, and that the cached row-by-row tables agree
+    with the uncached table within the quantization error bounds.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.output_dir = os.path.join(os.environ['SLREALIZERDIR'], 'tests', 'test_output', 'test_moments_cache')
+        if os.path.exists(cls.output_dir):
+            shutil.rmtree(cls.output_dir)
+        os.makedirs(cls.output_dir)
+
+    def get_realizer(self, moments_cache=None, add_noise=True, catalog_seed=11):
+        realizer = OM10Realizer(observation=make_synthetic_observation(40, seed=11),
+                                catalog=make_synthetic_catalog(6, seed=catalog_seed),
+                                add_moment_noise=add_noise, add_flux_noise=add_noise)
+        realizer.moments_cache = moments_cache
+        return realizer
+
+    def make_table(self, name, moments_cache=None, add_noise=True, catalog_seed=11, pixel_scale=None, **kwargs):
+        path = os.path.join(self.output_dir, name + '.parquet')
+        realizer = self.get_realizer(moments_cache, add_noise, catalog_seed)
+        if pixel_scale is not None:
+            realizer.pixel_scale = pixel_scale
+        realizer.make_source_table_rowbyrow(path, method='gaussian_numerical', **kwargs)
+        return read_table(path)
+
+    def test_lru(self):
+        """Tests the eviction order, the copies and the counts"""
+        cache = MomentsCache(fwhm_bin=0.1, max_size=2)
+        render = ('raw_numerical', 0.1, (49, 49))
+        assert cache.get_key(1, 'g', 0.71, *render) == cache.get_key(1, 'g', 0.79, *render) != cache.get_key(1, 'g', 0.81, *render)
+        # The method and the stamp are part of the key
+        assert cache.get_key(1, 'g', 0.71, *render) != cache.get_key(1, 'g', 0.71, 'gaussian_numerical', 0.1, (49, 49))
+        assert cache.get_key(1, 'g', 0.71, *render) != cache.get_key(1, 'g', 0.71, 'raw_numerical', 0.2, (49, 49))
+        assert cache.get_key(1, 'g', 0.71, *render) != cache.get_key(1, 'g', 0.71, 'raw_numerical', 0.1, (25, 25))
+        assert np.isclose(cache.quantize_fwhm(0.71), 0.75)
+        cache.put('a', {'trace': 1.0})
+        cache.put('b', {'trace': 2.0})
+        cache.get('a')['trace'] += 1.0
+        cache.put('c', {'trace': 3.0})
+        # b was the least recently used
+        assert cache.get('b') is None
+        assert cache.get('a') == {'trace': 1.0}
+        stats = cache.stats.as_dict()
+        assert (stats['num_hits'], stats['num_misses'], stats['num_evictions']) == (2, 1, 1)
+        merged = MomentsCacheStats()
+        merged.merge(cache.stats)
+        merged.merge(cache.stats)
+        assert merged.num_hits == 4 and merged.num_evictions == 2
+        assert merged.as_dict()['hit_rate'] == stats['hit_rate']
+        with self.assertRaises(ValueError):
+            MomentsCache(max_size=0)
+
+    def test_exact(self):
+        """Tests that the cache with exact FWHMs gives the uncached table, in series and in parallel"""
+        expected = self.make_table('uncached')
+        cache = MomentsCache(fwhm_bin=0.0)
+        pd.testing.assert_frame_equal(self.make_table('exact', cache, work_unit_size=16), expected, check_exact=False, rtol=1.e-12)
+        assert cache.stats.num_misses == len(expected) and cache.stats.max_trace_error == 0.0
+        cache = MomentsCache(fwhm_bin=0.0)
+        pd.testing.assert_frame_equal(self.make_table('exact_parallel', cache, num_processes=2), expected, check_exact=False, rtol=1.e-12)
+        assert cache.stats.num_hits + cache.stats.num_misses == len(expected)
+
+    def test_quantized(self):
+        """Tests the hits and the error bounds of a quantized cache, on noise-free tables"""
+        expected = self.make_table('uncached_quantized', add_noise=False)
+        cache = MomentsCache(fwhm_bin=0.1, max_size=1000)
+        cached = self.make_table('quantized', cache, add_noise=False, work_unit_size=16)
+        stats = cache.stats.as_dict()
+        assert stats['num_hits'] > 0 and stats['num_hits'] + stats['num_misses'] == len(expected)
+        assert 0.0 < stats['max_fwhm_error'] <= 0.05
+        # The flux and centroid do not depend on the PSF, up to the truncation of the stamp
+        for column in ['apFlux', 'x', 'y']:
+            assert np.allclose(cached[column], expected[column], rtol=5.e-3, atol=5.e-3)
+        assert np.all(np.abs(cached['trace'] - expected['trace']) <= stats['max_trace_error'])
+        for column in ['e1', 'e2']:
+            bound = np.abs(expected[column])*stats['max_relative_trace_error'] + 5.e-3
+            assert np.all(np.abs(cached[column] - expected[column]) <= bound)
+        # The table does not depend on the blocks or on a cache that is already warm,
+        # up to the rounding of the stacked moment calculation
+        pd.testing.assert_frame_equal(self.make_table('quantized_rerun', cache, add_noise=False, work_unit_size=7), cached, check_exact=False, rtol=1.e-12)
+        assert cache.stats.num_misses == 0
+        small_cache = MomentsCache(fwhm_bin=0.1, max_size=3)
+        pd.testing.assert_frame_equal(self.make_table('quantized_small', small_cache, add_noise=False), cached, check_exact=False, rtol=1.e-12)
+        assert small_cache.stats.num_evictions > 0
+
+    def test_reuse(self):
+        """Tests that a warm cache is not reused for another catalog with the same IDs, or another pixel scale"""
+        cache = MomentsCache(fwhm_bin=0.0)
+        self.make_table('reuse_first', cache, add_noise=False)
+        assert len(cache) > 0
+        expected = self.make_table('reuse_expected', add_noise=False, catalog_seed=12)
+        other = self.make_table('reuse_other', cache, add_noise=False, catalog_seed=12)
+        assert cache.stats.num_hits == 0
+        pd.testing.assert_frame_equal(other, expected, check_exact=False, rtol=1.e-12)
+        # Only the entries of the bound catalog are kept
+        assert len(cache) == cache.stats.num_misses
+        expected = self.make_table('reuse_scale_expected', add_noise=False, catalog_seed=12, pixel_scale=0.15)
+        scaled = self.make_table('reuse_scale', cache, add_noise=False, catalog_seed=12, pixel_scale=0.15)
+        assert cache.stats.num_hits == 0
+        pd.testing.assert_frame_equal(scaled, expected, check_exact=False, rtol=1.e-12)
+
+if __name__ == '__main__':
+    unittest.main()
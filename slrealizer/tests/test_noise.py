@@ -0,0 +1,47 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for the counter-based noise
+
+# ======================================================================
+from __future__ import print_function
+import unittest
+import numpy as np
+
+from slrealizer.utils.noise import get_standard_normal, add_keyed_noise
+# ======================================================================
+
+class NoiseTest(unittest.TestCase):
+
+    """
+    Tests that the keyed noise is standard normal and independent of row order.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.seed = 123
+        cls.objectId = np.repeat(np.arange(500), 200)
+        cls.ccdVisitId = np.tile(np.arange(200), 500)
+
+    def test_distribution(self):
+        z = get_standard_normal(self.seed, self.objectId, self.ccdVisitId, quantity='x')
+        assert abs(np.mean(z)) < 0.02
+        assert abs(np.std(z) - 1.0) < 0.02
+        z_other = get_standard_normal(self.seed, self.objectId, self.ccdVisitId, quantity='y')
+        assert abs(np.corrcoef(z, z_other)[0, 1]) < 0.02
+
+    def test_order_independence(self):
+        z = get_standard_normal(self.seed, self.objectId, self.ccdVisitId, quantity='apFlux')
+        perm = np.random.RandomState(0).permutation(len(z))
+        z_perm = get_standard_normal(self.seed, self.objectId[perm], self.ccdVisitId[perm], quantity='apFlux')
+        np.testing.assert_array_equal(z[perm], z_perm)
+        # A single row gets the same draw as in a whole array
+        assert get_standard_normal(self.seed, self.objectId[7], self.ccdVisitId[7], quantity='apFlux') == z[7]
+
+    def test_keys(self):
+        z = get_standard_normal(self.seed, self.objectId, self.ccdVisitId, quantity='x')
+        assert not np.any(z == get_standard_normal(self.seed + 1, self.objectId, self.ccdVisitId, quantity='x'))
+        noise = add_keyed_noise(mean=1.0, stdev=2.0, seed=self.seed, object_id=self.objectId, visit_id=self.ccdVisitId,
+                                quantity='x', measurement=3.0)
+        np.testing.assert_allclose(noise, 3.0*(1.0 + 2.0*z))
+
+if __name__ == '__main__':
+    unittest.main()
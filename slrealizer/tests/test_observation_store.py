@@ -0,0 +1,66 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for the indexed observation store
+
+# ======================================================================
+from __future__ import print_function
+import unittest
+import pickle
+import numpy as np
+
+from slrealizer.utils.observation_store import ObservationStore
+from slrealizer.realize_om10 import OM10Realizer
+from slrealizer.benchmarks.synthetic import make_synthetic_catalog, make_synthetic_observation
+# ======================================================================
+
+class ObservationStoreTest(unittest.TestCase):
+
+    """
+    Tests the lookups of the observation store against scans of the observation DF.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        observation = make_synthetic_observation(50, seed=4, first_id=100)
+        # Unsorted, non-consecutive IDs
+        rng = np.random.RandomState(4)
+        observation['obsHistID'] = rng.permutation(np.arange(100, 300, 4))
+        cls.observation = observation.sample(frac=1.0, random_state=rng).reset_index(drop=True)
+        cls.store = ObservationStore(cls.observation)
+
+    def test_records(self):
+        """Tests that records unpack and index like the rows of the observation DF"""
+        for rownum in [0, 17, 49]:
+            row = self.observation.loc[rownum]
+            record = self.store.get_record(rownum)
+            assert tuple(record) == tuple(row.values)
+            histID, MJD, band, PSF_FWHM, sky_mag = record
+            assert band == row['filter'] == record['filter'] == record[2]
+            assert record.keys() == list(self.observation.columns)
+        records = self.store.get_records([3, 1, 3])
+        assert [tuple(r) for r in records] == [tuple(self.observation.loc[j].values) for j in [3, 1, 3]]
+        assert pickle.loads(pickle.dumps(records[0]))['expMJD'] == records[0][1]
+
+    def test_lookups(self):
+        """Tests the lookups by obsHistID and by MJD range"""
+        obs_ids = self.observation['obsHistID'].values
+        query = np.array([obs_ids[5], 101, obs_ids[0], 10**6])
+        np.testing.assert_array_equal(self.store.find_rows(query), [5, -1, 0, -1])
+        assert self.store.get_record_by_id(obs_ids[9])[0] == obs_ids[9]
+        with self.assertRaises(KeyError):
+            self.store.get_record_by_id(101)
+        mjd = self.observation['expMJD'].values
+        lo, hi = np.percentile(mjd, [20, 60])
+        np.testing.assert_array_equal(self.store.get_rows_in_mjd_range(lo, hi), np.where((mjd >= lo) & (mjd < hi))[0])
+        assert len(self.store.get_rows_in_mjd_range(hi, lo)) == 0
+
+    def test_realizer(self):
+        """Tests that the realizer's store follows its observation history"""
+        realizer = OM10Realizer(observation=self.observation, catalog=make_synthetic_catalog(2, seed=4))
+        obs_id = self.observation['obsHistID'].values[7]
+        assert tuple(realizer.get_obs_info(obsID=obs_id)) == tuple(self.observation.loc[7].values)
+        realizer.observation = self.observation.iloc[::-1].reset_index(drop=True)
+        assert tuple(realizer.get_obs_info(rownum=0)) == tuple(self.observation.loc[49].values)
+        assert pickle.loads(pickle.dumps(realizer))._observation_store is None
+
+if __name__ == '__main__':
+    unittest.main()
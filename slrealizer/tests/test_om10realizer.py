@@ -10,11 +10,8 @@ import shutil
 import pandas as pd
 import numpy as np
 
-import sys
-realizer_path = os.path.join(os.environ['SLREALIZERDIR'], 'slrealizer')
-sys.path.insert(0, realizer_path)
-from realize_om10 import OM10Realizer
-from utils.utils import *
+from slrealizer.realize_om10 import OM10Realizer
+from slrealizer.utils.utils import *
 # ======================================================================
 
 class OM10RealizerTest(unittest.TestCase):
@@ -46,6 +43,7 @@ class OM10RealizerTest(unittest.TestCase):
         'rowbyrow_hsm_numerical_path': os.path.join(output_dir, 'rowbyrow_hsm_num_source.csv'),
         'rowbyrow_raw_numerical_path': os.path.join(output_dir, 'rowbyrow_raw_num_source.csv'),
         'vectorized_path': os.path.join(output_dir, 'vectorized_source.csv'),
+        'chunked_path': os.path.join(output_dir, 'chunked_source.csv'),
         'object_path': os.path.join(output_dir, 'object.csv'),
         }
 
@@ -57,6 +55,7 @@ class OM10RealizerTest(unittest.TestCase):
         test_obs_df = pd.read_csv(input_observation_catalog).query("(filter != 'y')").sample(20, random_state=123).reset_index(drop=True)
         # Instantiate OM10Realizer
         cls.realizer = OM10Realizer(observation=test_obs_df, catalog=test_om10_db, debug=True, add_moment_noise=False, add_flux_noise=False) 
+        cls.test_om10_db, cls.test_obs_df = test_om10_db, test_obs_df
         cls.lens_info = test_om10_db.sample[0]
         cls.obs_info = test_obs_df.loc[0]
 
@@ -81,7 +80,7 @@ class OM10RealizerTest(unittest.TestCase):
         Tests whether create_source_row runs with each of the options 
         for moment calculation method 
         """
-        for m in ["analytical", "hsm", "raw_numerical"]:
+        for m in ["analytical", "hsm", "raw_numerical", "gaussian_numerical"]:
             self.realizer.create_source_row(lens_info=self.lens_info, obs_info=self.obs_info, method=m)
 
     def test_make_source_table_rowbyrow_numerical(self):
@@ -90,7 +89,20 @@ class OM10RealizerTest(unittest.TestCase):
         for moment calculation method, 'hsm' and 'raw_numerical'
         """
         self.realizer.make_source_table_rowbyrow(save_file=self.rowbyrow_raw_numerical_path, method="raw_numerical")
-        self.realizer.make_source_table_rowbyrow(save_file=self.rowbyrow_hsm_numerical_path, method="hsm")
+        hsm = self.realizer.make_source_table_rowbyrow(save_file=self.rowbyrow_hsm_numerical_path, method="hsm")
+        failed = self.realizer.rowbyrow_failed
+        self.assertEqual(failed.shape, (self.realizer.num_obs, self.realizer.num_systems))
+        self.assertEqual(len(hsm), failed.size - failed.sum())
+
+    def test_make_source_table_rowbyrow_parallel(self):
+        """ 
+        Tests whether make_source_table_rowbyrow gives the same table
+        with a process pool as with a serial run
+        """
+        serial = self.realizer.make_source_table_rowbyrow(save_file=self.rowbyrow_raw_numerical_path, method="raw_numerical")
+        parallel = self.realizer.make_source_table_rowbyrow(save_file=self.rowbyrow_raw_numerical_path, method="raw_numerical",
+                                                            num_processes=2, work_unit_size=3)
+        pd.testing.assert_frame_equal(serial, parallel)
 
     def test_make_source_table_analytical(self):
         """ 
@@ -109,6 +121,22 @@ class OM10RealizerTest(unittest.TestCase):
 
         self.assertTrue(np.allclose(rowbyrow_float, vectorized_float, rtol=1e-05, atol=1e-05))
 
+    def test_make_source_table_chunked(self):
+        """ 
+        Tests whether make_source_table_chunked gives the same rows 
+        as make_source_table_vectorized
+        """
+        # With the noise on, the rows only match because it is keyed by (seed, objectId, ccdVisitId),
+        # so that each row gets the same draws in any tile
+        realizer = OM10Realizer(observation=self.test_obs_df, catalog=self.test_om10_db, debug=True)
+        vectorized = realizer.make_source_table_vectorized(output_source_path=self.vectorized_path, include_time_variability=False)
+        chunked = realizer.make_source_table_chunked(output_source_path=self.chunked_path, lens_chunk_size=1, obs_chunk_size=7)
+        
+        vectorized = vectorized.reset_index().sort_values(['objectId', 'ccdVisitId']).reset_index(drop=True)
+        chunked = chunked.reset_index().sort_values(['objectId', 'ccdVisitId']).reset_index(drop=True)
+        pd.testing.assert_frame_equal(vectorized, chunked)
+        self.assertEqual(len(pd.read_csv(self.chunked_path)), len(vectorized))
+
     def test_make_object_table(self):
         """ Tests whether make_object_table runs """
         self.realizer.make_source_table_vectorized(output_source_path=self.vectorized_path, include_time_variability=False)
@@ -0,0 +1,62 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for the process pool of make_source_table_rowbyrow and the copies of the realizers it needs
+
+# ======================================================================
+from __future__ import print_function
+import unittest
+import os
+import copy
+import time
+import shutil
+
+from slrealizer.realize_om10 import OM10Realizer
+from slrealizer.benchmarks.synthetic import make_synthetic_catalog, make_synthetic_observation
+# ======================================================================
+
+class FailingRealizer(OM10Realizer):
+
+    """An OM10Realizer whose first block fails and whose other blocks are slow"""
+
+    def _create_rowbyrow_rows(self, start, stop, method):
+        if start == 0:
+            raise RuntimeError("Failed block")
+        time.sleep(0.5)
+        return OM10Realizer._create_rowbyrow_rows(self, start, stop, method)
+
+class RowByRowPoolTest(unittest.TestCase):
+
+    """
+    Tests the failures of the process pool and the copies of subclassed realizers.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.output_dir = os.path.join(os.environ['SLREALIZERDIR'], 'tests', 'test_output', 'test_rowbyrow_pool')
+        if os.path.exists(cls.output_dir):
+            shutil.rmtree(cls.output_dir)
+        os.makedirs(cls.output_dir)
+
+    def test_worker_failure(self):
+        """Tests that a failed block stops the run without waiting for the queued blocks"""
+        realizer = FailingRealizer(observation=make_synthetic_observation(40, seed=12),
+                                   catalog=make_synthetic_catalog(5, seed=12))
+        start = time.time()
+        with self.assertRaises(RuntimeError):
+            realizer.make_source_table_rowbyrow(os.path.join(self.output_dir, 'source.csv'), method='gaussian_numerical',
+                                                num_processes=2, work_unit_size=5)
+        # The 39 other blocks would take about 10 s in 2 workers
+        assert time.time() - start < 5.0
+
+    def test_copy_subclass(self):
+        """Tests that a copy of a subclass still calls SLRealizer's methods through as_super"""
+        realizer = FailingRealizer(observation=make_synthetic_observation(4, seed=12),
+                                   catalog=make_synthetic_catalog(2, seed=12))
+        copied = copy.copy(realizer)
+        assert copied.as_super.__thisclass__ is OM10Realizer
+        assert copied.as_super.__self__ is copied
+        row = copied.create_source_row(obs_info=copied.get_obs_info(rownum=0),
+                                       lens_info=copied.get_lens_info(rownum=0), method='gaussian_numerical')
+        assert row['objectId'] == copied.get_lens_info(rownum=0)['LENSID']
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,11 +9,8 @@ import shutil
 import pandas as pd
 import numpy as np
 
-import sys
-realizer_path = os.path.join(os.environ['SLREALIZERDIR'], 'slrealizer')
-sys.path.insert(0, realizer_path)
-from realize_sdss import SDSSRealizer
-from utils.utils import *
+from slrealizer.realize_sdss import SDSSRealizer
+from slrealizer.utils.utils import *
 # ======================================================================
 
 class SDSSRealizerTest(unittest.TestCase):
@@ -43,6 +40,7 @@ class SDSSRealizerTest(unittest.TestCase):
         output_paths = {
         'rowbyrow_path': os.path.join(output_dir, 'rowbyrow_source.csv'),
         'vectorized_path': os.path.join(output_dir, 'vectorized_source.csv'),
+        'chunked_path': os.path.join(output_dir, 'chunked_source.csv'),
         'object_path': os.path.join(output_dir, 'object.csv'),
         }
 
@@ -68,6 +66,15 @@ class SDSSRealizerTest(unittest.TestCase):
         """ Tests whether make_source_table_vectorized runs """
         self.realizer.make_source_table_vectorized(save_file=self.vectorized_path)
 
+    def test_make_source_table_chunked(self):
+        """ Tests whether make_source_table_chunked gives the same rows as make_source_table_vectorized """
+        vectorized = self.realizer.make_source_table_vectorized(save_file=self.vectorized_path)
+        chunked = self.realizer.make_source_table_chunked(output_source_path=self.chunked_path, lens_chunk_size=1, obs_chunk_size=7)
+        
+        vectorized = vectorized.reset_index().sort_values(['objectId', 'ccdVisitId']).reset_index(drop=True)
+        chunked = chunked.reset_index().sort_values(['objectId', 'ccdVisitId']).reset_index(drop=True)
+        pd.testing.assert_frame_equal(vectorized, chunked)
+
     def test_make_object_table(self):
         """ Tests whether make_object_table runs """
         self.realizer.make_source_table_vectorized(save_file=self.vectorized_path)
@@ -0,0 +1,78 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for the sharded runs
+
+# ======================================================================
+from __future__ import print_function
+import unittest
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+from slrealizer.realize_om10 import OM10Realizer
+from slrealizer.utils.table_io import read_table
+from slrealizer.utils.shard import parse_shard, get_shard_indices, get_shard_path
+from slrealizer.benchmarks.synthetic import make_synthetic_catalog, make_synthetic_observation
+# ======================================================================
+
+class ShardTest(unittest.TestCase):
+
+    """
+    Tests that the sharded runs give the outputs of an unsharded run, whatever the number of shards.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.output_dir = os.path.join(os.environ['SLREALIZERDIR'], 'tests', 'test_output', 'test_shard')
+        if os.path.exists(cls.output_dir):
+            shutil.rmtree(cls.output_dir)
+        os.makedirs(cls.output_dir)
+        # Parquet stores doubles exactly, so that the tables can be compared bit for bit
+        realizer = cls.get_realizer()
+        cls.source_path = os.path.join(cls.output_dir, 'source.parquet')
+        cls.object_path = os.path.join(cls.output_dir, 'object.parquet')
+        realizer.make_source_table_vectorized(cls.source_path, include_time_variability=True)
+        realizer.make_object_table(cls.object_path, source_table_path=cls.source_path, include_std=True)
+
+    @staticmethod
+    def get_realizer():
+        return OM10Realizer(observation=make_synthetic_observation(30, seed=6),
+                            catalog=make_synthetic_catalog(9, seed=6))
+
+    def test_shard_indices(self):
+        """Tests the assignment of systems to shards and the shard specifications"""
+        object_ids = np.arange(100, 1100)
+        for method in ['hash', 'range']:
+            shards = get_shard_indices(object_ids, 8, method=method)
+            assert shards.min() == 0 and shards.max() == 7
+            assert np.bincount(shards).min() > 80
+            np.testing.assert_array_equal(get_shard_indices(object_ids[::-1], 8, method=method), shards[::-1])
+        np.testing.assert_array_equal(get_shard_indices(object_ids, 4, method='range'), np.repeat(np.arange(4), 250))
+        assert parse_shard('3/16') == (3, 16)
+        for spec in ['16/16', '3', 'a/b', '0/0']:
+            with self.assertRaises(ValueError):
+                parse_shard(spec)
+        assert get_shard_path('data/source.csv.gz', 3, 16) == 'data/source.shard0003of0016.csv.gz'
+
+    def test_merge(self):
+        """Tests that the shards add up to the source and object tables of the unsharded run"""
+        expected_source = read_table(self.source_path).sort_values(['objectId', 'ccdVisitId']).reset_index(drop=True)
+        expected_object = read_table(self.object_path, dtype={})
+        # More shards than systems leaves some shards empty
+        for method, num_shards in [('hash', 1), ('hash', 4), ('range', 3), ('hash', 20)]:
+            source_path = os.path.join(self.output_dir, '%s_%d_source.parquet' %(method, num_shards))
+            state_path = os.path.join(self.output_dir, '%s_%d_state.parquet' %(method, num_shards))
+            object_path = os.path.join(self.output_dir, '%s_%d_object.parquet' %(method, num_shards))
+            realizer = self.get_realizer()
+            for shard_index in range(num_shards):
+                realizer.make_source_table_shard(shard_index, num_shards, source_path, state_path,
+                                                 include_time_variability=True, shard_by=method)
+            realizer.merge_object_table_shards(num_shards, object_path, state_path, include_std=True)
+            src = pd.concat([read_table(get_shard_path(source_path, shard_index, num_shards))
+                             for shard_index in range(num_shards)])
+            pd.testing.assert_frame_equal(src.sort_values(['objectId', 'ccdVisitId']).reset_index(drop=True),
+                                          expected_source, check_exact=True)
+            pd.testing.assert_frame_equal(read_table(object_path, dtype={}), expected_object, check_exact=True)
+
+if __name__ == '__main__':
+    unittest.main()
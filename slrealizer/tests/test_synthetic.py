@@ -0,0 +1,61 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for the synthetic benchmark inputs
+
+# ======================================================================
+from __future__ import print_function
+import unittest
+import json
+import numpy as np
+
+from slrealizer.benchmarks.synthetic import make_synthetic_catalog, make_synthetic_observation, OBSERVATION_COLUMNS
+from slrealizer.benchmarks.throughput import run, ROWBYROW_METHODS, _measure_into
+from slrealizer.utils.catalog_cache import get_om10_catalog_table
+# ======================================================================
+
+class SyntheticInputTest(unittest.TestCase):
+
+    """
+    Tests that the synthetic catalog and observation history have the schema of the real inputs.
+    """
+
+    def test_catalog(self):
+        """Tests the columns of the flattened OM10 sample and the images of doubles"""
+        catalog = make_synthetic_catalog(500, seed=1)
+        table = catalog.table
+        assert len(catalog) == 500
+        assert set(table.columns) == set(get_om10_catalog_table(catalog.sample).columns)
+        assert table['LENSID'].is_unique
+        doubles = table['NIMG'].values == 2
+        for mc in ['MAG', 'XIMG', 'YIMG', 'DELAY']:
+            assert np.all(table.loc[doubles, [mc + '_2', mc + '_3']].values == 0.0)
+        assert np.all(table['DELAY_0'].values == 0.0)
+        # Same seed, same catalog
+        assert table.equals(make_synthetic_catalog(500, seed=1).table)
+
+    def test_observation(self):
+        """Tests the columns, order and bands of the observation history"""
+        observation = make_synthetic_observation(1000, seed=1)
+        assert list(observation.columns) == OBSERVATION_COLUMNS
+        assert observation['obsHistID'].is_unique
+        assert np.all(np.diff(observation['expMJD'].values) >= 0.0)
+        assert set(observation['filter'].unique()) <= set('ugriz')
+        with_pointings = make_synthetic_observation(1000, seed=1, include_pointings=True)
+        assert np.all(np.abs(with_pointings['fieldDec'].values) <= 0.5*np.pi)
+
+    def test_throughput(self):
+        """Tests that every benchmark runs on small inputs, and that a failing benchmark is recorded"""
+        results = run(num_lenses=3, num_visits=6, rowbyrow_num_lenses=2, rowbyrow_num_visits=3, trace_memory=False)
+        benchmarks = results['benchmarks']
+        for method in ROWBYROW_METHODS:
+            assert 'make_source_table_rowbyrow_' + method in benchmarks
+        for name, result in benchmarks.items():
+            assert 'error' not in result, (name, result)
+            assert result['seconds'] >= 0.0 and result['rows'] > 0
+        json.dumps(results)
+        def fail():
+            raise RuntimeError("failed benchmark")
+        _measure_into(benchmarks, 'failing', fail, 10)
+        assert benchmarks['failing']['error'] == 'RuntimeError: failed benchmark'
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for the table format layer
+
+# ======================================================================
+from __future__ import print_function
+import unittest
+import os
+import shutil
+import pandas as pd
+import numpy as np
+
+from slrealizer.utils.table_io import read_table, iter_table, write_table, append_table, open_table_writer, get_table_format
+from slrealizer.utils.table_io import get_source_table_dtypes, FILTER_DTYPE, SOURCE_FLOAT_COLUMNS
+from slrealizer.realize_om10 import OM10Realizer
+from slrealizer.benchmarks.synthetic import make_synthetic_catalog, make_synthetic_observation
+# ======================================================================
+
+class TableIOTest(unittest.TestCase):
+
+    """
+    Tests writing and reading source tables in each table format.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.output_dir = os.path.join(os.environ['SLREALIZERDIR'], 'tests', 'test_output', 'test_table_io')
+        if os.path.exists(cls.output_dir):
+            shutil.rmtree(cls.output_dir)
+        os.makedirs(cls.output_dir)
+        
+        num_rows = 30
+        cls.src = pd.DataFrame({'objectId': np.repeat([3, 1, 2], 10),
+                                'ccdVisitId': np.tile(np.arange(10), 3),
+                                'MJD': np.linspace(59580.0, 59600.0, num_rows),
+                                'filter': np.tile(list('ugriz'), 6),
+                                'apFlux': np.linspace(1.0, 2.0, num_rows)})
+        cls.src.set_index('objectId', inplace=True)
+        # Tables are read back with a categorical filter
+        cls.expected = cls.src.reset_index().astype({'filter': FILTER_DTYPE})
+
+    def test_get_table_format(self):
+        """ Tests whether formats are inferred from the extension """
+        self.assertEqual(get_table_format('src.csv').name, 'csv')
+        self.assertEqual(get_table_format('src.parquet').name, 'parquet')
+        self.assertEqual(get_table_format('src.feather').name, 'feather')
+        self.assertEqual(get_table_format('src.csv.gz').name, 'csv')
+        self.assertEqual(get_table_format('src.txt').name, 'csv')
+        self.assertEqual(get_table_format('src.txt', table_format='parquet').name, 'parquet')
+        with self.assertRaises(ValueError):
+            get_table_format('src.csv', table_format='hdf5')
+
+    def test_round_trip(self):
+        """ Tests whether each format reads back what it wrote, with column projection """
+        for ext in ['csv', 'csv.gz', 'parquet', 'feather']:
+            path = os.path.join(self.output_dir, 'src.' + ext)
+            write_table(self.src, path)
+            out = read_table(path)
+            pd.testing.assert_frame_equal(out[['objectId', 'ccdVisitId', 'MJD', 'filter', 'apFlux']], 
+                                          self.expected)
+            if ext == 'csv.gz':
+                with open(path, 'rb') as f:
+                    self.assertEqual(f.read(2), b'\x1f\x8b')
+            projected = read_table(path, columns=['objectId', 'apFlux'])
+            self.assertEqual(sorted(projected.columns), ['apFlux', 'objectId'])
+
+    def test_chunked_writer(self):
+        """ Tests whether appending chunks gives the same table as one write """
+        for ext in ['csv', 'csv.gz', 'parquet', 'feather']:
+            path = os.path.join(self.output_dir, 'src_chunked.' + ext)
+            writer = open_table_writer(path)
+            for start in range(0, len(self.src), 7):
+                writer.write(self.src.iloc[start:start + 7])
+            writer.close()
+            self.assertEqual(writer.num_rows, len(self.src))
+            pd.testing.assert_frame_equal(read_table(path), self.expected)
+
+    def test_iter_table(self):
+        """ Tests whether reading in chunks gives back the whole table """
+        for ext in ['csv', 'csv.gz', 'parquet', 'feather']:
+            path = os.path.join(self.output_dir, 'src_iter.' + ext)
+            write_table(self.src, path)
+            chunks = list(iter_table(path, chunk_size=8, columns=['objectId', 'filter', 'apFlux']))
+            self.assertTrue(all(len(chunk) <= 8 for chunk in chunks))
+            pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True),
+                                          self.expected[['objectId', 'filter', 'apFlux']])
+
+    def test_append_table(self):
+        """ Tests whether appending rows to an existing table gives the same table as one write """
+        for ext in ['csv', 'csv.gz', 'parquet', 'feather']:
+            path = os.path.join(self.output_dir, 'src_appended.' + ext)
+            write_table(self.src.iloc[:12], path)
+            append_table(self.src.iloc[12:20], path)
+            # Columns are matched by name
+            append_table(self.src.iloc[20:][['apFlux', 'MJD', 'filter', 'ccdVisitId']], path)
+            pd.testing.assert_frame_equal(read_table(path), self.expected)
+
+    def test_compact_schema(self):
+        """ Tests the compact dtypes of the source table schema in each format """
+        self.assertEqual(get_source_table_dtypes(max_id=2**31 - 1)['objectId'], np.int32)
+        self.assertEqual(get_source_table_dtypes(max_id=2**31)['objectId'], np.int64)
+        self.assertEqual(get_source_table_dtypes()['ccdVisitId'], np.int64)
+        dtype = get_source_table_dtypes(max_id=100, use_float32=True)
+        self.assertEqual(dtype['MJD'], np.float64)
+        for ext in ['csv', 'csv.gz', 'parquet', 'feather']:
+            path = os.path.join(self.output_dir, 'src_compact.' + ext)
+            write_table(self.src, path, dtype=dtype)
+            out = read_table(path, dtype=dtype)
+            self.assertEqual(out['filter'].dtype, FILTER_DTYPE)
+            self.assertEqual(out['objectId'].dtype, np.int32)
+            self.assertEqual(out['apFlux'].dtype, np.float32)
+            self.assertEqual(out['MJD'].dtype, np.float64)
+        with self.assertRaises(ValueError):
+            write_table(self.src.assign(filter='w'), os.path.join(self.output_dir, 'src_bad.csv'))
+
+    def test_float32_accuracy(self):
+        """
+        Checks the float32 source table against the float64 one: every measured quantity
+        must be the float64 value rounded to single precision, i.e. within a relative
+        error of 2**-24 ~ 6e-8, and the other columns must be identical
+        """
+        tables = {}
+        for use_float32 in [False, True]:
+            realizer = OM10Realizer(observation=make_synthetic_observation(50, seed=3),
+                                    catalog=make_synthetic_catalog(20, seed=3), debug=True)
+            realizer.use_float32 = use_float32
+            path = os.path.join(self.output_dir, 'src_float%d.parquet' %(32 if use_float32 else 64))
+            realizer.make_source_table_vectorized(path, include_time_variability=True)
+            tables[use_float32] = read_table(path, dtype=realizer.get_source_dtypes())
+        full, single = tables[False], tables[True]
+        for col in ['MJD', 'ccdVisitId', 'objectId', 'filter']:
+            pd.testing.assert_series_equal(full[col], single[col])
+        for col in SOURCE_FLOAT_COLUMNS:
+            self.assertEqual(single[col].dtype, np.float32)
+            np.testing.assert_array_equal(single[col].values, full[col].values.astype(np.float32))
+            np.testing.assert_allclose(single[col].values, full[col].values, rtol=2.0**-24, atol=0.0)
+
+if __name__ == '__main__':
+    unittest.main()
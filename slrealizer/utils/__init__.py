@@ -1,2 +1,2 @@
-from constants import *
-from utils import *
+from .constants import *
+from .utils import *
@@ -0,0 +1,170 @@
+"""
+Streaming aggregation of source table rows into object table columns.
+
+Per-(objectId, filter) running counts, means and sums of squared deviations (M2)
+are updated one chunk of the source table at a time with the parallel form of
+Welford's algorithm (Chan et al. 1979), so that the memory used grows with
+the number of objects rather than with the number of source table rows.
+"""
+
+import numpy as np
+import pandas as pd
+from .table_io import read_table, write_table
+
+def _to_object_filter(state):
+    """Returns state with the filter level of its index as plain strings, so that states of categorical and string filters can be combined"""
+    filters = state.index.levels[1]
+    if isinstance(filters, pd.CategoricalIndex):
+        state.index = state.index.set_levels(filters.astype(object), level=1)
+    return state
+
+class ObjectAggregator(object):
+
+    """
+    Accumulates the mean and standard deviation of each property
+    of each object in each filter over chunks of source table rows.
+    Two aggregators over disjoint sets of rows can be merged into one.
+
+    """
+
+    def __init__(self, properties):
+        """
+        Keyword arguments:
+        properties -- list of the source table columns to aggregate, e.g. ['x', 'y', 'apFlux']
+        """
+        self.properties = list(properties)
+        # Running state, indexed by (objectId, filter), with the columns
+        # count_<p>, mean_<p> and m2_<p> for each property p
+        self.state = None
+
+    def _get_state_columns(self):
+        return [stat + '_' + p for stat in ['count', 'mean', 'm2'] for p in self.properties]
+
+    def _combine(self, other_state):
+        """Merges the running state other_state into self.state"""
+        if self.state is None:
+            self.state = other_state
+            return
+        index = self.state.index.union(other_state.index)
+        a = self.state.reindex(index)
+        b = other_state.reindex(index)
+        combined = {}
+        for p in self.properties:
+            count_a = a['count_' + p].fillna(0.0).values
+            count_b = b['count_' + p].fillna(0.0).values
+            mean_a = a['mean_' + p].fillna(0.0).values
+            mean_b = b['mean_' + p].fillna(0.0).values
+            count = count_a + count_b
+            with np.errstate(invalid='ignore', divide='ignore'):
+                frac_b = np.where(count > 0.0, count_b/count, 0.0)
+            delta = mean_b - mean_a
+            combined['count_' + p] = count
+            combined['mean_' + p] = mean_a + delta*frac_b
+            combined['m2_' + p] = a['m2_' + p].fillna(0.0).values + b['m2_' + p].fillna(0.0).values\
+                                  + delta*delta*count_a*frac_b
+        self.state = pd.DataFrame(combined, index=index, columns=self._get_state_columns())
+
+    def update(self, src):
+        """
+        Adds the rows of a chunk of the source table
+
+        Keyword arguments:
+        src -- a Pandas DF with the columns objectId, filter and self.properties
+               (objectId may also be the index)
+        """
+        if src.index.name == 'objectId':
+            src = src.reset_index()
+        if len(src) == 0:
+            return
+        # Statistics are accumulated in double precision whatever the dtypes of the source table,
+        # and only the bands that occur in the chunk form groups if filter is categorical
+        grouped = src[self.properties].astype(np.float64)\
+                                      .groupby([src['objectId'], src['filter']], sort=False, observed=True)
+        counts = grouped.count()
+        means = grouped.mean()
+        # Sum of squared deviations from the chunk mean, skipping missing values
+        m2 = grouped.var(ddof=0)*counts
+        chunk_state = pd.concat([counts.add_prefix('count_').astype(np.float64),
+                                 means.add_prefix('mean_'),
+                                 m2.fillna(0.0).add_prefix('m2_')], axis=1)
+        self._combine(_to_object_filter(chunk_state[self._get_state_columns()]))
+
+    def merge(self, other):
+        """Adds the state of another ObjectAggregator over a disjoint set of rows"""
+        if other.state is not None:
+            self._combine(other.state[self._get_state_columns()])
+
+    def save(self, path, table_format=None):
+        """
+        Persists the running state, e.g. to update the object table
+        with new visits later (see SLRealizer.append_visits)
+
+        Keyword arguments:
+        path -- save path of the state table
+        table_format -- name of the format; if None, inferred from path [default: None]
+        """
+        state = self.state
+        if state is None:
+            # No rows yet, e.g. a shard without systems
+            index = pd.MultiIndex.from_arrays([np.array([], dtype=np.int64), np.array([], dtype=object)],
+                                              names=['objectId', 'filter'])
+            state = pd.DataFrame(columns=self._get_state_columns(), index=index, dtype=np.float64)
+        write_table(state, path, table_format=table_format, index=True)
+
+    @classmethod
+    def load(cls, path, table_format=None):
+        """
+        Returns an ObjectAggregator with the running state saved at path
+
+        Keyword arguments: see save
+        """
+        state = read_table(path, table_format=table_format)
+        state.set_index(['objectId', 'filter'], inplace=True)
+        state = _to_object_filter(state)
+        properties = [c[len('count_'):] for c in state.columns if c.startswith('count_')]
+        aggregator = cls(properties)
+        if len(state) > 0:
+            aggregator.state = state[aggregator._get_state_columns()].astype(np.float64)
+        return aggregator
+
+    def to_object_table(self, include_std=False, reference_band='r'):
+        """
+        Returns the object table, with one row per object and the columns {band}_{property}
+        (and {band}_{property}-std if include_std) in the order of the original pivot-based builder.
+        Objects missing any value are dropped and the x, y columns are made relative to reference_band.
+
+        Keyword arguments:
+        include_std -- whether to include the sample standard deviation columns [default: False]
+        reference_band -- band relative to which x and y are given [default: 'r']
+        """
+        state = self.state.sort_index()
+        counts = state[['count_' + p for p in self.properties]].values
+        means = pd.DataFrame(state[['mean_' + p for p in self.properties]].values,
+                             index=state.index, columns=self.properties).where(counts >= 1.0)
+        # Sample standard deviation, NaN for fewer than 2 epochs as in Pandas
+        with np.errstate(invalid='ignore', divide='ignore'):
+            stds = np.sqrt(state[['m2_' + p for p in self.properties]].values/(counts - 1.0))
+        stds = pd.DataFrame(stds, index=state.index, columns=self.properties).where(counts >= 2.0)
+
+        def _to_wide(df):
+            # unstack orders the rows by the order of the objectId level, which depends on
+            # the chunks the state was built from, so the rows are sorted by objectId
+            wide = df.unstack('filter').sort_index()
+            wide = wide[sorted(wide.columns)]
+            wide.columns = wide.columns.map('{0[1]}_{0[0]}'.format)
+            return wide
+
+        obj = _to_wide(means)
+        if include_std:
+            obj = obj.join(_to_wide(stds), lsuffix='', rsuffix='-std')
+        # Drop examples with missing values
+        obj.dropna(how='any', inplace=True)
+        # Get x, y values relative to the reference band
+        bands = sorted(set(c.split('_', 1)[0] for c in obj.columns))
+        for p in ['x', 'y']:
+            if p not in self.properties:
+                continue
+            reference = obj[reference_band + '_' + p].copy()
+            for b in bands:
+                obj[b + '_' + p] = obj[b + '_' + p] - reference
+        return obj
@@ -0,0 +1,172 @@
+"""
+Array kernel for the analytically computed moments of lensed quasar systems.
+
+The quantities that depend only on the lens (the lens covariance, image positions
+and per-band fluxes) and only on the visit (the PSF size and the flux error) are
+computed once, and each (lens, visit) pair of the source table is realized by
+gathering them with integer row indices. The moments are then evaluated with
+in-place numpy operations on a few preallocated arrays, instead of materializing
+one Pandas column per intermediate quantity of the cross join.
+"""
+
+import numpy as np
+from .utils import hlr_to_sigma, flux_to_mag
+
+BANDS = 'ugriz'
+NUM_IMAGES = 4
+
+def get_band_index(filters):
+    """
+    Returns the index in BANDS of each filter name in filters
+    """
+    filters = np.asarray(filters).astype(str)
+    band_index = np.full(len(filters), -1, dtype=np.int64)
+    for i, b in enumerate(BANDS):
+        band_index[filters == b] = i
+    if np.any(band_index < 0):
+        raise ValueError("Filters must be one of %s." %', '.join(BANDS))
+    return band_index
+
+def get_lens_covariance(e, beta, hlr=1.0):
+    """
+    Returns the second moments Ixx, Iyy, Ixy of the lens light profile
+
+    Keyword arguments:
+    e -- array of the lens ellipticities
+    beta -- array of the lens position angles in degrees
+    hlr -- half-light radius of the lens in arcsec [default: 1.0]
+    """
+    minor_to_major = np.power((1.0 - e)/(1.0 + e), 0.5) # q parameter in galsim.shear
+    beta = np.radians(beta) # beta parameter in galsim.shear
+    sigmasq_lens = np.power(hlr_to_sigma(hlr), 2.0)
+    lam1 = sigmasq_lens/minor_to_major
+    lam2 = sigmasq_lens*minor_to_major
+    cos_beta, sin_beta = np.cos(beta), np.sin(beta)
+    lens_Ixx = lam1*np.power(cos_beta, 2.0) + lam2*np.power(sin_beta, 2.0)
+    lens_Iyy = lam1*np.power(sin_beta, 2.0) + lam2*np.power(cos_beta, 2.0)
+    lens_Ixy = (lam1 - lam2)*cos_beta*sin_beta
+    return lens_Ixx, lens_Iyy, lens_Ixy
+
+def get_image_mags(q_mag, magnification, num_images):
+    """
+    Returns the magnitudes of the quasar images, of shape (num_lenses, num_bands, NUM_IMAGES),
+    with np.inf for the images beyond num_images of each lens
+
+    Keyword arguments:
+    q_mag -- array of shape (num_lenses, num_bands) of the unlensed quasar magnitudes
+    magnification -- array of shape (num_lenses, NUM_IMAGES) of the image magnifications
+    num_images -- array of the number of images of each lens
+    """
+    with np.errstate(divide='ignore'):
+        image_mag = q_mag[:, :, None] + flux_to_mag(np.abs(magnification))[:, None, :]
+    missing = np.arange(NUM_IMAGES)[None, :] >= np.asarray(num_images)[:, None]
+    image_mag[np.broadcast_to(missing[:, None, :], image_mag.shape)] = np.inf
+    return image_mag
+
+def get_blended_moments(lens_flux, q_flux, x_img, y_img, lens_Ixx, lens_Iyy, lens_Ixy, sigmasq_psf,
+                        x_noise=None, y_noise=None, trace_noise=None):
+    """
+    Returns the flux and the first and second moments of the blend of the lens and quasar images,
+    one value per row of the inputs
+
+    Keyword arguments:
+    lens_flux -- array of shape (N,) of the lens fluxes
+    q_flux -- array of shape (N, NUM_IMAGES) of the image fluxes (zero for missing images)
+    x_img, y_img -- arrays of shape (N, NUM_IMAGES) of the image positions relative to the lens
+    lens_Ixx, lens_Iyy, lens_Ixy -- arrays of shape (N,) of the lens second moments
+    sigmasq_psf -- array of shape (N,) of the squared PSF sigmas
+    x_noise, y_noise, trace_noise -- arrays of shape (N,) of the fractional noise
+                                     of x, y and the trace, or None for no noise [default: None]
+
+    Returns:
+    a dictionary of the arrays apFlux, x, y, Ixx, Iyy, Ixy, trace, e1 and e2
+    """
+    num_rows = len(lens_flux)
+    ap_flux = np.array(q_flux[:, 0], dtype=np.float64)
+    for q in range(1, NUM_IMAGES):
+        ap_flux += q_flux[:, q]
+    ap_flux += lens_flux
+
+    # Flux ratios (for weighted moments)
+    ratio = np.empty(num_rows)
+    tmp = np.empty(num_rows)
+    x = np.zeros(num_rows)
+    y = np.zeros(num_rows)
+    for q in range(NUM_IMAGES):
+        np.divide(q_flux[:, q], ap_flux, out=ratio)
+        x += np.multiply(ratio, x_img[:, q], out=tmp)
+        y += np.multiply(ratio, y_img[:, q], out=tmp)
+    if x_noise is not None:
+        x += np.multiply(x, x_noise, out=tmp)
+    if y_noise is not None:
+        y += np.multiply(y, y_noise, out=tmp)
+
+    # Lens contributions
+    np.divide(lens_flux, ap_flux, out=ratio)
+    Ixx = np.multiply(x, x)
+    Ixx += lens_Ixx
+    Ixx *= ratio
+    Iyy = np.multiply(y, y)
+    Iyy += lens_Iyy
+    Iyy *= ratio
+    # The lens is at the origin, so its offset from the centroid is (-x, -y)
+    Ixy = np.multiply(x, y)
+    Ixy += lens_Ixy
+    Ixy *= ratio
+    # Quasar contributions
+    dx = np.empty(num_rows)
+    dy = np.empty(num_rows)
+    for q in range(NUM_IMAGES):
+        np.divide(q_flux[:, q], ap_flux, out=ratio)
+        np.subtract(x_img[:, q], x, out=dx)
+        np.subtract(y_img[:, q], y, out=dy)
+        Ixx += np.multiply(ratio, np.multiply(dx, dx, out=tmp), out=tmp)
+        Iyy += np.multiply(ratio, np.multiply(dy, dy, out=tmp), out=tmp)
+        np.multiply(ratio, dx, out=tmp)
+        Ixy += np.multiply(tmp, dy, out=tmp)
+    # PSF
+    Ixx += sigmasq_psf
+    Iyy += sigmasq_psf
+
+    # Trace and ellipticities
+    trace = Ixx + Iyy
+    if trace_noise is not None:
+        trace += np.multiply(trace, trace_noise, out=tmp)
+    e1 = np.subtract(Ixx, Iyy, out=dx)
+    e1 /= trace
+    e2 = np.multiply(Ixy, 2.0, out=dy)
+    e2 /= trace
+    return {'apFlux': ap_flux, 'x': x, 'y': y, 'Ixx': Ixx, 'Iyy': Iyy, 'Ixy': Ixy,
+            'trace': trace, 'e1': e1, 'e2': e2}
+
+def add_moment_noise(noiseless, x_noise=None, y_noise=None, trace_noise=None):
+    """
+    Returns the moments that get_blended_moments gives with the fractional noise
+    x_noise, y_noise, trace_noise, computed from its noise-free output instead of the images.
+    The second moments are quadratic in the noisy centroid (x, y) = (x0 + dx, y0 + dy):
+        Ixx = Ixx0 + dx^2, Iyy = Iyy0 + dy^2, Ixy = Ixy0 + dx dy,
+    so that the results agree with get_blended_moments up to rounding.
+
+    Keyword arguments:
+    noiseless -- a dictionary of the arrays apFlux, x, y, Ixx, Iyy, Ixy of get_blended_moments without noise
+    x_noise, y_noise, trace_noise -- see get_blended_moments
+
+    Returns:
+    a dictionary of the arrays apFlux, x, y, Ixx, Iyy, Ixy, trace, e1 and e2
+    """
+    x0, y0 = noiseless['x'], noiseless['y']
+    Ixx = np.array(noiseless['Ixx'], dtype=np.float64)
+    Iyy = np.array(noiseless['Iyy'], dtype=np.float64)
+    Ixy = np.array(noiseless['Ixy'], dtype=np.float64)
+    dx = np.zeros(len(x0)) if x_noise is None else np.multiply(x0, x_noise)
+    dy = np.zeros(len(y0)) if y_noise is None else np.multiply(y0, y_noise)
+    x = x0 + dx
+    y = y0 + dy
+    Ixx += dx*dx
+    Iyy += dy*dy
+    Ixy += dx*dy
+    trace = Ixx + Iyy
+    if trace_noise is not None:
+        trace += trace*trace_noise
+    return {'apFlux': np.array(noiseless['apFlux'], dtype=np.float64), 'x': x, 'y': y,
+            'Ixx': Ixx, 'Iyy': Iyy, 'Ixy': Ixy, 'trace': trace, 'e1': (Ixx - Iyy)/trace, 'e2': 2.0*Ixy/trace}
@@ -0,0 +1,148 @@
+"""
+Persistent, content-addressed cache of the flattened OM10 lens catalog.
+
+Loading the OM10 FITS catalog, selecting a random sample and painting colors
+onto it is the slowest part of starting a run. The flattened per-lens table
+(one column per quasar image for MAG, XIMG, YIMG and DELAY) is therefore saved
+in an uncompressed Feather file named after a hash of the catalog file contents
+and of the selection and paint parameters, and memory-mapped by later runs
+with the same inputs instead of being recomputed.
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from .utils import get_1D_columns
+from .table_io import write_table, _import_pyarrow
+
+# Bump to invalidate existing cache files when the layout of the cached table changes
+CACHE_VERSION = 1
+MULTIDIM_COLUMNS = ['MAG', 'XIMG', 'YIMG', 'DELAY']
+
+def get_file_hash(path, block_size=1 << 20):
+    """
+    Returns the SHA-256 hex digest of the contents of the file at path
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def get_catalog_cache_key(catalog_path, select_params=None, paint_params=None, seed=None):
+    """
+    Returns the cache key of the catalog sample obtained with the given inputs
+
+    Keyword arguments: see load_om10_catalog
+    """
+    inputs = {'version': CACHE_VERSION,
+              'catalog': get_file_hash(catalog_path),
+              'select': select_params,
+              'paint': paint_params,
+              'seed': seed}
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+def get_om10_catalog_table(sample):
+    """
+    Converts the Astropy table underlying an OM10 DB into a Pandas DF with one row per lens,
+    with the multi-dimensional MAG, XIMG, YIMG, DELAY columns flattened
+    into one column per quasar image
+    """
+    lensMagCols = [b + '_SDSS_lens' for b in 'ugriz']
+    qMagCols = [b + '_SDSS_quasar' for b in 'ugriz']
+    saveCols = lensMagCols + qMagCols + ['REFF_T', 'NIMG', 'LENSID', 'ELLIP', 'PHIE']
+    saveColDict = dict((c, np.asarray(sample[c])) for c in saveCols)
+    saveColDict.update(get_1D_columns(multidimColNames=MULTIDIM_COLUMNS, table=sample))
+    # FITS columns are big-endian, which Pandas does not support
+    for c, values in saveColDict.items():
+        saveColDict[c] = values.astype(values.dtype.newbyteorder('='))
+    collapsedCols = [mc + '_%d' %c for mc in MULTIDIM_COLUMNS for c in range(4)]
+    catalog = pd.DataFrame(saveColDict, columns=saveCols + collapsedCols)
+    catalog.drop_duplicates('LENSID', inplace=True)
+    catalog.reset_index(drop=True, inplace=True)
+    return catalog
+
+class CachedCatalog(object):
+
+    """
+    Stand-in for an OM10 DB whose sample was loaded from the catalog cache.
+    OM10Realizer uses the flattened table directly; the Astropy sample with
+    the multi-dimensional columns is only rebuilt if a code path asks for it,
+    e.g. row-by-row rendering.
+
+    """
+
+    def __init__(self, table):
+        """
+        Keyword arguments:
+        table -- the flattened per-lens Pandas DF, as returned by get_om10_catalog_table
+        """
+        self.table = table
+        self._sample = None
+
+    def __len__(self):
+        return len(self.table)
+
+    @property
+    def sample(self):
+        if self._sample is None:
+            from astropy.table import Table
+            collapsedCols = [mc + '_%d' %c for mc in MULTIDIM_COLUMNS for c in range(4)]
+            sample = Table.from_pandas(self.table.drop(collapsedCols, axis=1))
+            for mc in MULTIDIM_COLUMNS:
+                sample[mc] = self.table[[mc + '_%d' %c for c in range(4)]].values
+            self._sample = sample
+        return self._sample
+
+def _read_mapped(path):
+    """Reads an uncompressed Feather file through a memory map, so that unchanged pages are shared between runs"""
+    pa = _import_pyarrow()
+    reader = pa.ipc.open_file(pa.memory_map(path, 'r'))
+    return reader.read_all().to_pandas(split_blocks=True)
+
+def load_om10_catalog(catalog_path, cache_dir, select_params=None, paint_params=None, seed=None, overwrite=False):
+    """
+    Returns the flattened OM10 sample for the given inputs as a CachedCatalog,
+    from the cache if it has been computed before, and saves it to the cache otherwise
+
+    Keyword arguments:
+    catalog_path -- path of the OM10 FITS catalog
+    cache_dir -- directory of the cache files
+    select_params -- dictionary of the keyword arguments of DB.select_random, e.g.
+                     {'maglim': 23.3, 'area': 100.0, 'IQ': 0.75}, or None for no selection [default: None]
+    paint_params -- dictionary of the keyword arguments of DB.paint, e.g.
+                    {'synthetic': True}, or None for no painting [default: None]
+    seed -- if not None, NumPy's global random state is seeded with it before selecting and painting,
+            so that the cached sample is reproducible. A random selection or painting without a seed
+            is a fresh draw on every call, so it is neither read from nor saved to the cache. [default: None]
+    overwrite -- whether to recompute the sample even if it is in the cache [default: False]
+    """
+    use_cache = seed is not None or (select_params is None and paint_params is None)
+    key = get_catalog_cache_key(catalog_path, select_params=select_params, paint_params=paint_params, seed=seed)
+    cache_path = os.path.join(cache_dir, 'om10_%s.feather' %key)
+    if use_cache and os.path.exists(cache_path) and not overwrite:
+        print("Reading the cached OM10 catalog at %s" %cache_path)
+        return CachedCatalog(_read_mapped(cache_path))
+
+    from om10 import DB
+    if seed is not None:
+        np.random.seed(seed)
+    db = DB(catalog=catalog_path)
+    if select_params is not None:
+        db.select_random(**select_params)
+    if paint_params is not None:
+        db.paint(**paint_params)
+    table = get_om10_catalog_table(db.sample)
+    if not use_cache:
+        return CachedCatalog(table)
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # Write to a temporary file first, so that an interrupted run never leaves a partial cache file
+    tmp_path = cache_path + '.tmp'
+    write_table(table, tmp_path, table_format='feather', index=False, compression='uncompressed')
+    os.rename(tmp_path, cache_path)
+    print("Saved the OM10 catalog to the cache at %s" %cache_path)
+    return CachedCatalog(table)
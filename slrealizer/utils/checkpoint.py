@@ -0,0 +1,108 @@
+"""
+Checkpoints of long source table runs, which can be resumed after an interruption.
+
+A run is split into work units (e.g. blocks of row-by-row work units, or tiles of the chunked path).
+Each completed unit is committed to the checkpoint directory as a part file,
+and then recorded in the manifest, manifest.json; both are written to a temporary
+file that is renamed into place, which is atomic on POSIX, so that a run interrupted
+at any point leaves only fully committed units behind. A restarted run with the same
+configuration skips the units in the manifest and realizes the others. As the noise
+is keyed by (seed, objectId, ccdVisitId), the resumed table is the same as the table
+of an uninterrupted run.
+
+Parts are pickled DataFrames, which preserve the values and dtypes exactly.
+They are only meant to be read back by the same installation, to finish the run.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import json
+import shutil
+import pandas as pd
+
+class Checkpoint(object):
+
+    """
+    Manifest and part files of the completed work units of one run
+
+    """
+
+    manifest_name = 'manifest.json'
+
+    def __init__(self, directory, config):
+        """
+        Keyword arguments:
+        directory -- checkpoint directory of the run, created if needed
+        config -- JSON-serializable dictionary describing the run, e.g. its method, seed and unit size.
+                  Resuming a checkpoint made with another configuration raises a ValueError,
+                  as its units would not fit together.
+        """
+        self.directory = directory
+        # Round trip through JSON, so that it compares equal to the saved configuration
+        self.config = json.loads(json.dumps(config, sort_keys=True))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        manifest_path = os.path.join(directory, self.manifest_name)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            if manifest['config'] != self.config:
+                raise ValueError("The checkpoint at %s was made by a run with another configuration: %s. "
+                                 "Remove it to start over." %(directory, manifest['config']))
+            self.units = manifest['units']
+        else:
+            self.units = {}
+
+    @staticmethod
+    def _get_key(unit):
+        return '-'.join(str(u) for u in unit) if isinstance(unit, tuple) else str(unit)
+
+    def _get_part_path(self, key, name):
+        return os.path.join(self.directory, '%s_%s.pkl' %(name, key))
+
+    def _write_atomic(self, path, write):
+        """Calls write(tmp_path) and renames tmp_path into path"""
+        tmp_path = path + '.tmp'
+        write(tmp_path)
+        os.rename(tmp_path, path)
+
+    def is_done(self, unit):
+        """Returns whether the work unit unit (an integer or a tuple of integers) has been committed"""
+        return self._get_key(unit) in self.units
+
+    def commit(self, unit, tables, info=None):
+        """
+        Saves the outputs of a completed work unit and records it in the manifest
+
+        Keyword arguments:
+        unit -- the work unit, an integer or a tuple of integers
+        tables -- dictionary of the Pandas DFs produced by the unit, e.g. {'source': src}
+        info -- JSON-serializable dictionary of other outputs of the unit [default: None]
+        """
+        key = self._get_key(unit)
+        for name, df in tables.items():
+            self._write_atomic(self._get_part_path(key, name), lambda path: df.to_pickle(path))
+        self.units[key] = {'tables': sorted(tables), 'info': info}
+        manifest = {'config': self.config, 'units': self.units}
+        def write_manifest(path):
+            with open(path, 'w') as f:
+                json.dump(manifest, f, sort_keys=True)
+        self._write_atomic(os.path.join(self.directory, self.manifest_name), write_manifest)
+
+    def get_info(self, unit):
+        """Returns the info dictionary committed with unit"""
+        return self.units[self._get_key(unit)]['info']
+
+    def read(self, unit, name):
+        """Returns the table name of unit, or None if the unit did not produce one"""
+        key = self._get_key(unit)
+        if name not in self.units[key]['tables']:
+            return None
+        return pd.read_pickle(self._get_part_path(key, name))
+
+    def remove(self):
+        """Deletes the checkpoint directory, e.g. once the final table is saved"""
+        shutil.rmtree(self.directory)
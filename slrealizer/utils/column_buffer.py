@@ -0,0 +1,67 @@
+"""
+Preallocated, typed column storage for building a table one row at a time.
+"""
+
+import numpy as np
+import pandas as pd
+
+class ColumnBuffer(object):
+
+    """
+    Holds one preallocated NumPy array per column and fills them row by row,
+    so that building a table of N rows costs O(N) instead of the O(N^2)
+    of repeated DataFrame.append calls. Rows that could not be computed
+    (e.g. HSM failures) are left out of the table and recorded in a boolean mask.
+
+    """
+
+    def __init__(self, columns, num_rows, dtypes=None):
+        """
+        Keyword arguments:
+        columns -- list of the column names, in output order
+        num_rows -- number of row slots to preallocate
+        dtypes -- dictionary of column dtypes. Columns not in dtypes are float64.
+                  Categorical columns are filled as objects and converted in to_dataframe. [default: None]
+        """
+        if dtypes is None:
+            dtypes = {}
+        self.columns = list(columns)
+        self.num_rows = num_rows
+        self.arrays = {}
+        self.categorical_dtypes = {}
+        for col in self.columns:
+            dt = dtypes.get(col, np.float64)
+            if isinstance(dt, pd.api.types.CategoricalDtype):
+                self.categorical_dtypes[col] = dt
+                dt = object
+            dt = np.dtype(dt)
+            if dt.kind == 'f':
+                self.arrays[col] = np.full(num_rows, np.nan, dtype=dt)
+            else:
+                self.arrays[col] = np.zeros(num_rows, dtype=dt)
+        # Whether each slot holds a successfully computed row
+        self.is_filled = np.zeros(num_rows, dtype=bool)
+
+    def set_row(self, idx, row):
+        """
+        Writes the values of the dictionary row into slot idx.
+        Keys that are not columns are ignored and columns missing from row are left empty.
+        If row is None, the slot is recorded as failed.
+        """
+        if row is None:
+            self.is_filled[idx] = False
+            return
+        for col, value in row.items():
+            if col in self.arrays:
+                self.arrays[col][idx] = value
+        self.is_filled[idx] = True
+
+    def to_dataframe(self):
+        """Returns a Pandas DF of the filled rows, built in one go"""
+        if self.is_filled.all():
+            df = pd.DataFrame(self.arrays, columns=self.columns)
+        else:
+            df = pd.DataFrame(dict((col, arr[self.is_filled]) for col, arr in self.arrays.items()), columns=self.columns)
+        if self.categorical_dtypes:
+            df = df.astype(self.categorical_dtypes)
+        return df
@@ -0,0 +1,205 @@
+"""
+Damped random walk (DRW) model of quasar variability (MacLeod et al. 2010)
+evaluated on flat, sorted arrays of observation times.
+
+Light curves of many (object, band) pairs are stored back to back in one array,
+sorted by segment and then by time. The DRW recurrence
+
+    m_i = a_i m_{i-1} + MU (1 - a_i) + eps_i,  a_i = exp(-dt_i/TAU)
+
+is solved for all segments at once in time and memory linear in the number of rows,
+without pivoting the light curves into a dense objects x times matrix.
+
+Light curves that must be sampled at shifted times, e.g. the time-delayed images
+of a lensed quasar, are evaluated on the nodes of a fine regular grid that bracket
+the query times and linearly interpolated (see get_grid_nodes).
+"""
+
+import numpy as np
+import pandas as pd
+
+# Largest time span (in units of TAU) over which the solver accumulates
+# exp(+dt/TAU) weights before re-anchoring, well below float64 overflow
+_MAX_ANCHOR_SPAN = 300.0
+
+def get_segment_starts(*keys):
+    """
+    Returns a boolean array that is True at the first row of each segment,
+    where a segment is a run of rows with identical values in all the key arrays
+
+    Keyword arguments:
+    keys -- one or more arrays of equal length, e.g. objectId and filter,
+            already sorted so that each segment is contiguous
+    """
+    num_rows = len(keys[0])
+    is_start = np.zeros(num_rows, dtype=bool)
+    if num_rows == 0:
+        return is_start
+    is_start[0] = True
+    for k in keys:
+        k = np.asarray(k)
+        is_start[1:] |= (k[1:] != k[:-1])
+    return is_start
+
+def get_drw_step_params(times, is_start, tau, sf_inf, mu=0.0, start_d_time=None):
+    """
+    Returns the decay factor a_i, the mean increment MU*(1 - a_i)
+    and the noise scale of each step of the DRW recurrence
+
+    Keyword arguments:
+    times -- sorted observation times in days
+    is_start -- boolean array that is True at the first row of each segment
+    tau -- damping time scale in days
+    sf_inf -- structure function at infinity in mag
+    mu -- mean magnitude offset of the walk [default: 0.0]
+    start_d_time -- time elapsed before the first row of each segment, one per segment,
+                    for walks continued from an earlier epoch. NaN (or None for all segments)
+                    means the walk starts at the first row. [default: None]
+    """
+    times = np.asarray(times, dtype=np.float64)
+    d_time = np.empty_like(times)
+    d_time[0:1] = 0.0
+    d_time[1:] = times[1:] - times[:-1]
+    if start_d_time is None:
+        d_time[is_start] = 0.0
+    else:
+        d_time[is_start] = np.nan_to_num(np.asarray(start_d_time, dtype=np.float64))
+    d_time = np.clip(d_time, a_min=0.0, a_max=None)
+    decay = np.exp(-d_time/tau)
+    mean_step = mu*(1.0 - decay)
+    scale = 0.5*sf_inf**2.0*(1.0 - np.exp(-2.0*d_time/tau))
+    return decay, mean_step, scale
+
+def solve_segmented_recurrence(times, is_start, increments, tau, initial=None):
+    """
+    Solves x_i = exp(-(t_i - t_{i-1})/tau) x_{i-1} + c_i within each segment,
+    with x equal to c (plus initial, if given) at the first row of each segment.
+
+    Uses x_i = sum_{j <= i} c_j exp(-(t_i - t_j)/tau), with the exponentials
+    anchored at the start of runs no longer than _MAX_ANCHOR_SPAN*tau
+    and the value at the end of each run carried into the next.
+
+    Keyword arguments:
+    times -- sorted observation times in days
+    is_start -- boolean array that is True at the first row of each segment
+    increments -- the c_i, one per row
+    tau -- damping time scale in days
+    initial -- value of x before the first row of each segment, one per segment.
+               If None, the walks start from zero. [default: None]
+
+    Returns:
+    an array of the x_i
+    """
+    times = np.asarray(times, dtype=np.float64)
+    increments = np.asarray(increments, dtype=np.float64)
+    num_rows = len(times)
+    if num_rows == 0:
+        return np.zeros(0)
+
+    segment_id = np.cumsum(is_start) - 1
+    segment_first_row = np.flatnonzero(is_start)
+    # Time elapsed since the start of the segment, in units of tau
+    elapsed = (times - times[segment_first_row][segment_id])/tau
+    # Split segments into runs short enough for exp(elapsed) not to overflow
+    run_rank = np.floor(elapsed/_MAX_ANCHOR_SPAN).astype(np.int64)
+    is_run_start = is_start.copy()
+    is_run_start[1:] |= (run_rank[1:] != run_rank[:-1])
+    run_id = np.cumsum(is_run_start) - 1
+    run_first_row = np.flatnonzero(is_run_start)
+    run_last_row = np.append(run_first_row[1:] - 1, num_rows - 1)
+
+    # Weighted cumulative sum within each run, anchored at the run's first time
+    anchored = elapsed - elapsed[run_first_row][run_id]
+    weighted = pd.Series(increments*np.exp(anchored)).groupby(run_id).cumsum().values
+
+    # Carry the value of x at the end of each run into the next run of the segment.
+    # Segments rarely span more than one run, so this loop is short.
+    num_runs = len(run_first_row)
+    run_segment = segment_id[run_first_row]
+    carry = np.zeros(num_runs) # x just before the run, decayed to the run's anchor time
+    if initial is not None:
+        is_first_run = is_start[run_first_row]
+        carry[is_first_run] = np.asarray(initial, dtype=np.float64)[run_segment[is_first_run]]
+    run_end_value = np.exp(-anchored[run_last_row])*weighted[run_last_row]
+    continues = np.flatnonzero(~is_start[run_first_row])
+    if len(continues) > 0:
+        run_rank_in_segment = np.arange(num_runs) - np.flatnonzero(is_start[run_first_row])[run_segment]
+        for r in range(1, run_rank_in_segment.max() + 1):
+            this_rank = np.flatnonzero(run_rank_in_segment == r)
+            prev = this_rank - 1
+            prev_end = np.exp(-anchored[run_last_row[prev]])*carry[prev] + run_end_value[prev]
+            gap = (times[run_first_row[this_rank]] - times[run_last_row[prev]])/tau
+            carry[this_rank] = np.exp(-gap)*prev_end
+
+    return np.exp(-anchored)*(carry[run_id] + weighted)
+
+def simulate_drw(times, is_start, tau, sf_inf, mu=0.0, standard_normal=None, initial=None, initial_times=None):
+    """
+    Draws DRW light curves (in mag, relative to the mean magnitude)
+    for all segments of the flat, sorted times array.
+    The first epoch of each segment is set to initial (zero by default),
+    or, if initial_times is given, takes one step of the walk from initial.
+
+    Keyword arguments:
+    times -- sorted observation times in days
+    is_start -- boolean array that is True at the first row of each segment
+    tau -- damping time scale in days
+    sf_inf -- structure function at infinity in mag
+    mu -- mean magnitude offset of the walk [default: 0.0]
+    standard_normal -- standard normal draws, one per row.
+                       If None, drawn from np.random. [default: None]
+    initial -- value of the walk just before the first row of each segment, one per segment.
+               If None, the walks start from zero. [default: None]
+    initial_times -- time of the initial values, one per segment, to continue
+                     light curves whose last epoch was at initial_times.
+                     Segments with NaN initial_times start afresh. [default: None]
+
+    Returns:
+    an array of the intrinsic magnitude variations
+    """
+    start_d_time = None
+    if initial_times is not None:
+        start_d_time = np.asarray(times, dtype=np.float64)[is_start] - np.asarray(initial_times, dtype=np.float64)
+    decay, mean_step, scale = get_drw_step_params(times, is_start, tau=tau, sf_inf=sf_inf, mu=mu, start_d_time=start_d_time)
+    if standard_normal is None:
+        standard_normal = np.random.normal(size=len(decay))
+    increments = mean_step + scale*standard_normal
+    if initial is not None:
+        initial = np.nan_to_num(np.asarray(initial, dtype=np.float64))
+        if initial_times is not None:
+            # Decay the last value of each walk to the first new epoch
+            initial = initial*decay[is_start]
+    return solve_segmented_recurrence(times, is_start, increments, tau=tau, initial=initial)
+
+def get_grid_nodes(segment_id, times, grid_step):
+    """
+    Returns the nodes of a regular time grid of spacing grid_step (node k at time k*grid_step)
+    that bracket each of the query times, without duplicates, and where each query
+    falls between them. Only the nodes next to a query are kept, so the cost
+    does not depend on grid_step or on the time span of the light curves.
+
+    Keyword arguments:
+    segment_id -- non-negative integer light curve of each query time
+    times -- query times in days
+    grid_step -- spacing of the grid in days
+
+    Returns:
+    node_segment -- light curve of each node, sorted by light curve and then by time
+    node_index -- grid index k of each node
+    lower -- position in the node arrays of the node just before each query time
+             (the node just after it is at lower + 1)
+    frac -- position of each query time between the two nodes, in [0, 1)
+    """
+    segment_id = np.asarray(segment_id, dtype=np.int64)
+    scaled_times = np.asarray(times, dtype=np.float64)/grid_step
+    k = np.floor(scaled_times).astype(np.int64)
+    frac = scaled_times - k
+    k_min = k.min() if len(k) > 0 else 0
+    # Unique integer key of each (segment, node), leaving room for the node after the last
+    span = (k.max() - k_min + 2) if len(k) > 0 else 2
+    key = segment_id*span + (k - k_min)
+    node_key = np.unique(np.concatenate([key, key + 1]))
+    lower = np.searchsorted(node_key, key)
+    node_segment = node_key//span
+    node_index = node_key%span + k_min
+    return node_segment, node_index, lower, frac
@@ -0,0 +1,86 @@
+"""
+Matching of systems on the sky to the fields of view of the visits in which they are observed.
+
+Rather than assuming that every system is observed in every visit,
+the unit vectors of the systems are indexed with a KD-tree and queried once
+per distinct pointing of the observation history, so that the cost scales with
+the number of overlapping (system, visit) pairs rather than with their product.
+"""
+
+import numpy as np
+from .noise import get_uniform
+
+def radec_to_xyz(ra, dec):
+    """
+    Returns the unit vectors, of shape (N, 3), of the sky positions ra, dec in degrees
+    """
+    ra = np.radians(np.atleast_1d(np.asarray(ra, dtype=np.float64)))
+    dec = np.radians(np.atleast_1d(np.asarray(dec, dtype=np.float64)))
+    cos_dec = np.cos(dec)
+    return np.column_stack([cos_dec*np.cos(ra), cos_dec*np.sin(ra), np.sin(dec)])
+
+def get_uniform_sky_positions(seed, object_ids, ra_range=(0.0, 360.0), dec_range=(-90.0, 90.0)):
+    """
+    Returns sky positions drawn uniformly (per unit solid angle) over the given RA, Dec box.
+    The position of each system is keyed by its ID, so it does not depend on the catalog order.
+
+    Keyword arguments:
+    seed -- integer seed of the run
+    object_ids -- array of the IDs of the systems
+    ra_range -- (min, max) of RA in degrees [default: (0.0, 360.0)]
+    dec_range -- (min, max) of Dec in degrees [default: (-90.0, 90.0)]
+
+    Returns:
+    a tuple of the RA and Dec arrays in degrees
+    """
+    object_ids = np.asarray(object_ids)
+    u_ra = get_uniform(seed, object_ids, 0, quantity='ra')
+    u_dec = get_uniform(seed, object_ids, 0, quantity='dec')
+    ra = ra_range[0] + u_ra*(ra_range[1] - ra_range[0])
+    sin_dec_min, sin_dec_max = np.sin(np.radians(dec_range[0])), np.sin(np.radians(dec_range[1]))
+    dec = np.degrees(np.arcsin(sin_dec_min + u_dec*(sin_dec_max - sin_dec_min)))
+    return ra, dec
+
+def get_overlapping_pairs(system_ra, system_dec, field_ra, field_dec, fov_radius=1.75):
+    """
+    Returns the (visit, system) pairs in which the system lies within
+    fov_radius of the pointing of the visit
+
+    Keyword arguments:
+    system_ra, system_dec -- arrays of the sky positions of the systems in degrees
+    field_ra, field_dec -- arrays of the pointings of the visits in degrees
+                           (OpSim v3 stores them in radians; convert with np.degrees)
+    fov_radius -- radius of the field of view in degrees [default: 1.75]
+
+    Returns:
+    a tuple of the row numbers of the visits and of the systems of each pair,
+    sorted by visit and then by system
+    """
+    from scipy.spatial import cKDTree
+
+    field_ra = np.asarray(field_ra, dtype=np.float64)
+    field_dec = np.asarray(field_dec, dtype=np.float64)
+    # Visits of the same field share one query
+    pointings, visit_pointing = np.unique(np.column_stack([field_ra, field_dec]), axis=0, return_inverse=True)
+    visit_pointing = np.asarray(visit_pointing).ravel()
+
+    tree = cKDTree(radec_to_xyz(system_ra, system_dec))
+    chord = 2.0*np.sin(0.5*np.radians(fov_radius))
+    systems_in_pointing = tree.query_ball_point(radec_to_xyz(pointings[:, 0], pointings[:, 1]), r=chord)
+    num_systems_in_pointing = np.array([len(s) for s in systems_in_pointing], dtype=np.int64)
+    if num_systems_in_pointing.sum() == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    pair_pointing = np.repeat(np.arange(len(pointings)), num_systems_in_pointing)
+    pair_system = np.concatenate([np.asarray(s, dtype=np.int64) for s in systems_in_pointing])
+
+    # Expand each (pointing, system) pair into one pair per visit of the pointing
+    visits_by_pointing = np.argsort(visit_pointing, kind='mergesort')
+    num_visits = np.bincount(visit_pointing, minlength=len(pointings))
+    first_visit = np.cumsum(num_visits) - num_visits
+    repeats = num_visits[pair_pointing]
+    system_rows = np.repeat(pair_system, repeats)
+    offsets = np.arange(repeats.sum()) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+    visit_rows = visits_by_pointing[np.repeat(first_visit[pair_pointing], repeats) + offsets]
+
+    order = np.lexsort((system_rows, visit_rows))
+    return visit_rows[order], system_rows[order]
@@ -0,0 +1,113 @@
+"""
+FFT-free rendering of lens systems whose components are all Gaussian.
+
+A Gaussian lens galaxy plus point-source quasar images, convolved with a Gaussian PSF,
+is a sum of elliptical Gaussians with closed-form covariances, so whole stacks of
+stamps can be evaluated directly on the pixel grid with NumPy instead of
+drawing each one with galsim.Convolve.
+"""
+
+import numpy as np
+from .utils import hlr_to_sigma, fwhm_to_sigma
+
+def get_pixel_grid(nx, ny, pixel_scale):
+    """
+    Returns the x (length nx) and y (length ny) coordinates, in arcsec,
+    of the pixel centers of an ny x nx stamp centered on the origin,
+    following GalSim's convention that array rows run along y
+    """
+    x = (np.arange(nx) - 0.5*(nx - 1))*pixel_scale
+    y = (np.arange(ny) - 0.5*(ny - 1))*pixel_scale
+    return x, y
+
+def get_sheared_covariance(sigma, e, beta):
+    """
+    Returns Ixx, Ixy, Iyy of a round Gaussian of width sigma
+    sheared with distortion e at position angle beta (in radians),
+    as in galsim.Gaussian(sigma=sigma).shear(e=e, beta=beta)
+    """
+    minor_to_major = np.sqrt((1.0 - e)/(1.0 + e))
+    lam1 = sigma**2.0/minor_to_major
+    lam2 = sigma**2.0*minor_to_major
+    cos_beta, sin_beta = np.cos(beta), np.sin(beta)
+    Ixx = lam1*cos_beta**2.0 + lam2*sin_beta**2.0
+    Iyy = lam1*sin_beta**2.0 + lam2*cos_beta**2.0
+    Ixy = (lam1 - lam2)*cos_beta*sin_beta
+    return Ixx, Ixy, Iyy
+
+def add_gaussian_stamps(stamps, flux, x0, y0, Ixx, Ixy, Iyy, x, y, pixel_scale):
+    """
+    Adds a stack of elliptical Gaussians, sampled at the pixel centers,
+    to the stack of stamps of shape (N, ny, nx) in place.
+    The x and y factors are evaluated separately, so only the
+    x-y cross term of tilted Gaussians costs one exp per pixel.
+
+    Keyword arguments:
+    stamps -- array of shape (N, ny, nx) to add to
+    flux, x0, y0, Ixx, Ixy, Iyy -- arrays of shape (N,) with the flux, centroid (arcsec)
+                                   and covariance (arcsec^2) of each Gaussian
+    x, y -- pixel center coordinates from get_pixel_grid
+    pixel_scale -- arcsec/pixel
+    """
+    det = Ixx*Iyy - Ixy**2.0
+    norm = flux*pixel_scale**2.0/(2.0*np.pi*np.sqrt(det))
+    dx = x[None, :] - x0[:, None] # shape (N, nx)
+    dy = y[None, :] - y0[:, None] # shape (N, ny)
+    # exp(-0.5 r^T I^-1 r) = exp(-a dx^2) exp(-c dy^2) exp(b dx dy)
+    a = (0.5*Iyy/det)[:, None]
+    c = (0.5*Ixx/det)[:, None]
+    x_factor = np.exp(-a*dx*dx)
+    y_factor = norm[:, None]*np.exp(-c*dy*dy)
+    profile = y_factor[:, :, None]*x_factor[:, None, :]
+    if np.any(Ixy != 0.0):
+        b = (Ixy/det)[:, None, None]
+        profile *= np.exp(b*dy[:, :, None]*dx[:, None, :])
+    stamps += profile
+    return stamps
+
+def draw_gaussian_systems(lens_flux, lens_hlr, lens_e, lens_beta, q_flux, q_x, q_y, psf_fwhm,
+                          nx, ny, pixel_scale, pixel_integration=True):
+    """
+    Renders a stack of lens systems, each made of a sheared Gaussian lens galaxy
+    and up to 4 point-source quasar images, convolved with a Gaussian PSF.
+
+    Keyword arguments:
+    lens_flux, lens_hlr, lens_e, lens_beta -- arrays of shape (N,) with the flux, half-light radius (arcsec),
+                                              distortion and position angle (radians) of the lens galaxy
+    q_flux, q_x, q_y -- arrays of shape (N, num_images) with the flux and position (arcsec) of
+                        the quasar images. Missing images should have zero flux.
+    psf_fwhm -- array of shape (N,) with the FWHM of the PSF (arcsec)
+    nx, ny -- stamp size in pixels
+    pixel_scale -- arcsec/pixel
+    pixel_integration -- whether to account for the pixel response, as GalSim's default
+                         drawImage method does. The pixel box is approximated by a Gaussian
+                         of the same second moments (pixel_scale^2/12 per axis), which keeps the
+                         flux, centroid and second moments of the stamp exact. [default: True]
+
+    Returns:
+    an array of shape (N, ny, nx) of pixel values in flux units
+    """
+    lens_flux = np.atleast_1d(np.asarray(lens_flux, dtype=np.float64))
+    q_flux = np.atleast_2d(np.asarray(q_flux, dtype=np.float64))
+    q_x = np.atleast_2d(np.asarray(q_x, dtype=np.float64))
+    q_y = np.atleast_2d(np.asarray(q_y, dtype=np.float64))
+    num_systems = len(lens_flux)
+    x, y = get_pixel_grid(nx, ny, pixel_scale)
+    stamps = np.zeros((num_systems, ny, nx))
+
+    # Variance added to every component by the PSF (and the pixel)
+    sigmasq_psf = fwhm_to_sigma(np.atleast_1d(np.asarray(psf_fwhm, dtype=np.float64)))**2.0
+    if pixel_integration:
+        sigmasq_psf = sigmasq_psf + pixel_scale**2.0/12.0
+    zeros = np.zeros(num_systems)
+
+    # Lens galaxy
+    Ixx, Ixy, Iyy = get_sheared_covariance(hlr_to_sigma(np.atleast_1d(lens_hlr)),
+                                           np.atleast_1d(lens_e), np.atleast_1d(lens_beta))
+    add_gaussian_stamps(stamps, lens_flux, zeros, zeros, Ixx + sigmasq_psf, Ixy, Iyy + sigmasq_psf,
+                        x, y, pixel_scale)
+    # Quasar images, which are the PSF itself
+    for q in range(q_flux.shape[1]):
+        add_gaussian_stamps(stamps, q_flux[:, q], q_x[:, q], q_y[:, q], sigmasq_psf, zeros, sigmasq_psf,
+                            x, y, pixel_scale)
+    return stamps
@@ -0,0 +1,61 @@
+"""
+Counters of the HSM adaptive moment fits of the row-by-row realization.
+
+Each fit (see SLRealizer.estimate_parameters with method="hsm") makes one or more
+attempts at GalSim's FindAdaptiveMom: first from the analytical centroid and size
+of the image, if known, then from the fallback guesses. HSMStats counts the fits,
+the attempts, the iterations of the adaptive moment loop and the failures,
+so that the warm start can be checked to save iterations and failures.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+class HSMStats(object):
+
+    """
+    Running counts of HSM fits, which can be merged across worker processes
+
+    """
+
+    _COUNTS = ['num_fits', 'num_attempts', 'num_retries', 'num_failures', 'num_iterations', 'num_warm_starts']
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        for name in self._COUNTS:
+            setattr(self, name, 0)
+
+    def record(self, iterations, attempts, success, warm_start):
+        """
+        Adds one fit
+
+        Keyword arguments:
+        iterations -- total number of iterations of its attempts
+        attempts -- number of attempts made
+        success -- whether an attempt converged
+        warm_start -- whether the first attempt started from the analytical guess
+        """
+        self.num_fits += 1
+        self.num_attempts += attempts
+        self.num_retries += attempts - 1
+        self.num_failures += int(not success)
+        self.num_iterations += iterations
+        self.num_warm_starts += int(warm_start)
+
+    def merge(self, other):
+        """Adds the counts of another HSMStats, e.g. of a worker process"""
+        for name in self._COUNTS:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def as_dict(self):
+        """Returns the counts with the failure rate and the mean iterations per fit (None without fits)"""
+        stats = dict((name, getattr(self, name)) for name in self._COUNTS)
+        stats['failure_rate'] = self.num_failures/self.num_fits if self.num_fits else None
+        stats['iterations_per_fit'] = self.num_iterations/self.num_fits if self.num_fits else None
+        return stats
+
+    def __repr__(self):
+        return 'HSMStats(%s)' %', '.join('%s=%s' %(k, v) for k, v in sorted(self.as_dict().items()))
@@ -0,0 +1,172 @@
+"""
+Per-stage instrumentation of the realization pipeline.
+
+The realizers wrap each stage of their work in Instrumentation.stage,
+one of STAGES, which emits an event dictionary to every registered callback:
+
+    stage            -- name of the stage, e.g. 'moments'
+    wall_time        -- elapsed wall-clock time in seconds
+    cpu_time         -- CPU time of the process in seconds
+    rows             -- number of source table rows processed (None if not applicable)
+    rows_per_second  -- rows/wall_time (None if rows is None)
+    peak_rss_mb      -- peak resident set size of the process so far in MB
+                        (None where the resource module is unavailable, e.g. on Windows)
+    timestamp        -- Unix time at the start of the stage
+
+plus any context given to the stage, e.g. the calling method.
+No event is emitted, and nothing is measured, while no callback is registered.
+
+Example:
+    realizer.instrumentation.add_callback(print_event)
+    sink = realizer.instrumentation.add_jsonl_sink('events.jsonl')
+    realizer.make_source_table_vectorized(...)
+    sink.close()
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import json
+import time
+
+STAGES = ['preformat', 'merge', 'variability', 'moments', 'noise', 'write', 'aggregate']
+_EVENT_KEYS = ['stage', 'wall_time', 'cpu_time', 'rows', 'rows_per_second', 'peak_rss_mb', 'timestamp']
+
+# time.process_time is Python 3.3+
+_cpu_time = getattr(time, 'process_time', None) or time.clock
+
+def get_peak_rss_mb():
+    """Returns the peak resident set size of this process in MB, or None if it cannot be measured"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return peak/1.e6
+    return peak/1.e3
+
+def print_event(event):
+    """Callback that prints a one-line summary of the event"""
+    context = ', '.join('%s=%s' %(k, event[k]) for k in sorted(event) if k not in _EVENT_KEYS)
+    rows = '' if event['rows'] is None else ' %d row(s), %0.0f rows/s,' %(event['rows'], event['rows_per_second'] or 0.0)
+    peak = 'n/a' if event['peak_rss_mb'] is None else '%0.1f MB' %event['peak_rss_mb']
+    print("[%s]%s %0.3f s wall, %0.3f s CPU, peak RSS %s%s" %(event['stage'], rows, event['wall_time'], event['cpu_time'],
+                                                              peak, ' (%s)' %context if context else ''))
+
+class JSONLinesSink(object):
+
+    """
+    Callback that appends each event as one line of JSON to a file
+
+    """
+
+    def __init__(self, path):
+        """
+        Keyword arguments:
+        path -- path of the JSON-lines file, appended to if it exists
+        """
+        self.path = path
+        self._file = open(path, 'a')
+
+    def __call__(self, event):
+        self._file.write(json.dumps(event, sort_keys=True) + '\n')
+        # Flush so that the events of a long run can be followed, or survive a crash
+        self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+class _Stage(object):
+
+    """
+    Context manager that measures one stage and emits its event on a clean exit.
+    The number of rows can be set on it inside the block, once it is known.
+
+    """
+
+    def __init__(self, instrumentation, name, rows, context):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.rows = rows
+        self.context = context
+        self._timestamp = None
+
+    def __enter__(self):
+        if self.instrumentation.enabled:
+            self._timestamp = time.time()
+            self._cpu_start = _cpu_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None or self._timestamp is None or not self.instrumentation.enabled:
+            return False
+        wall_time = time.time() - self._timestamp
+        rows = None if self.rows is None else int(self.rows)
+        event = {'stage': self.name,
+                 'wall_time': wall_time,
+                 'cpu_time': _cpu_time() - self._cpu_start,
+                 'rows': rows,
+                 'rows_per_second': rows/wall_time if rows is not None and wall_time > 0.0 else None,
+                 'peak_rss_mb': get_peak_rss_mb(),
+                 'timestamp': self._timestamp}
+        event.update(self.context)
+        self.instrumentation.emit(event)
+        return False
+
+class Instrumentation(object):
+
+    """
+    Registry of the callbacks that receive the stage events of a realizer.
+    Callbacks are not carried over when the realizer is pickled,
+    e.g. to worker processes, so only the parent process emits events.
+
+    """
+
+    def __init__(self):
+        self.callbacks = []
+
+    @property
+    def enabled(self):
+        return len(self.callbacks) > 0
+
+    def add_callback(self, callback):
+        """
+        Registers callback, a function that takes the event dictionary, and returns it
+        """
+        self.callbacks.append(callback)
+        return callback
+
+    def remove_callback(self, callback):
+        self.callbacks.remove(callback)
+
+    def add_jsonl_sink(self, path):
+        """
+        Registers a JSONLinesSink writing to path and returns it, to be closed when done
+        """
+        return self.add_callback(JSONLinesSink(path))
+
+    def stage(self, name, rows=None, **context):
+        """
+        Returns a context manager that measures the stage it wraps
+
+        Keyword arguments:
+        name -- name of the stage, one of STAGES
+        rows -- number of source table rows processed, if known in advance [default: None]
+        context -- extra items of the event, e.g. method='make_object_table'
+        """
+        if name not in STAGES:
+            raise ValueError("Unknown stage '%s'. Choose one of %s." %(name, ', '.join(STAGES)))
+        return _Stage(self, name, rows, context)
+
+    def emit(self, event):
+        for callback in self.callbacks:
+            callback(event)
+
+    def __getstate__(self):
+        # Callbacks (e.g. open files) are neither picklable nor meaningful in another process
+        return {'callbacks': []}
@@ -0,0 +1,104 @@
+"""
+Counter-based random noise that does not depend on the order in which rows are generated.
+
+Every draw is a pure function of (seed, objectId, ccdVisitId, quantity):
+the key is hashed with the SplitMix64 finalizer into two uniform deviates,
+which are mapped to a standard normal deviate with the Box-Muller transform.
+The noise of a source table row is therefore the same whether the row was
+realized in a vectorized, chunked, parallel or row-by-row run, and whatever
+the other rows of the run were.
+"""
+
+import zlib
+import numpy as np
+
+_GOLDEN_GAMMA = np.uint64(0x9e3779b97f4a7c15)
+_MIX_MULT_1 = np.uint64(0xbf58476d1ce4e5b9)
+_MIX_MULT_2 = np.uint64(0x94d049bb133111eb)
+_SHIFT_30 = np.uint64(30)
+_SHIFT_27 = np.uint64(27)
+_SHIFT_31 = np.uint64(31)
+_SHIFT_11 = np.uint64(11)
+
+def _mix64(z):
+    """SplitMix64 finalizer, applied elementwise to a uint64 array"""
+    z = (z ^ (z >> _SHIFT_30))*_MIX_MULT_1
+    z = (z ^ (z >> _SHIFT_27))*_MIX_MULT_2
+    return z ^ (z >> _SHIFT_31)
+
+def _to_uint64(values):
+    """Reinterprets integer keys (which may be negative) as uint64"""
+    return np.atleast_1d(np.asarray(values)).astype(np.int64).view(np.uint64)
+
+def get_quantity_key(quantity):
+    """
+    Returns the stable integer key of a quantity name, e.g. 'x' or 'apFlux'.
+    Unlike hash(), it does not change between Python sessions.
+    """
+    return zlib.crc32(quantity.encode('utf-8')) & 0xffffffff
+
+def _hash_keys(seed, object_id, visit_id, quantity):
+    h = _mix64(_to_uint64(seed) + _GOLDEN_GAMMA)
+    h = _mix64(h ^ _to_uint64(object_id))
+    h = _mix64(h ^ _to_uint64(visit_id))
+    return _mix64(h ^ _to_uint64(get_quantity_key(quantity)))
+
+def _to_unit_interval(h):
+    """Maps uint64 hashes to uniform deviates in the open interval (0, 1)"""
+    return ((h >> _SHIFT_11).astype(np.float64) + 0.5)*(2.0**-53)
+
+def _get_uniform_pairs(seed, object_id, visit_id, quantity):
+    """Returns two independent arrays of uniform deviates in (0, 1) for the keys"""
+    with np.errstate(over='ignore'):
+        h = _hash_keys(seed, object_id, visit_id, quantity)
+        u1 = _to_unit_interval(_mix64(h ^ np.uint64(1)))
+        u2 = _to_unit_interval(_mix64(h ^ np.uint64(2)))
+    return u1, u2
+
+def get_uniform(seed, object_id, visit_id, quantity):
+    """
+    Returns uniform deviates in the open interval (0, 1), one per (object_id, visit_id) pair,
+    that depend only on the keys
+
+    Keyword arguments: see get_standard_normal
+    """
+    u1, u2 = _get_uniform_pairs(seed, object_id, visit_id, quantity)
+    if np.ndim(object_id) == 0 and np.ndim(visit_id) == 0:
+        return float(u1[0])
+    return u1
+
+def get_standard_normal(seed, object_id, visit_id, quantity):
+    """
+    Returns standard normal deviates, one per (object_id, visit_id) pair,
+    that depend only on the keys
+
+    Keyword arguments:
+    seed -- integer seed of the run
+    object_id -- objectId(s) of the rows, an integer or an array
+    visit_id -- ccdVisitId(s) of the rows, an integer or an array broadcastable with object_id
+    quantity -- name of the noisy quantity, e.g. 'x' or 'apFlux', so that
+                different quantities of the same row get independent noise
+
+    Returns:
+    a float if object_id and visit_id are scalars, an array otherwise
+    """
+    u1, u2 = _get_uniform_pairs(seed, object_id, visit_id, quantity)
+    standard_normal = np.sqrt(-2.0*np.log(u1))*np.cos(2.0*np.pi*u2)
+    if np.ndim(object_id) == 0 and np.ndim(visit_id) == 0:
+        return float(standard_normal[0])
+    return standard_normal
+
+def add_keyed_noise(mean, stdev, seed, object_id, visit_id, quantity, measurement=1.0):
+    """
+    Counter-based counterpart of utils.add_noise: returns Gaussian noise,
+    one draw per (object_id, visit_id) pair, to be added to the data
+
+    Keyword arguments:
+    mean -- the mean of Gaussian
+    stdev -- the standard deviation of Gaussian
+    seed, object_id, visit_id, quantity -- keys of the draws (see get_standard_normal)
+    measurement -- scaling factor, for adding fractional errors.
+                   If 1.0, error is absolute. [default: 1.0]
+    """
+    standard_normal = get_standard_normal(seed, object_id, visit_id, quantity)
+    return measurement*(mean + np.asarray(stdev)*standard_normal)
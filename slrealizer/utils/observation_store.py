@@ -0,0 +1,112 @@
+"""
+Indexed, read-only access to the visits of an observation history.
+
+The row-by-row realization looks up one visit per (observation, system) pair.
+Rather than scanning the observation DF for each obsHistID, or building a
+Pandas Series for each row, ObservationStore keeps the columns as NumPy arrays,
+with the permutations that sort them by obsHistID and by expMJD, so that
+    - a visit is found by its ID in O(log n) by binary search,
+    - the visits in an MJD range are found in O(log n + k) by binary search,
+    - a row is returned as an ObservationRecord, a plain tuple of its values.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+class ObservationRecord(tuple):
+
+    """
+    One visit of the observation history: a tuple of its values in column order,
+    which can be unpacked like the rows of the observation DF,
+    e.g. histID, MJD, band, PSF_FWHM, sky_mag = record,
+    and also indexed by column name, e.g. record['filter']
+
+    """
+
+    def __new__(cls, values, field_index=None):
+        record = tuple.__new__(cls, values)
+        # Shared by all the records of a store, mapping each column name to its position
+        record._field_index = field_index
+        return record
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return tuple.__getitem__(self, self._field_index[key])
+        return tuple.__getitem__(self, key)
+
+    def keys(self):
+        return sorted(self._field_index, key=self._field_index.get)
+
+    def replace(self, position, value):
+        """Returns a copy of the record with the value at position (e.g. 3, the PSF FWHM) replaced by value"""
+        values = list(self)
+        values[position] = value
+        return ObservationRecord(values, self._field_index)
+
+class ObservationStore(object):
+
+    """
+    Column arrays of an observation history, indexed by obsHistID and by expMJD.
+    The store is a snapshot: it does not follow later changes to the observation DF.
+
+    """
+
+    def __init__(self, observation):
+        """
+        Keyword arguments:
+        observation -- a Pandas DF of the observation history,
+                       with (at least) the columns obsHistID and expMJD
+        """
+        self.observation = observation
+        self.columns = list(observation.columns)
+        self._values = [observation[col].values for col in self.columns]
+        self._field_index = dict((col, c) for c, col in enumerate(self.columns))
+        obs_ids = observation['obsHistID'].values
+        self._id_order = np.argsort(obs_ids, kind='mergesort')
+        self._sorted_ids = obs_ids[self._id_order]
+        mjd = observation['expMJD'].values
+        self._mjd_order = np.argsort(mjd, kind='mergesort')
+        self._sorted_mjd = mjd[self._mjd_order]
+
+    def __len__(self):
+        return len(self._sorted_ids)
+
+    def get_record(self, rownum):
+        """Returns the ObservationRecord of the visit in row rownum (0-based position) of the observation DF"""
+        return ObservationRecord([values[rownum] for values in self._values], self._field_index)
+
+    def get_records(self, rownums):
+        """Returns the list of the ObservationRecords of the visits in rows rownums"""
+        rownums = np.asarray(rownums, dtype=np.int64)
+        columns = [values[rownums] for values in self._values]
+        return [ObservationRecord(values, self._field_index) for values in zip(*columns)]
+
+    def find_rows(self, obs_ids):
+        """
+        Returns the array of the row numbers of the visits with IDs obs_ids, -1 where an ID is absent.
+        Among duplicate IDs, the first row is returned.
+        """
+        obs_ids = np.atleast_1d(obs_ids)
+        position = np.searchsorted(self._sorted_ids, obs_ids, side='left')
+        found = position < len(self._sorted_ids)
+        found[found] = self._sorted_ids[position[found]] == obs_ids[found]
+        rows = np.full(len(obs_ids), -1, dtype=np.int64)
+        rows[found] = self._id_order[position[found]]
+        return rows
+
+    def get_record_by_id(self, obs_id):
+        """Returns the ObservationRecord of the visit with ID obs_id; raises KeyError if there is none"""
+        rownum = self.find_rows(obs_id)[0]
+        if rownum < 0:
+            raise KeyError("No visit with obsHistID %s in the observation history." %obs_id)
+        return self.get_record(rownum)
+
+    def get_rows_in_mjd_range(self, mjd_min, mjd_max):
+        """
+        Returns the sorted array of the row numbers of the visits with mjd_min <= expMJD < mjd_max
+        """
+        start, stop = np.searchsorted(self._sorted_mjd, [mjd_min, mjd_max], side='left')
+        return np.sort(self._mjd_order[start:stop])
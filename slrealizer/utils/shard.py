@@ -0,0 +1,66 @@
+"""
+Deterministic splitting of a catalog into shards, for realizations spread over many processes or hosts.
+
+Each system is assigned to one of N shards by its ID alone, either by a hash of
+the ID or by its rank among the sorted IDs, so that every shard can be realized
+independently (see SLRealizer.make_source_table_shard). As the noise and the
+variability of each row are keyed by (seed, objectId, ccdVisitId), the rows of
+a system are the same whichever shard realizes them, and the merged outputs do not
+depend on N (see SLRealizer.merge_object_table_shards).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import numpy as np
+from .noise import _mix64, _to_uint64
+
+SHARD_METHODS = ['hash', 'range']
+
+def parse_shard(spec):
+    """
+    Returns the (shard_index, num_shards) of a shard specification 'i/N', with 0 <= i < N
+    """
+    try:
+        shard_index, num_shards = [int(v) for v in spec.split('/')]
+    except ValueError:
+        raise ValueError("Shard must be given as i/N, e.g. 0/16, not '%s'." %spec)
+    if num_shards < 1 or not 0 <= shard_index < num_shards:
+        raise ValueError("Shard index must be in [0, %d), got %d." %(num_shards, shard_index))
+    return shard_index, num_shards
+
+def get_shard_indices(object_ids, num_shards, method='hash'):
+    """
+    Returns the index of the shard of each system, in [0, num_shards)
+
+    Keyword arguments:
+    object_ids -- array of the IDs of the systems
+    num_shards -- number of shards
+    method -- 'hash' to spread the systems over the shards by a hash of their IDs
+              (which keeps neighboring IDs apart), or 'range' to give each shard
+              a contiguous range of the sorted IDs, of nearly equal size [default: 'hash']
+    """
+    object_ids = np.asarray(object_ids)
+    if method == 'hash':
+        with np.errstate(over='ignore'):
+            return (_mix64(_to_uint64(object_ids)) % np.uint64(num_shards)).astype(np.int64)
+    elif method == 'range':
+        unique_ids = np.unique(object_ids)
+        rank = np.searchsorted(unique_ids, object_ids)
+        return rank*num_shards//max(len(unique_ids), 1)
+    raise ValueError("Unknown shard method '%s'. Choose one of %s." %(method, ', '.join(SHARD_METHODS)))
+
+def get_shard_path(path, shard_index, num_shards):
+    """
+    Returns the path of the part of the table at path written by shard shard_index of num_shards,
+    e.g. source.csv -> source.shard0003of0016.csv
+    """
+    for ext in ['.csv.gz']:
+        if path.endswith(ext):
+            root = path[:-len(ext)]
+            break
+    else:
+        root, ext = os.path.splitext(path)
+    return '%s.shard%04dof%04d%s' %(root, shard_index, num_shards, ext)
@@ -0,0 +1,412 @@
+"""
+Pluggable on-disk formats for the source and object tables.
+
+The format of a table is inferred from the file extension
+(.csv, .parquet/.pq, .feather) unless given explicitly.
+CSV is kept as the legacy format; Parquet and Feather are columnar
+and require pyarrow, which is only imported when they are used.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+# The filter column is a categorical, i.e. one byte per row instead of a Python string
+FILTER_DTYPE = pd.api.types.CategoricalDtype(categories=list('ugrizy'))
+# Measured quantities of the source table, which can be stored in single precision.
+# MJD always stays in double precision: float32 resolves MJD ~ 60000 only to ~0.004 days.
+SOURCE_FLOAT_COLUMNS = ['psf_fwhm', 'x', 'y', 'apFlux', 'apFluxErr', 'apMag', 'apMagErr',
+                        'trace', 'e1', 'e2', 'e_final', 'phi_final']
+
+def get_source_table_dtypes(max_id=None, use_float32=False):
+    """
+    Returns the dictionary of the dtypes of the source table columns
+
+    Keyword arguments:
+    max_id -- largest objectId or ccdVisitId of the table. The IDs are stored as int32
+              if it fits, and as int64 if it does not or if it is None [default: None]
+    use_float32 -- whether to store the measured quantities (SOURCE_FLOAT_COLUMNS) in float32.
+                   They are still computed in float64; storing them in float32 changes
+                   each value by at most half a unit in the last place, i.e. a relative error
+                   of 6e-8 (see tests/test_table_io.py for the check against float64 output) [default: False]
+    """
+    if max_id is not None and max_id <= np.iinfo(np.int32).max:
+        id_dtype = np.int32
+    else:
+        id_dtype = np.int64
+    float_dtype = np.float32 if use_float32 else np.float64
+    dtypes = {'MJD': np.float64, 'ccdVisitId': id_dtype, 'objectId': id_dtype, 'filter': FILTER_DTYPE}
+    dtypes.update((col, float_dtype) for col in SOURCE_FLOAT_COLUMNS)
+    return dtypes
+
+def get_object_table_dtypes(columns, use_float32=False):
+    """
+    Returns the dictionary of the dtypes of the given object table columns,
+    all of which are per-band means or standard deviations of measured quantities
+
+    Keyword arguments:
+    columns -- the object table columns
+    use_float32 -- whether to store them in float32 (see get_source_table_dtypes) [default: False]
+    """
+    return dict((col, np.float32 if use_float32 else np.float64) for col in columns)
+
+# Default dtypes of the source table columns, applied when writing
+# so that every tile of a chunked run has the same schema,
+# and when reading CSV so that no dtype inference is needed
+SOURCE_TABLE_DTYPES = get_source_table_dtypes()
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError("The Parquet and Feather table formats require pyarrow. "
+                          "Please install it or use the CSV table format.")
+    return pyarrow
+
+def _apply_dtypes(df, dtype):
+    """Casts the columns of df that appear in dtype"""
+    if dtype is None:
+        return df
+    dtype = dict((col, dt) for col, dt in dtype.items() if col in df.columns)
+    for col, dt in dtype.items():
+        # Values outside of the categories would become missing (or raise, in later pandas) in the cast
+        if isinstance(dt, pd.api.types.CategoricalDtype):
+            if (df[col].notnull() & ~df[col].isin(dt.categories)).any():
+                raise ValueError("Column %s has values outside of %s." %(col, list(dt.categories)))
+    return df.astype(dtype)
+
+def _flatten_index(df, index):
+    """Moves a named index into the columns, or discards it if index is False"""
+    if index and any(name is not None for name in df.index.names):
+        return df.reset_index()
+    return df.reset_index(drop=True)
+
+class CSVFormat(object):
+
+    """Legacy text format, written and read with Pandas"""
+
+    name = 'csv'
+    extensions = ['.csv', '.csv.gz']
+
+    def write(self, df, path, index=True, compression=None):
+        # Without a codec, Pandas infers it from the extension, e.g. gzip for .csv.gz
+        df.to_csv(path, index=index, compression=compression or 'infer')
+
+    def read(self, path, columns=None, dtype=None):
+        if dtype is not None and columns is not None:
+            dtype = dict((col, dt) for col, dt in dtype.items() if col in columns)
+        return pd.read_csv(path, usecols=columns, dtype=dtype)
+
+    def read_chunks(self, path, chunk_size, columns=None, dtype=None):
+        if dtype is not None and columns is not None:
+            dtype = dict((col, dt) for col, dt in dtype.items() if col in columns)
+        for chunk in pd.read_csv(path, usecols=columns, dtype=dtype, chunksize=chunk_size):
+            yield chunk
+
+    def open_writer(self, path, index=True, compression=None):
+        if compression is not None:
+            raise ValueError("Appending to a compressed CSV file is not supported.")
+        return CSVWriter(path, index=index)
+
+    def append(self, df, path, index=True, compression=None, dtype=None):
+        if compression is not None:
+            raise ValueError("Appending to a compressed CSV file is not supported.")
+        columns = pd.read_csv(path, nrows=0).columns
+        # A .csv.gz file is appended to as another gzip member, which gzip readers concatenate
+        _flatten_index(df, index)[columns].to_csv(path, mode='a', header=False, index=False, compression='infer')
+
+class ParquetFormat(object):
+
+    """Columnar format with per-column compression, written and read with pyarrow"""
+
+    name = 'parquet'
+    extensions = ['.parquet', '.pq']
+    default_compression = 'snappy'
+
+    def write(self, df, path, index=True, compression=None):
+        pa = _import_pyarrow()
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pandas(_flatten_index(df, index), preserve_index=False)
+        pq.write_table(table, path, compression=compression or self.default_compression)
+
+    def read(self, path, columns=None, dtype=None):
+        _import_pyarrow()
+        import pyarrow.parquet as pq
+        return _apply_dtypes(pq.read_table(path, columns=columns).to_pandas(), dtype)
+
+    def read_chunks(self, path, chunk_size, columns=None, dtype=None):
+        _import_pyarrow()
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=columns):
+            yield _apply_dtypes(batch.to_pandas(), dtype)
+
+    def open_writer(self, path, index=True, compression=None):
+        return ParquetWriter(path, index=index, compression=compression or self.default_compression)
+
+    def append(self, df, path, index=True, compression=None, dtype=None):
+        _append_by_rewrite(self, df, path, index=index, compression=compression, dtype=dtype)
+
+class FeatherFormat(object):
+
+    """Arrow IPC (Feather V2) format, written and read with pyarrow"""
+
+    name = 'feather'
+    extensions = ['.feather']
+    default_compression = 'lz4'
+
+    def write(self, df, path, index=True, compression=None):
+        pa = _import_pyarrow()
+        import pyarrow.feather as feather
+        table = pa.Table.from_pandas(_flatten_index(df, index), preserve_index=False)
+        feather.write_feather(table, path, compression=compression or self.default_compression)
+
+    def read(self, path, columns=None, dtype=None):
+        _import_pyarrow()
+        import pyarrow.feather as feather
+        return _apply_dtypes(feather.read_table(path, columns=columns).to_pandas(), dtype)
+
+    def read_chunks(self, path, chunk_size, columns=None, dtype=None):
+        pa = _import_pyarrow()
+        # Record batches are memory-mapped, so only the rows of one chunk are materialized
+        reader = pa.ipc.open_file(pa.memory_map(path, 'r'))
+        for b in range(reader.num_record_batches):
+            batch = reader.get_batch(b)
+            if columns is not None:
+                batch = batch.select(columns)
+            for offset in range(0, batch.num_rows, chunk_size):
+                yield _apply_dtypes(batch.slice(offset, chunk_size).to_pandas(), dtype)
+
+    def open_writer(self, path, index=True, compression=None):
+        return FeatherWriter(path, index=index, compression=compression or self.default_compression)
+
+    def append(self, df, path, index=True, compression=None, dtype=None):
+        _append_by_rewrite(self, df, path, index=index, compression=compression, dtype=dtype)
+
+def _append_by_rewrite(fmt, df, path, index=True, compression=None, chunk_size=1000000, dtype=None):
+    """
+    Appends df to a table in a format that cannot be appended to in place,
+    by streaming the existing rows and then df into a new file that replaces the old one
+    """
+    if dtype is None:
+        dtype = SOURCE_TABLE_DTYPES
+    tmp_path = path + '.tmp'
+    writer = fmt.open_writer(tmp_path, index=False, compression=compression)
+    columns = None
+    for chunk in fmt.read_chunks(path, chunk_size, dtype=dtype):
+        columns = chunk.columns
+        writer.write(chunk)
+    new_rows = _apply_dtypes(_flatten_index(df, index), dtype)
+    writer.write(new_rows if columns is None else new_rows[columns])
+    writer.close()
+    # Atomic on POSIX, so a failed append leaves the old table intact
+    os.rename(tmp_path, path)
+
+class CSVWriter(object):
+
+    """Appends DataFrames to a CSV file, writing the header only once"""
+
+    def __init__(self, path, index=True):
+        self.path = path
+        self.index = index
+        self.num_rows = 0
+        self._is_first = True
+
+    def write(self, df):
+        df.to_csv(self.path, index=self.index, mode='w' if self._is_first else 'a', header=self._is_first,
+                  compression='infer')
+        self._is_first = False
+        self.num_rows += len(df)
+
+    def close(self):
+        if self._is_first:
+            # Nothing was written, but the file should still exist
+            open(self.path, 'w').close()
+
+class ParquetWriter(object):
+
+    """Appends DataFrames to a Parquet file as row groups"""
+
+    def __init__(self, path, index=True, compression='snappy'):
+        _import_pyarrow()
+        self.path = path
+        self.index = index
+        self.compression = compression
+        self.num_rows = 0
+        self._writer = None
+        self._schema = None
+
+    def write(self, df):
+        pa = _import_pyarrow()
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pandas(_flatten_index(df, self.index), preserve_index=False)
+        if self._writer is None:
+            self._schema = table.schema
+            self._writer = pq.ParquetWriter(self.path, self._schema, compression=self.compression)
+        self._writer.write_table(table.cast(self._schema))
+        self.num_rows += len(df)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+class FeatherWriter(object):
+
+    """Appends DataFrames to a Feather V2 (Arrow IPC) file as record batches"""
+
+    def __init__(self, path, index=True, compression='lz4'):
+        _import_pyarrow()
+        self.path = path
+        self.index = index
+        self.compression = compression
+        self.num_rows = 0
+        self._sink = None
+        self._writer = None
+        self._schema = None
+
+    def write(self, df):
+        pa = _import_pyarrow()
+        table = pa.Table.from_pandas(_flatten_index(df, self.index), preserve_index=False)
+        if self._writer is None:
+            self._schema = table.schema
+            self._sink = pa.OSFile(self.path, 'wb')
+            options = pa.ipc.IpcWriteOptions(compression=self.compression)
+            self._writer = pa.ipc.new_file(self._sink, self._schema, options=options)
+        self._writer.write_table(table.cast(self._schema))
+        self.num_rows += len(df)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._sink.close()
+
+TABLE_FORMATS = {
+    'csv': CSVFormat(),
+    'parquet': ParquetFormat(),
+    'feather': FeatherFormat(),
+}
+
+def register_table_format(table_format):
+    """
+    Makes a new table format available to read_table, iter_table, write_table and open_table_writer
+
+    Keyword arguments:
+    table_format -- an object with the attributes name and extensions
+                    and the methods read, read_chunks, write, append and open_writer (see CSVFormat)
+    """
+    TABLE_FORMATS[table_format.name] = table_format
+
+def get_table_format(path, table_format=None):
+    """
+    Returns the table format object for the given path
+
+    Keyword arguments:
+    path -- path of the table file
+    table_format -- name of the format, e.g. 'csv', 'parquet' or 'feather'.
+                    If None, the format is inferred from the extension of path [default: None]
+    """
+    if table_format is not None:
+        if table_format not in TABLE_FORMATS:
+            raise ValueError("Unknown table format '%s'. Choose one of %s." %(table_format, sorted(TABLE_FORMATS.keys())))
+        return TABLE_FORMATS[table_format]
+    lower_path = str(path).lower()
+    for fmt in TABLE_FORMATS.values():
+        if any(lower_path.endswith(ext) for ext in fmt.extensions):
+            return fmt
+    # Tables have always been CSV files, whatever their extension
+    return TABLE_FORMATS['csv']
+
+def write_table(df, path, table_format=None, index=True, compression=None, dtype=None):
+    """
+    Saves a source or object table
+
+    Keyword arguments:
+    df -- the Pandas DF to save
+    path -- save path of the table
+    table_format -- name of the format; if None, inferred from path [default: None]
+    index -- whether to save the index of df as a column [default: True]
+    compression -- compression codec, e.g. 'snappy', 'zstd', 'lz4' or 'gzip'.
+                   If None, the default of the format is used [default: None]
+    dtype -- dictionary of the dtypes the columns are cast to before saving,
+             e.g. from get_source_table_dtypes. If None, SOURCE_TABLE_DTYPES is used [default: None]
+    """
+    if dtype is None:
+        dtype = SOURCE_TABLE_DTYPES
+    get_table_format(path, table_format).write(_apply_dtypes(df, dtype), path, index=index, compression=compression)
+
+def read_table(path, table_format=None, columns=None, dtype=None):
+    """
+    Reads a source or object table
+
+    Keyword arguments:
+    path -- path of the table
+    table_format -- name of the format; if None, inferred from path [default: None]
+    columns -- list of the columns to read. If None, all columns are read [default: None]
+    dtype -- dictionary of column dtypes. If None, SOURCE_TABLE_DTYPES is used [default: None]
+
+    Returns:
+    a Pandas DF with a default integer index
+    """
+    if dtype is None:
+        dtype = SOURCE_TABLE_DTYPES
+    return get_table_format(path, table_format).read(path, columns=columns, dtype=dtype)
+
+def iter_table(path, chunk_size, table_format=None, columns=None, dtype=None):
+    """
+    Reads a source or object table in chunks of at most chunk_size rows,
+    so that tables larger than memory can be processed
+
+    Keyword arguments:
+    path -- path of the table
+    chunk_size -- maximum number of rows per chunk
+    table_format, columns, dtype -- see read_table
+
+    Returns:
+    a generator of Pandas DFs with default integer indices
+    """
+    if dtype is None:
+        dtype = SOURCE_TABLE_DTYPES
+    return get_table_format(path, table_format).read_chunks(path, chunk_size, columns=columns, dtype=dtype)
+
+def append_table(df, path, table_format=None, index=True, compression=None, dtype=None):
+    """
+    Appends the rows of df to the table at path, or creates it if it does not exist.
+    The columns of df are matched to those of the existing table by name.
+
+    Keyword arguments: see write_table
+    """
+    if not os.path.exists(path):
+        write_table(df, path, table_format=table_format, index=index, compression=compression, dtype=dtype)
+        return
+    if dtype is None:
+        dtype = SOURCE_TABLE_DTYPES
+    get_table_format(path, table_format).append(_apply_dtypes(df, dtype), path, index=index, compression=compression, dtype=dtype)
+
+def open_table_writer(path, table_format=None, index=True, compression=None, dtype=None):
+    """
+    Returns a writer whose write(df) method appends df to the table at path
+    and whose close() method finalizes the file.
+    Used to write a table that is generated in chunks.
+
+    Keyword arguments: see write_table
+    """
+    if dtype is None:
+        dtype = SOURCE_TABLE_DTYPES
+    return _DtypeWriter(get_table_format(path, table_format).open_writer(path, index=index, compression=compression), dtype)
+
+class _DtypeWriter(object):
+
+    """Casts each chunk to the table dtypes before handing it to a format-specific writer"""
+
+    def __init__(self, writer, dtype):
+        self.writer = writer
+        self.dtype = dtype
+
+    @property
+    def num_rows(self):
+        return self.writer.num_rows
+
+    def write(self, df):
+        self.writer.write(_apply_dtypes(df, self.dtype))
+
+    def close(self):
+        self.writer.close()
@@ -1,6 +1,54 @@
 import numpy as np
 
 
+# Pixel coordinate grids of the moment engine, keyed by (ny, nx, pixel_scale)
+_moment_grid_cache = {}
+
+def get_moment_grid(ny, nx, pixel_scale):
+    """
+    Returns the (cached) pixel center coordinates in arcsec of an ny x nx image
+    centered on the origin, as a dictionary of the 1D arrays x (length nx) and y (length ny),
+    their squares x2 and y2, and the 2D array xy = y*x of shape (ny, nx)
+    """
+    key = (ny, nx, float(pixel_scale))
+    if key not in _moment_grid_cache:
+        x = (np.arange(nx) - 0.5*(nx - 1))*pixel_scale
+        y = (np.arange(ny) - 0.5*(ny - 1))*pixel_scale
+        _moment_grid_cache[key] = {'x': x, 'y': y, 'x2': x*x, 'y2': y*y, 'xy': np.outer(y, x)}
+    return _moment_grid_cache[key]
+
+def get_moments_from_images(images, pixel_scale):
+    """
+    Returns the flux, first moments and second (central) moments in arcsec units
+    numerically computed from a stack of images on the same pixel grid, in one pass
+    
+    Keyword arguments:
+    images -- a numpy array of shape (N, ny, nx), or a single (ny, nx) image
+    pixel_scale -- scale factor for the images in arcsec/pixel
+ 
+    Returns:
+    a tuple of arrays of shape (N,) (scalars for a single image) of
+    the total flux, Ix, Iy in arcsec, and Ixx, Ixy, Iyy in arcsec^2
+    """
+    images = np.asarray(images, dtype=np.float64)
+    is_single = (images.ndim == 2)
+    if is_single:
+        images = images[None, :, :]
+    num_images, ny, nx = images.shape
+    grid = get_moment_grid(ny, nx, pixel_scale)
+    # Marginal profiles along x (summed over rows) and along y (summed over columns)
+    x_profile = images.sum(axis=1)
+    y_profile = images.sum(axis=2)
+    flux = x_profile.sum(axis=1)
+    Ix = x_profile.dot(grid['x'])/flux
+    Iy = y_profile.dot(grid['y'])/flux
+    Ixx = x_profile.dot(grid['x2'])/flux - Ix*Ix
+    Iyy = y_profile.dot(grid['y2'])/flux - Iy*Iy
+    Ixy = images.reshape(num_images, -1).dot(grid['xy'].ravel())/flux - Ix*Iy
+    if is_single:
+        return flux[0], Ix[0], Iy[0], Ixx[0], Ixy[0], Iyy[0]
+    return flux, Ix, Iy, Ixx, Ixy, Iyy
+
 def get_first_moments_from_image(image_array, pixel_scale):
     """ 
     Returns the first moments in arcsec units numerically computed from
@@ -13,14 +61,7 @@ def get_first_moments_from_image(image_array, pixel_scale):
     Returns:
     a tuple of the first moments Ix, Iy in arcsec
     """
-    nx, ny = image_array.shape
-    offset = np.array([(nx - 1)/2, (ny - 1)/2]).reshape(2, 1, 1)
-    pixel_grid = np.indices([nx, ny]) - offset # shape (2, nx, ny)
-    x_coords = pixel_grid[1, :, :] * pixel_scale
-    y_coords = pixel_grid[0, :, :] * pixel_scale
-    total_flux = np.sum(image_array)
-    Ix = np.sum(image_array * x_coords) / total_flux 
-    Iy = np.sum(image_array * y_coords) / total_flux 
+    flux, Ix, Iy, Ixx, Ixy, Iyy = get_moments_from_images(image_array, pixel_scale)
     return Ix, Iy
 
 def get_second_moments_from_image(image_array, pixel_scale):
@@ -35,16 +76,7 @@ def get_second_moments_from_image(image_array, pixel_scale):
     Returns:
     a tuple of the second moments Ixx, Ixy, Iyy in arcsec
     """
-    nx, ny = image_array.shape
-    Ix, Iy = get_first_moments_from_image(image_array, pixel_scale=1.0)
-    offset = np.array([(ny - 1)/2 + Iy, (nx - 1)/2 + Ix]).reshape(2, 1, 1)
-    pixel_grid = np.indices([ny, nx]) - offset # shape (2, nx, ny)
-    x_coords = pixel_grid[1, :, :] * pixel_scale
-    y_coords = pixel_grid[0, :, :] * pixel_scale
-    total_flux = np.sum(image_array)
-    Ixx = np.sum(image_array * np.power(x_coords, 2.0)) / total_flux 
-    Ixy = np.sum(image_array * x_coords * y_coords) / total_flux 
-    Iyy = np.sum(image_array * np.power(y_coords, 2.0)) / total_flux 
+    flux, Ix, Iy, Ixx, Ixy, Iyy = get_moments_from_images(image_array, pixel_scale)
     return Ixx, Ixy, Iyy
 
 def e1e2_to_ephi(e1, e2):
@@ -67,6 +99,22 @@ def get_1D_columns(multidimColNames, table):
         totalColDict.update(colDict)
     return totalColDict
 
+def get_chunk_bounds(total_size, chunk_size):
+    """
+    Returns the (start, stop) index pairs that split range(total_size)
+    into consecutive chunks of at most chunk_size elements
+    
+    Keyword arguments:
+    total_size -- number of elements to split
+    chunk_size -- maximum number of elements in each chunk.
+                  If None, a single chunk spanning all elements is returned.
+    """
+    if chunk_size is None or chunk_size >= total_size:
+        return [(0, total_size)]
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be a positive integer.")
+    return [(start, min(start + chunk_size, total_size)) for start in range(0, total_size, chunk_size)]
+
 def hlr_to_sigma(hlr):
     return hlr/np.sqrt(2.0*np.log(2.0))
 